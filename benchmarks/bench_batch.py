@@ -0,0 +1,102 @@
+"""
+Detection throughput as a function of the batch size (client.py --batch): once
+in this process, where only the vectorized detect_batch is timed, and through the
+real pipeline, where frames go through the shared memory ring and the FrameQueue
+to one DetectorWorker and the coordinates come back on the results queue, so
+per-frame IPC and wake-ups are included.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_batch --batches 1,2,4,8,16,32 --frames 2000
+"""
+
+import argparse
+import multiprocessing as mp
+import time
+
+import cv2
+import numpy as np
+
+from docker_client.client import DetectorPool, FrameQueue, FrameRing, MomentsDetector
+
+
+def generate(shape, count):
+    """
+    Luma planes of a ball at different positions.
+    """
+    height, width = shape
+    frames = np.full((count, height, width), 16, dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        cv2.circle(frame, (40 + (7 * i) % (width - 80), 40 + (5 * i) % (height - 80)), 20, 82, -1)
+    return frames
+
+
+def in_process(frames, batch, repeat):
+    """
+    Microseconds per frame of MomentsDetector, detect for batch 1 and detect_batch otherwise.
+    """
+    detector = MomentsDetector()
+    pts = np.arange(len(frames))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if batch == 1:
+            for frame in frames:
+                detector.detect(frame)
+        else:
+            for i in range(0, len(frames), batch):
+                detector.detect_batch(frames[i:i + batch], pts[i:i + batch])
+    return (time.perf_counter() - start) / (repeat * len(frames)) * 1e6
+
+
+def pipeline(frames, batch, total):
+    """
+    Frames per second through the ring, the queue and one detector worker. The
+    producer keeps the queue full, so the worker always finds a whole batch.
+    """
+    queue_size = max(2 * batch, 4)
+    queue, results = FrameQueue(queue_size, "drop-newest"), mp.Queue()
+    ring = FrameRing(frames.shape[1:], slots=queue_size + batch + 1)
+    pool = DetectorPool(queue, (mp.Value('i', 0), mp.Value('i', 0)), 1, ring, results, None, MomentsDetector(), batch)
+    pool.start()
+    try:
+        start = time.perf_counter()
+        sent = 0
+        while sent < total:
+            if queue.latest.value - queue.taken.value >= queue_size:
+                time.sleep(0.0001)
+                continue
+            queue.put(ring.write(frames[sent % len(frames)], sent) + (time.perf_counter(),))
+            sent += 1
+        while sum(pool.frame_counts()) + queue.dropped.value < total:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        processed = sum(pool.frame_counts())
+        messages = 0
+        while not results.empty():
+            results.get()
+            messages += 1
+    finally:
+        pool.stop()
+        ring.close()
+    return processed / elapsed, processed / max(messages, 1), queue.dropped.value
+
+
+def csv(text):
+    return [int(item) for item in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detection throughput versus batch size")
+    parser.add_argument("--batches", type=csv, default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--frames", type=int, default=2000, help="Frames sent through the pipeline per batch size.")
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=640)
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    frames = generate((args.height, args.width), 64)
+    print("%6s %14s %14s %16s %8s" % ("batch", "detect us/fr", "pipeline fps", "frames/message", "dropped"))
+    for batch in args.batches:
+        detect = in_process(frames, batch, 5)
+        fps, per_message, dropped = pipeline(frames, batch, args.frames)
+        print("%6d %14.0f %14.0f %16.1f %8d" % (batch, detect, fps, per_message, dropped))
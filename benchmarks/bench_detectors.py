@@ -0,0 +1,118 @@
+"""
+Throughput and accuracy of every detector backend in client.py's DETECTORS over
+generated luma frames (what client.py detects on by default) at several
+resolutions and levels of Gaussian noise. For each resolution and noise level the
+fastest backend whose mean error, miss rate and spurious detections meet
+the targets is picked.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_detectors --frames 100 --noise 0,10,25 --max-error 2
+"""
+
+import argparse
+import math
+import time
+
+import cv2
+import numpy as np
+
+from docker_client.client import DETECTORS
+from docker_server.server import YuvBallRenderer
+
+
+RESOLUTIONS = {
+    "480p": (480, 640, 3),
+    "720p": (720, 1280, 3),
+    "1080p": (1080, 1920, 3),
+}
+
+RADIUS = 20
+
+
+def generate(image_shape, frames, noise, seed=0):
+    """
+    Luma planes of a red ball at random positions, with Gaussian noise of standard deviation noise.
+
+    Returns
+    -------
+    tuple
+        (list of (height, width) uint8 frames, (frames, 2) true centres)
+    """
+    rng = np.random.default_rng(seed)
+    height, width = image_shape[:2]
+    renderer = YuvBallRenderer(image_shape, 'uint8', RADIUS, (0, 0, 255))
+    centres = np.stack([rng.integers(RADIUS, width - RADIUS, frames), rng.integers(RADIUS, height - RADIUS, frames)], axis=1)
+    images = []
+    for x, y in centres.tolist():
+        luma = renderer.render(x, y)[:height].astype(np.float32)
+        if noise > 0:
+            luma += rng.normal(0, noise, luma.shape).astype(np.float32)
+        images.append(np.clip(luma, 0, 255).astype(np.uint8))
+    return images, centres
+
+
+def run(name, images, centres, threshold):
+    """
+    Run one backend over the frames.
+
+    Returns
+    -------
+    dict
+        frames per second, mean pixel error of the frames with a detection, fraction of frames
+        missed and extra detections per frame
+    """
+    detector = DETECTORS[name](threshold)
+    found = []
+    start = time.perf_counter()
+    for image in images:
+        found.append(detector.detect_all(image) if detector.multiple else detector.detect(image))
+    fps = len(images) / (time.perf_counter() - start)
+
+    errors, spurious = [], 0
+    for centre, (x, y) in zip(found, centres.tolist()):
+        if centre is None:
+            continue
+        cx, cy = centre
+        if detector.multiple:
+            # Several components, score the one closest to the ball and count the others
+            spurious += len(cx) - 1
+            cx, cy = min(zip(cx.tolist(), cy.tolist()), key=lambda c: math.hypot(c[0] - x, c[1] - y))
+        errors.append(math.hypot(cx - x, cy - y))
+    return {
+        "fps": fps,
+        "error": float(np.mean(errors)) if errors else float("nan"),
+        "missed": 1 - len(errors) / len(images),
+        "spurious": spurious / len(images),
+    }
+
+
+def csv(cast):
+    return lambda text: [cast(item) for item in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detector backend throughput and accuracy")
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--resolutions", type=csv(str), default=list(RESOLUTIONS))
+    parser.add_argument("--noise", type=csv(float), default=[0, 10, 25], help="Standard deviations of the Gaussian noise added to the frames.")
+    parser.add_argument("--detectors", type=csv(str), default=list(DETECTORS))
+    parser.add_argument("--threshold", type=int, default=50)
+    parser.add_argument("--max-error", type=float, default=2.0, help="Accuracy target, mean pixel error.")
+    parser.add_argument("--max-missed", type=float, default=0.01, help="Accuracy target, fraction of frames without a detection.")
+    parser.add_argument("--max-spurious", type=float, default=0.0, help="Accuracy target, extra detections per frame.")
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    print("%-6s %6s %-11s %10s %10s %8s %9s" % ("res", "noise", "detector", "fps", "error px", "missed", "spurious"))
+    for resolution in args.resolutions:
+        for noise in args.noise:
+            images, centres = generate(RESOLUTIONS[resolution], args.frames, noise)
+            results = {name: run(name, images, centres, args.threshold) for name in args.detectors}
+            for name, result in results.items():
+                print("%-6s %6.0f %-11s %10.0f %10.2f %7.1f%% %9.1f" % (
+                    resolution, noise, name, result["fps"], result["error"], result["missed"] * 100, result["spurious"]))
+            eligible = [name for name, result in results.items()
+                        if result["error"] <= args.max_error and result["missed"] <= args.max_missed and result["spurious"] <= args.max_spurious]
+            best = max(eligible, key=lambda name: results[name]["fps"]) if eligible else "none"
+            print("%-6s %6.0f -> fastest within %.1f px: %s\n" % (resolution, noise, args.max_error, best))
@@ -0,0 +1,112 @@
+"""
+CPU and memory of the fan-out server (server.py --fanout) as viewers are added.
+The server runs in its own process, the viewers are plain aiortc receivers in
+this process which decode and discard the frames.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_fanout --clients 8 --window 5
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from aiortc import RTCPeerConnection
+from aiortc.contrib.media import MediaBlackhole
+from aiortc.contrib.signaling import TcpSocketSignaling
+
+
+def process_cpu_seconds(pid):
+    """
+    User plus system CPU time of a process and all its threads, from /proc.
+    """
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def process_rss_mb(pid):
+    """
+    Resident set size of a process in MB, from /proc.
+    """
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def add_viewer(host, port):
+    """
+    Connect one receiver to the fan-out server and start consuming its video.
+
+    Returns
+    -------
+    tuple
+        (peer connection, signaling, media sink) to close at the end
+    """
+    signaling = TcpSocketSignaling(host, port)
+    pc = RTCPeerConnection()
+    sink = MediaBlackhole()
+
+    @pc.on("track")
+    def on_track(track):
+        sink.addTrack(track)
+
+    offer = await signaling.receive()
+    await pc.setRemoteDescription(offer)
+    await sink.start()
+    await pc.setLocalDescription(await pc.createAnswer())
+    await signaling.send(pc.localDescription)
+    return pc, signaling, sink
+
+
+async def measure(pid, window):
+    """
+    Server CPU usage in percent of one core and RSS over a time window.
+    """
+    cpu, start = process_cpu_seconds(pid), time.perf_counter()
+    await asyncio.sleep(window)
+    cpu = (process_cpu_seconds(pid) - cpu) / (time.perf_counter() - start) * 100
+    return cpu, process_rss_mb(pid)
+
+
+async def run(clients, window, port):
+    """
+    Start the server, add viewers one at a time and print the cost of each step.
+    """
+    server = subprocess.Popen(
+        [sys.executable, os.path.join("docker_server", "server.py"), "--fanout",
+         "--signaling", "tcp-socket", "--signaling-port", str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    viewers = []
+    try:
+        await asyncio.sleep(2)
+        base_cpu, base_rss = await measure(server.pid, window)
+        print("%8s %10s %10s %14s %14s" % ("clients", "cpu %", "rss MB", "cpu %/client", "MB/client"))
+        print("%8d %10.1f %10.1f %14s %14s" % (0, base_cpu, base_rss, "-", "-"))
+        for k in range(1, clients + 1):
+            viewers.append(await add_viewer("127.0.0.1", port))
+            await asyncio.sleep(1)   # let the connection settle before measuring
+            cpu, rss = await measure(server.pid, window)
+            print("%8d %10.1f %10.1f %14.1f %14.1f" % (k, cpu, rss, (cpu - base_cpu) / k, (rss - base_rss) / k))
+    finally:
+        for pc, signaling, sink in viewers:
+            await sink.stop()
+            await pc.close()
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fan-out server cost per added client")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--window", type=float, default=5.0, help="Seconds measured per step.")
+    parser.add_argument("--port", type=int, default=9765)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.clients, args.window, args.port))
@@ -0,0 +1,101 @@
+"""
+Allocations per frame on the send and receive paths, before and after pooling.
+
+Send path: a rendered yuv420p or bgr24 image is wrapped in a new VideoFrame with
+VideoFrame.from_ndarray, or copied into a frame of a VideoFramePool. Receive
+path: a decoded yuv420p frame is converted to bgr24 with to_ndarray, or into
+reused buffers with bgr_image. Bytes are counted with tracemalloc, which sees
+the numpy arrays and Python objects; libav allocates the frame buffers itself,
+so the minor page faults per frame are reported too.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_frame_pool --frames 300
+"""
+
+import argparse
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+from av import VideoFrame
+
+from docker_client.client import bgr_image
+from docker_server.server import VideoFramePool
+
+
+RESOLUTIONS = {
+    "480p": (480, 640),
+    "1080p": (1080, 1920),
+}
+
+
+def measure(step, frames):
+    """
+    Run a per-frame step and measure its speed, allocations and page faults.
+
+    Parameters
+    ----------
+    step : callable
+        one frame of work, its result is kept until the next call like a sender would
+    frames : int
+        number of frames
+
+    Returns
+    -------
+    tuple
+        (frames per second, bytes allocated per frame, peak bytes of one frame, minor page faults per frame)
+    """
+    held = step()
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    start = time.perf_counter()
+    for _ in range(frames):
+        held = step()
+    fps = frames / (time.perf_counter() - start)
+    faults = (resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults) / frames
+
+    tracemalloc.start()
+    allocated = peak = 0
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        held = step()
+        _, frame_peak = tracemalloc.get_traced_memory()
+        allocated += frame_peak - before
+        peak = max(peak, frame_peak - before)
+    tracemalloc.stop()
+    del held
+    return fps, allocated / frames, peak, faults
+
+
+def steps(height, width):
+    """
+    The before and after step of every path at one resolution.
+    """
+    rng = np.random.default_rng(0)
+    yuv = rng.integers(0, 256, (height * 3 // 2, width), dtype=np.uint8)
+    bgr = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    yuv_pool, bgr_pool = VideoFramePool(width, height, "yuv420p"), VideoFramePool(width, height, "bgr24")
+    decoded = VideoFrame.from_ndarray(yuv, format="yuv420p")
+    i420, out = np.empty((height * 3 // 2, width), np.uint8), np.empty((height, width, 3), np.uint8)
+    return {
+        ("send yuv420p", "from_ndarray"): lambda: VideoFrame.from_ndarray(yuv, format="yuv420p"),
+        ("send yuv420p", "pool"): lambda: yuv_pool.wrap(yuv),
+        ("send bgr24", "from_ndarray"): lambda: VideoFrame.from_ndarray(bgr, format="bgr24"),
+        ("send bgr24", "pool"): lambda: bgr_pool.wrap(bgr),
+        ("receive bgr", "to_ndarray"): lambda: decoded.to_ndarray(format="bgr24"),
+        ("receive bgr", "buffers"): lambda: bgr_image(decoded, i420, out),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Frame pool benchmark - allocations per frame before and after pooling")
+    parser.add_argument("--frames", type=int, default=200)
+    args = parser.parse_args()
+
+    print("%-6s %-13s %-13s %10s %14s %14s %12s" % ("res", "path", "mode", "fps", "bytes/frame", "peak bytes", "faults/frame"))
+    for name, (height, width) in RESOLUTIONS.items():
+        for (path, mode), step in steps(height, width).items():
+            fps, allocated, peak, faults = measure(step, args.frames)
+            print("%-6s %-13s %-13s %10.0f %14.0f %14d %12.1f" % (name, path, mode, fps, allocated, peak, faults))
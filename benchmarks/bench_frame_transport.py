@@ -0,0 +1,107 @@
+"""
+Compare the two ways FrameReceiever hands frames to the detector processes:
+pickling every frame through a multiprocessing queue, or writing it once into
+the shared memory FrameRing and only passing (slot, seq) over the queue.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_frame_transport --frames 500
+"""
+
+import argparse
+import multiprocessing as mp
+import pickle
+import time
+
+import numpy as np
+
+from docker_client.client import FrameRing
+
+
+def consume(queue, acks, ring):
+    """
+    Detector stand-in: take each frame, touch every pixel and acknowledge it.
+
+    Parameters
+    ----------
+    queue : obj of class 'multiprocessing.queue'
+        frames, or (slot, seq) pairs when a ring is used, tagged with their send time
+    acks : obj of class 'multiprocessing.queue'
+        per-frame latency in seconds, sent back to the producer
+    ring : obj of class 'FrameRing'
+        shared frame slots, None for the plain queue path
+    """
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        sent, payload = item
+        frame = payload if ring is None else ring.read(*payload)
+        frame.sum()
+        acks.put(time.perf_counter() - sent)
+
+
+def run(transport, frames, shape):
+    """
+    Send frames one at a time and collect the latency of each.
+
+    Parameters
+    ----------
+    transport : str
+        'queue' or 'shm'
+    frames : int
+        number of frames to send
+    shape : tuple of ints
+        (height, width, channel) of the frames
+
+    Returns
+    -------
+    dict
+        latency percentiles in ms and bytes copied per frame
+    """
+    ring = FrameRing(shape, slots=4) if transport == "shm" else None
+    queue, acks = mp.Queue(), mp.Queue()
+    consumer = mp.Process(target=consume, args=(queue, acks, ring), daemon=True)
+    consumer.start()
+
+    image = np.random.randint(0, 255, shape, dtype='uint8')
+    latencies = []
+    for _ in range(frames):
+        if ring is None:
+            queue.put((time.perf_counter(), image))
+        else:
+            queue.put((time.perf_counter(), ring.write(image)))
+        latencies.append(acks.get())
+    queue.put(None)
+    consumer.join()
+
+    if ring is None:
+        # pickled on put and unpickled into a new array on get
+        copied = 2 * len(pickle.dumps(image, protocol=pickle.HIGHEST_PROTOCOL))
+    else:
+        # one copy into the slot, the (slot, seq) pair is pickled both ways
+        copied = image.nbytes + 2 * len(pickle.dumps((0, frames), protocol=pickle.HIGHEST_PROTOCOL))
+        ring.close()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "transport": transport,
+        "p50_ms": np.percentile(latencies, 50),
+        "p99_ms": np.percentile(latencies, 99),
+        "mean_ms": latencies.mean(),
+        "bytes_copied": copied,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Frame transport benchmark - mp.Queue versus shared memory ring")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=640)
+    args = parser.parse_args()
+
+    shape = (args.height, args.width, 3)
+    print("%-8s %10s %10s %10s %14s" % ("path", "p50 ms", "p99 ms", "mean ms", "bytes/frame"))
+    for transport in ("queue", "shm"):
+        result = run(transport, args.frames, shape)
+        print("%-8s %10.3f %10.3f %10.3f %14d" % (result["transport"], result["p50_ms"], result["p99_ms"], result["mean_ms"], result["bytes_copied"]))
@@ -0,0 +1,80 @@
+"""
+Highest frame rate a host sustains: for every swept frame rate a FrameGenerator
+renders and a VP8 encoder encodes (on a thread, like aiortc's sender) for a
+number of seconds. The pacing clock skips the slots of frames that overran
+their budget, so the achieved rate, missed deadlines and skipped frames show
+where the host stops keeping up.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pacing --fps 30,60,120,144,240 --resolution 1280x720 --seconds 5
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+from aiortc import RTCRtpCodecParameters
+from aiortc.codecs import get_encoder
+
+from docker_server.server import create_frame_generator, parse_resolution
+
+
+async def run(image_shape, fps, seconds, render):
+    """
+    Render and encode paced frames for a number of seconds.
+
+    Parameters
+    ----------
+    image_shape : tuple of ints
+        (height, width, channel) of the frames
+    fps : float
+        frame rate asked of the pacing clock
+    seconds : float
+        duration of the run
+    render : str
+        'full', 'dirty' or 'yuv' frame rendering
+
+    Returns
+    -------
+    tuple
+        (frames per second sent, deadlines missed, frame slots skipped)
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        generator = create_frame_generator(None, render, image_shape=image_shape, fps=fps)
+    encoder = get_encoder(RTCRtpCodecParameters(mimeType="video/VP8", clockRate=90000, payloadType=96))
+    loop = asyncio.get_running_loop()
+    frames = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        frame = await generator.recv()
+        await loop.run_in_executor(None, encoder.encode, frame)
+        frames += 1
+    elapsed = time.perf_counter() - start
+    generator.stop()
+    return frames / elapsed, generator.clock.missed, generator.clock.skipped
+
+
+def csv(cast):
+    return lambda text: [cast(item) for item in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pacing benchmark - highest sustainable frame rate of render and encode")
+    parser.add_argument("--fps", type=csv(float), default=[30, 60, 120, 144, 240])
+    parser.add_argument("--resolution", type=parse_resolution, default=(480, 640, 3), help="WIDTHxHEIGHT")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--render", choices=["full", "dirty", "yuv"], default="yuv")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Share of skipped frames still counted as sustained.")
+    args = parser.parse_args()
+
+    sustained = None
+    print("%-8s %10s %8s %8s" % ("fps", "achieved", "missed", "skipped"))
+    for fps in args.fps:
+        achieved, missed, skipped = asyncio.run(run(args.resolution, fps, args.seconds, args.render))
+        print("%-8g %10.1f %8d %8d" % (fps, achieved, missed, skipped))
+        if skipped <= args.tolerance * fps * args.seconds:
+            sustained = fps
+    print("highest sustained rate:", "%g fps" % sustained if sustained is not None else "none")
@@ -0,0 +1,174 @@
+"""
+Cost of recording for the live path of the client: a paced synthetic video track
+is shared through a MediaRelay between a live consumer (standing in for
+FrameReceiever) and no recorder, aiortc's MediaRecorder encoding to mp4 or the
+RawFrameRecorder archive. The live consumer measures how late each frame reaches
+it, a ticker how late the event loop wakes up.
+
+Afterwards random frames are read back from both recordings, directly from the
+raw archive and by decoding the mp4 from its start.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_record --height 720 --width 1280 --seconds 10
+"""
+
+import argparse
+import asyncio
+import fractions
+import os
+import tempfile
+import time
+
+import av
+import cv2
+import numpy as np
+from aiortc import MediaStreamTrack
+from av import VideoFrame
+from aiortc.contrib.media import MediaRecorder, MediaRelay
+
+from docker_client.client import RawFrameArchive, RawFrameRecorder
+
+
+class PacedTrack(MediaStreamTrack):
+    """
+    Video track producing yuv420p frames of a moving ball at a fixed rate, each
+    frame remembers when it was due.
+    """
+
+    kind = "video"
+
+    def __init__(self, height, width, fps):
+        super().__init__()
+        self.fps = fps
+        self.images = []
+        for i in range(30):
+            image = np.zeros((height, width, 3), dtype='uint8')
+            cv2.circle(image, (width * (i + 1) // 32, height // 2), 20, (0, 0, 255), -1)
+            self.images.append(cv2.cvtColor(image, cv2.COLOR_BGR2YUV_I420))
+        self.count = 0
+        self.start = None
+        self.due = {}
+
+    async def recv(self):
+        if self.start is None:
+            self.start = time.perf_counter()
+        due = self.start + self.count / self.fps
+        await asyncio.sleep(max(0, due - time.perf_counter()))
+        frame = VideoFrame.from_ndarray(self.images[self.count % len(self.images)], format="yuv420p")
+        frame.pts, frame.time_base = self.count * 90000 // self.fps, fractions.Fraction(1, 90000)
+        self.count += 1
+        self.due[id(frame)] = due   # recorders may rewrite the pts of the shared frame
+        return frame
+
+
+async def live(track, due, lateness, seconds):
+    """
+    Live consumer: how long after its due time every frame arrives.
+    """
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        frame = await track.recv()
+        lateness.append(time.perf_counter() - due.pop(id(frame)))
+
+
+async def ticker(lag, seconds, interval=0.005):
+    """
+    Event loop lag: how late a sleep of a few ms wakes up.
+    """
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag.append(time.perf_counter() - start - interval)
+
+
+async def run(mode, height, width, fps, seconds, path):
+    """
+    Stream for a number of seconds with one recording mode.
+
+    Parameters
+    ----------
+    mode : str
+        'none', 'encode' (MediaRecorder) or 'raw' (RawFrameRecorder)
+    height, width, fps : int
+        frames of the synthetic track
+    seconds : float
+        duration of the stream
+    path : str
+        file recorded to
+
+    Returns
+    -------
+    dict
+        frame lateness and loop lag percentiles in ms, frames recorded and dropped
+    """
+    track = PacedTrack(height, width, fps)
+    relay = MediaRelay()
+    recorder = None
+    if mode == "encode":
+        recorder = MediaRecorder(path)
+    elif mode == "raw":
+        recorder = RawFrameRecorder(path)
+    if recorder is not None:
+        recorder.addTrack(relay.subscribe(track))
+        await recorder.start()
+
+    lateness, lag = [], []
+    await asyncio.gather(live(relay.subscribe(track), track.due, lateness, seconds), ticker(lag, seconds))
+    if recorder is not None:
+        await recorder.stop()
+    track.stop()
+
+    lateness, lag = np.array(lateness) * 1000, np.array(lag) * 1000
+    return {
+        "late_p50": np.percentile(lateness, 50), "late_p99": np.percentile(lateness, 99), "late_max": lateness.max(),
+        "lag_p99": np.percentile(lag, 99), "lag_max": lag.max(),
+        "recorded": recorder.recorded if mode == "raw" else "-", "dropped": recorder.dropped if mode == "raw" else "-",
+    }
+
+
+def random_access(raw, encoded, reads, seed=0):
+    """
+    Mean ms to get a random frame from the raw archive and from the mp4.
+    """
+    archive = RawFrameArchive(raw)
+    indices = np.random.default_rng(seed).integers(0, len(archive), reads)
+    start = time.perf_counter()
+    for i in indices:
+        archive.frame(int(i)).to_ndarray()
+    raw_ms = (time.perf_counter() - start) / reads * 1000
+    archive.close()
+
+    start = time.perf_counter()
+    for i in indices:
+        # No index to jump to, every read decodes from the start of the file
+        with av.open(encoded) as container:
+            for n, frame in enumerate(container.decode(video=0)):
+                if n == i:
+                    frame.to_ndarray()
+                    break
+    return raw_ms, (time.perf_counter() - start) / reads * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recording benchmark - live path cost of MediaRecorder versus the raw frame archive")
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--reads", type=int, default=20, help="Random frames read back from each recording.")
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {"none": None, "encode": os.path.join(directory, "record.mp4"), "raw": os.path.join(directory, "record.raw")}
+        print("%-8s %10s %10s %10s %10s %10s %9s %9s" % ("mode", "late p50", "late p99", "late max", "lag p99", "lag max", "recorded", "dropped"))
+        for mode, path in paths.items():
+            result = asyncio.run(run(mode, args.height, args.width, args.fps, args.seconds, path))
+            print("%-8s %10.2f %10.2f %10.2f %10.2f %10.2f %9s %9s" % (
+                mode, result["late_p50"], result["late_p99"], result["late_max"], result["lag_p99"], result["lag_max"],
+                result["recorded"], result["dropped"]))
+
+        raw_ms, encoded_ms = random_access(paths["raw"], paths["encode"], args.reads)
+        print("random frame read: raw archive %.2f ms, mp4 decoded from the start %.2f ms" % (raw_ms, encoded_ms))
@@ -0,0 +1,79 @@
+"""
+Frames per second and memory allocated per frame by FrameGenerator.generateFrame
+in 'full' mode (new array and cv2.circle every frame), 'dirty' mode
+(preallocated canvas, only the ball's bounding box is redrawn) and 'yuv' mode
+(dirty rectangles drawn straight into the planes of a yuv420p canvas).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_render --frames 300
+"""
+
+import argparse
+import contextlib
+import io
+import time
+import tracemalloc
+
+from aiortc import RTCPeerConnection
+
+from docker_server.server import FrameGenerator
+
+
+RESOLUTIONS = {
+    "480p": (480, 640, 3),
+    "1080p": (1080, 1920, 3),
+    "4K": (2160, 3840, 3),
+}
+
+
+def run(mode, image_shape, frames):
+    """
+    Render frames with one FrameGenerator and measure speed and allocations.
+
+    Parameters
+    ----------
+    mode : str
+        'full', 'dirty' or 'yuv'
+    image_shape : tuple of ints
+        (height, width, channel) of the frames
+    frames : int
+        number of frames to render
+
+    Returns
+    -------
+    tuple
+        (frames per second, bytes allocated per frame, peak bytes allocated by one frame)
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        generator = FrameGenerator(RTCPeerConnection(), image_shape, 'uint8', [2, 2], [100, 100], 20, (0, 0, 255), render=mode)
+    generator.generateFrame()   # canvas and sprite are allocated once, outside the measurement
+
+    start = time.perf_counter()
+    for _ in range(frames):
+        generator.generateFrame()
+    fps = frames / (time.perf_counter() - start)
+
+    tracemalloc.start()
+    allocated = peak = 0
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        generator.generateFrame()
+        _, frame_peak = tracemalloc.get_traced_memory()
+        allocated += frame_peak - before
+        peak = max(peak, frame_peak - before)
+    tracemalloc.stop()
+    return fps, allocated / frames, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Frame rendering benchmark - full, dirty rectangle and yuv")
+    parser.add_argument("--frames", type=int, default=200)
+    args = parser.parse_args()
+
+    print("%-6s %-6s %10s %16s %16s" % ("res", "mode", "fps", "bytes/frame", "peak bytes"))
+    for name, image_shape in RESOLUTIONS.items():
+        for mode in ("full", "dirty", "yuv"):
+            fps, allocated, peak = run(mode, image_shape, args.frames)
+            print("%-6s %-6s %10.0f %16.0f %16d" % (name, mode, fps, allocated, peak))
@@ -0,0 +1,68 @@
+"""
+Replay source cost on the server: frames per second of ReplayTrack.recv over the
+first loop of a clip (every frame decoded) and the following loops (served from
+the decoded frame cache), unthrottled. With a cache smaller than the clip the
+LRU order evicts every frame before its next use, so every loop decodes.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_replay --replay docker_client/video.mp4 --loops 3
+"""
+
+import argparse
+import asyncio
+import time
+
+import av
+
+from docker_server.server import ReplayTrack
+
+
+async def run(path, loops, cache_frames):
+    """
+    Replay a clip a number of times as fast as possible.
+
+    Parameters
+    ----------
+    path : str
+        video file or raw frame archive
+    loops : int
+        times the clip is replayed
+    cache_frames : int
+        most decoded frames kept
+
+    Returns
+    -------
+    list of tuples
+        (frames per second, cache hits, cache misses) of every loop
+    """
+    # Far above any frame rate, so the pacing never waits
+    track = ReplayTrack(None, path, speed=1e6, cache_frames=cache_frames)
+    # A video file's length is only known once the replay wraps, count it up front
+    length = track.length
+    if length is None:
+        with av.open(path) as container:
+            length = sum(1 for _ in container.decode(video=0))
+    results = []
+    for _ in range(loops):
+        hits, misses = track.hits, track.misses
+        start = time.perf_counter()
+        for _ in range(length):
+            await track.recv()
+        results.append((length / (time.perf_counter() - start), track.hits - hits, track.misses - misses))
+    track.stop()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay benchmark - decoding versus the decoded frame cache")
+    parser.add_argument("--replay", default="docker_client/video.mp4", help="Video file or client.py --record-raw archive.")
+    parser.add_argument("--loops", type=int, default=3)
+    parser.add_argument("--cache-frames", type=int, default=450)
+    args = parser.parse_args()
+
+    print("%-6s %10s %8s %8s" % ("loop", "fps", "hits", "misses"))
+    for cache_frames in (0, args.cache_frames):
+        print("cache of %d frames" % cache_frames)
+        for i, (fps, hits, misses) in enumerate(asyncio.run(run(args.replay, args.loops, cache_frames))):
+            print("%-6d %10.0f %8d %8d" % (i + 1, fps, hits, misses))
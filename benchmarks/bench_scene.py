@@ -0,0 +1,86 @@
+"""
+How both ends scale with the number of balls in a server.py --balls scene: the
+vectorized scene step and the yuv420p render on the server, connected components
+on the luma plane and packing on the client, then unpacking and matching the
+detections to the balls back on the server. Touching balls merge into one
+detection, the matched column shows how many balls were still found.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_scene --balls 1,10,100,1000 --frames 100
+"""
+
+import argparse
+import time
+
+import cv2
+
+from docker_client.client import ComponentsDetector, pack_detections
+from docker_server.server import BallScene, SceneRenderer, match_detections, unpack_detections
+
+
+RESOLUTIONS = {
+    "480p": (480, 640, 3),
+    "1080p": (1080, 1920, 3),
+}
+
+
+def run(image_shape, balls, radius, frames):
+    """
+    Time every stage for one scene size.
+
+    Returns
+    -------
+    dict
+        microseconds per frame of each stage, message bytes and the fraction of balls matched
+    """
+    scene = BallScene.random(image_shape, balls, radius, seed=0)
+    renderer = SceneRenderer(image_shape, 'uint8', "yuv420p")
+    detector = ComponentsDetector()
+    height = image_shape[0]
+    timings = {"step": 0.0, "render": 0.0, "detect": 0.0, "pack": 0.0, "match": 0.0}
+    matched = size = 0
+
+    for pts in range(frames):
+        start = time.perf_counter()
+        scene.step()
+        stepped = time.perf_counter()
+        canvas = renderer.render(scene)
+        rendered = time.perf_counter()
+        xs, ys = detector.detect_all(canvas[:height])
+        detected = time.perf_counter()
+        message = pack_detections(pts, xs, ys, time.time())
+        packed = time.perf_counter()
+        _, rec_x, rec_y, _ = unpack_detections(message)
+        _, _, errors = match_detections(scene.positions[:, 0], scene.positions[:, 1], rec_x, rec_y, 2 * radius)
+        done = time.perf_counter()
+
+        for stage, elapsed in zip(timings, (stepped - start, rendered - stepped, detected - rendered, packed - detected, done - packed)):
+            timings[stage] += elapsed
+        matched += len(errors)
+        size += len(message)
+
+    result = {stage: total / frames * 1e6 for stage, total in timings.items()}
+    result["bytes"] = size / frames
+    result["matched"] = matched / (frames * balls)
+    return result
+
+
+def csv(text):
+    return [int(item) for item in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-ball scene cost from 1 to many balls")
+    parser.add_argument("--balls", type=csv, default=[1, 10, 100, 1000])
+    parser.add_argument("--resolution", choices=list(RESOLUTIONS), default="1080p")
+    parser.add_argument("--radius", type=int, default=8, help="Largest ball radius, radii are drawn from radius / 2 up.")
+    parser.add_argument("--frames", type=int, default=100)
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    print("%6s %9s %9s %9s %9s %9s %9s %8s" % ("balls", "step us", "render us", "detect us", "pack us", "match us", "bytes", "matched"))
+    for balls in args.balls:
+        result = run(RESOLUTIONS[args.resolution], balls, args.radius, args.frames)
+        print("%6d %9.0f %9.0f %9.0f %9.0f %9.0f %9.0f %7.1f%%" % (
+            balls, result["step"], result["render"], result["detect"], result["pack"], result["match"], result["bytes"], result["matched"] * 100))
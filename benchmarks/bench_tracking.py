@@ -0,0 +1,72 @@
+"""
+Detection cost per frame of the whole-frame MomentsDetector against the
+TrackingDetector, which only searches a window around the predicted ball
+position, on bouncing ball frames at 480p, 1080p and 4K.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_tracking --frames 300
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from docker_client.client import MomentsDetector, TrackingDetector
+from docker_server.server import BallRenderer, BallTrajectory
+
+
+RESOLUTIONS = {
+    "480p": (480, 640, 3),
+    "1080p": (1080, 1920, 3),
+    "4K": (2160, 3840, 3),
+}
+
+
+def run(detector, image_shape, frames, step):
+    """
+    Detect the ball in a rendered trajectory and measure speed and accuracy.
+
+    Parameters
+    ----------
+    detector : obj of class 'MomentsDetector'
+        detector under test
+    image_shape : tuple of ints
+        (height, width, channel) of the frames
+    frames : int
+        number of frames
+    step : int
+        frames of the trajectory between two analysed frames, as seen by one of
+        several detector workers
+
+    Returns
+    -------
+    tuple
+        (microseconds per frame, largest error in pixels)
+    """
+    trajectory = BallTrajectory(image_shape, [100, 100], [7, 5], 20)
+    renderer = BallRenderer(image_shape, 'uint8', 20, (0, 0, 255))
+    elapsed, error = 0.0, 0.0
+    for i in range(frames):
+        x, y, _, _ = trajectory.state(i * step)
+        frame = renderer.render(x, y)
+        start = time.perf_counter()
+        centre = detector.detect(frame, i * step * 3000)
+        elapsed += time.perf_counter() - start
+        error = max(error, np.hypot(centre[0] - x, centre[1] - y))
+    return elapsed / frames * 1e6, error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detection benchmark - whole frame versus tracked search window")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--step", type=int, default=2, help="Trajectory frames between two analysed frames.")
+    args = parser.parse_args()
+
+    print("%-6s %-10s %10s %10s %14s" % ("res", "detector", "us/frame", "max err", "window hits"))
+    for name, image_shape in RESOLUTIONS.items():
+        for label, detector in (("moments", MomentsDetector()), ("tracking", TrackingDetector())):
+            us, error = run(detector, image_shape, args.frames, args.step)
+            hits = "%d/%d" % (detector.window_searches, args.frames) if label == "tracking" else "-"
+            print("%-6s %-10s %10.1f %10.2f %14s" % (name, label, us, error, hits))
@@ -0,0 +1,115 @@
+"""
+CPU time per frame on both sides of the stream with bgr24 frames (render in BGR,
+the encoder converts to yuv420p; the client converts the decoded frame to bgr24,
+then to gray, and rebuilds a VideoFrame) and with yuv420p frames (render into the
+planes, detect on the luma plane, pass the decoded frame through).
+Encoding and decoding themselves are the same in both paths and left out.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_yuv --frames 300
+"""
+
+import argparse
+import fractions
+import time
+
+import cv2
+import numpy as np
+from av import VideoFrame
+
+from docker_client.client import MomentsDetector, luma_plane
+from docker_server.server import BallRenderer, YuvBallRenderer
+
+
+RESOLUTIONS = {
+    "480p": (480, 640, 3),
+    "1080p": (1080, 1920, 3),
+}
+
+
+def positions(image_shape, frames):
+    """
+    Ball centres bouncing around the frame, one per frame.
+    """
+    height, width = image_shape[:2]
+    t = np.arange(frames)
+    xs = 40 + np.abs((t * 7) % (2 * (width - 80)) - (width - 80))
+    ys = 40 + np.abs((t * 5) % (2 * (height - 80)) - (height - 80))
+    return list(zip(xs.tolist(), ys.tolist()))
+
+
+def server_bgr(renderer, x, y):
+    frame = VideoFrame.from_ndarray(renderer.render(x, y), format="bgr24")
+    # what the VP8 encoder does with every non yuv420p frame
+    return frame.reformat(format="yuv420p")
+
+
+def server_yuv(renderer, x, y):
+    return VideoFrame.from_ndarray(renderer.render(x, y), format="yuv420p")
+
+
+def client_bgr(detector, frame):
+    img = frame.to_ndarray(format="bgr24")
+    centre = detector.detect(img)
+    new_frame = VideoFrame.from_ndarray(img, format="bgr24")
+    new_frame.pts = frame.pts
+    new_frame.time_base = frame.time_base
+    return centre
+
+
+def client_yuv(detector, frame):
+    return detector.detect(luma_plane(frame))
+
+
+def cpu_per_frame(step, items):
+    """
+    Process CPU time of one call of step, in microseconds, averaged over the items.
+    """
+    start = time.process_time()
+    for item in items:
+        step(*item)
+    return (time.process_time() - start) / len(items) * 1e6
+
+
+def run(image_shape, frames):
+    """
+    Measure both paths at one resolution.
+
+    Returns
+    -------
+    dict
+        CPU microseconds per frame of each side and path
+    """
+    centres = positions(image_shape, frames)
+    result = {}
+    for path, renderer_class, step in (("bgr", BallRenderer, server_bgr), ("yuv", YuvBallRenderer, server_yuv)):
+        renderer = renderer_class(image_shape, 'uint8', 20, (0, 0, 255))
+        result["server_" + path] = cpu_per_frame(step, [(renderer, x, y) for x, y in centres])
+
+    # The client gets what the decoder produces, yuv420p frames
+    renderer = YuvBallRenderer(image_shape, 'uint8', 20, (0, 0, 255))
+    decoded = []
+    for i, (x, y) in enumerate(centres):
+        frame = server_yuv(renderer, x, y)
+        frame.pts, frame.time_base = i * 3000, fractions.Fraction(1, 90000)
+        decoded.append(frame)
+    detector = MomentsDetector()
+    for path, step in (("bgr", client_bgr), ("yuv", client_yuv)):
+        assert step(detector, decoded[0]) is not None
+        result["client_" + path] = cpu_per_frame(step, [(detector, frame) for frame in decoded])
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU per frame of the bgr24 and yuv420p frame paths")
+    parser.add_argument("--frames", type=int, default=200)
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)   # CPU time of one core, comparable between runs
+    print("%-6s %-7s %12s %12s %8s" % ("res", "side", "bgr us", "yuv us", "saved"))
+    for name, image_shape in RESOLUTIONS.items():
+        result = run(image_shape, args.frames)
+        for side in ("server", "client"):
+            bgr, yuv = result[side + "_bgr"], result[side + "_yuv"]
+            print("%-6s %-7s %12.0f %12.0f %7.0f%%" % (name, side, bgr, yuv, (1 - yuv / bgr) * 100))
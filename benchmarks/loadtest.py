@@ -0,0 +1,210 @@
+"""
+How many concurrent sessions one server host sustains: a multi-session server
+(serve_peers, as server.py --fanout) runs in its own process and headless
+answer() clients are added step by step, each in its own process with its own
+event loop and detector worker. FrameReceiever keeps its session state at class
+level, so a process hosts exactly one client.
+
+For every step the report holds the delivered FPS of every client, the
+coordinate round trip percentiles measured by the server and the server's CPU
+usage. The ramp stops at the first step violating the service-level targets
+(--min-fps per client, --max-p99-ms round trip).
+
+Run from the repository root:
+
+    python -m benchmarks.loadtest --step 2 --max-clients 16 --min-fps 27 --max-p99-ms 200 --output loadtest.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+from aiortc import RTCPeerConnection
+from aiortc.contrib.media import MediaBlackhole
+from aiortc.contrib.signaling import TcpSocketSignaling
+
+from benchmarks.bench_fanout import process_cpu_seconds, process_rss_mb
+from benchmarks.loopback import RESOLUTIONS, no_nan
+
+
+async def serve_control(control, metrics):
+    """
+    Answer the load test's requests for the metrics of this process until it says 'stop'.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        command = await loop.run_in_executor(None, control.recv)
+        if command == "reset":
+            metrics.reset()
+            control.send(None)
+        elif command == "snapshot":
+            control.send(metrics.snapshot())
+        else:
+            break
+
+
+def run_server(port, image_shape, fps, control):
+    """
+    Server process: one frame source fanned out to every session connecting on the port.
+    """
+    from docker_server import server
+
+    sys.stdout = open(os.devnull, "w")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    framegenerator = server.create_frame_generator(None, image_shape=image_shape, fps=fps)
+    serving = loop.create_task(server.serve_peers(framegenerator, port=port))
+    loop.run_until_complete(serve_control(control, server.METRICS))
+    serving.cancel()
+    framegenerator.stop()
+
+
+def run_client(port, control):
+    """
+    Client process: one headless answer() session with a single detector worker.
+    """
+    from docker_client import client
+
+    sys.stdout = open(os.devnull, "w")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    signaling, pc = TcpSocketSignaling("127.0.0.1", port), RTCPeerConnection()
+    session = loop.create_task(client.answer(pc, signaling, MediaBlackhole(), loop, workers=1, display=False))
+    loop.run_until_complete(serve_control(control, client.METRICS))
+    session.cancel()
+    loop.run_until_complete(asyncio.gather(session, return_exceptions=True))
+    client.FrameReceiever.shutdown()
+    loop.run_until_complete(pc.close())
+
+
+def request(control, command):
+    control.send(command)
+    return control.recv()
+
+
+def start(target, *args):
+    """
+    Start a process serving metrics requests on the returned pipe end.
+    """
+    parent, child = mp.Pipe()
+    process = mp.Process(target=target, args=args + (child,))
+    process.start()
+    return process, parent
+
+
+def stop(process, control):
+    control.send("stop")
+    process.join(10)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+
+
+def measure_step(server, clients, window):
+    """
+    Measure one step with the clients already connected.
+
+    Parameters
+    ----------
+    server : tuple
+        (process, control pipe) of the server
+    clients : list of tuples
+        (process, control pipe) of every client
+    window : float
+        seconds measured
+
+    Returns
+    -------
+    dict
+        per-client delivered fps, round trip percentiles in ms, coordinates per second, server CPU and RSS
+    """
+    process, control = server
+    request(control, "reset")
+    before = [request(pipe, "snapshot")["ball_client_frames_received_total"] for _, pipe in clients]
+    cpu, start = process_cpu_seconds(process.pid), time.perf_counter()
+    time.sleep(window)
+    elapsed = time.perf_counter() - start
+    cpu = process_cpu_seconds(process.pid) - cpu
+    after = [request(pipe, "snapshot")["ball_client_frames_received_total"] for _, pipe in clients]
+    metrics = request(control, "snapshot")
+
+    fps = [(frames - previous) / elapsed for previous, frames in zip(before, after)]
+    round_trip = metrics["ball_server_round_trip_seconds"]
+    return no_nan({
+        "clients": len(clients),
+        "fps": fps,
+        "fps_min": min(fps),
+        "fps_mean": sum(fps) / len(fps),
+        "round_trip_ms": {key: round_trip[key] * 1000 for key in ("p50", "p99")},
+        "coordinates_per_second": metrics["ball_server_coordinates_received_total"] / elapsed,
+        "server_cpu_percent": cpu / elapsed * 100,
+        "server_rss_mb": process_rss_mb(process.pid),
+    })
+
+
+def violations(step, min_fps, max_p99_ms):
+    """
+    Service-level targets a step misses, empty when it meets all of them.
+    """
+    missed = []
+    if step["fps_min"] < min_fps:
+        missed.append("a client got %.2f fps < %g" % (step["fps_min"], min_fps))
+    p99 = step["round_trip_ms"]["p99"]
+    if p99 is None or p99 > max_p99_ms:
+        missed.append("round trip p99 %s ms > %g" % ("-" if p99 is None else "%.0f" % p99, max_p99_ms))
+    return missed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test - concurrent headless sessions against one server until the targets are missed")
+    parser.add_argument("--resolution", choices=list(RESOLUTIONS), default="480p")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--start", type=int, default=1, help="Clients of the first step.")
+    parser.add_argument("--step", type=int, default=1, help="Clients added per step.")
+    parser.add_argument("--max-clients", type=int, default=16)
+    parser.add_argument("--min-fps", type=float, help="Frames per second every client must receive, default 90%% of --fps.")
+    parser.add_argument("--max-p99-ms", type=float, default=200.0, help="Highest coordinate round trip p99 in ms.")
+    parser.add_argument("--settle", type=float, default=3.0, help="Seconds for new sessions to connect before measuring.")
+    parser.add_argument("--window", type=float, default=5.0, help="Seconds measured per step.")
+    parser.add_argument("--port", type=int, default=9880)
+    parser.add_argument("--output", default="loadtest.json", help="JSON report file.")
+    args = parser.parse_args()
+    min_fps = args.min_fps if args.min_fps is not None else 0.9 * args.fps
+
+    server = start(run_server, args.port, RESOLUTIONS[args.resolution], args.fps)
+    time.sleep(1)
+    clients, steps, sustained = [], [], 0
+    print("%8s %9s %9s %10s %10s %10s %9s %9s  %s" % ("clients", "fps min", "fps mean", "rtt p50", "rtt p99", "coords/s", "srv cpu", "srv MB", "targets"))
+    try:
+        count = args.start
+        while count <= args.max_clients:
+            while len(clients) < count:
+                clients.append(start(run_client, args.port))
+            time.sleep(args.settle)
+            step = measure_step(server, clients, args.window)
+            step["violations"] = violations(step, min_fps, args.max_p99_ms)
+            steps.append(step)
+            rtt = step["round_trip_ms"]
+            print("%8d %9.1f %9.1f %10s %10s %10.1f %9.1f %9.1f  %s" % (
+                count, step["fps_min"], step["fps_mean"],
+                "%.1f" % rtt["p50"] if rtt["p50"] is not None else "-", "%.1f" % rtt["p99"] if rtt["p99"] is not None else "-",
+                step["coordinates_per_second"], step["server_cpu_percent"], step["server_rss_mb"],
+                "; ".join(step["violations"]) or "met"))
+            if step["violations"]:
+                break
+            sustained = count
+            count += args.step
+    finally:
+        for process, control in clients:
+            stop(process, control)
+        stop(*server)
+
+    print("Highest sustained load: %d clients" % sustained)
+    with open(args.output, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "resolution": args.resolution, "fps": args.fps,
+                   "min_fps": min_fps, "max_p99_ms": args.max_p99_ms, "sustained_clients": sustained, "steps": steps}, f, indent=2)
+    print("Report written to", args.output)
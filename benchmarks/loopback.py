@@ -0,0 +1,328 @@
+"""
+Headless end-to-end benchmark: server.py's offer() and client.py's answer() run
+against each other in two processes over local TCP or unix socket signaling, for
+every combination of the swept resolutions, frame rates and detector settings.
+Nothing is displayed and no SDP has to be copied by hand.
+
+For every run the report holds the sustained FPS, end-to-end latency percentiles
+(from the metrics of both scripts, recorded after a warm-up), CPU usage and RSS of
+the server and of the client including its detector processes.
+
+The encoder profiles of server.py (--codec, --preset, --bitrate,
+--keyframe-interval) are swept too, with the encode time per frame on the
+server, the decode time per frame on the client and the detection error, to
+find the cheapest profile that keeps the detections accurate.
+
+With --loss a share of the SCTP data chunks sent by the client is dropped, to
+compare the coordinate round trip of the reliable "chat" channel with the
+unordered "coords" channel (--channel unordered) on a lossy link.
+
+Run from the repository root:
+
+    python -m benchmarks.loopback --resolutions 480p,720p --fps 15,30 --workers 1,2 --output loopback.json
+    python -m benchmarks.loopback --channel reliable,unordered --loss 0,0.05,0.2
+    python -m benchmarks.loopback --codec vp8,h264 --preset default,low-latency --bitrate 0,300000
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import random
+import sys
+import tempfile
+import time
+
+from aiortc import RTCPeerConnection
+from aiortc.contrib.media import MediaBlackhole
+from aiortc.contrib.signaling import TcpSocketSignaling, UnixSocketSignaling
+
+from benchmarks.bench_fanout import process_cpu_seconds, process_rss_mb
+
+
+RESOLUTIONS = {
+    "240p": (240, 320, 3),
+    "480p": (480, 640, 3),
+    "720p": (720, 1280, 3),
+    "1080p": (1080, 1920, 3),
+}
+
+
+def create_signaling(config):
+    """
+    Local signaling of one run, the server side listens and the client connects.
+    """
+    if config["signaling"] == "unix-socket":
+        return UnixSocketSignaling(config["path"])
+    return TcpSocketSignaling("127.0.0.1", config["port"])
+
+
+def simulate_loss(loss, seed=0):
+    """
+    Drop a share of the SCTP data chunks this process sends, retransmissions
+    included, like a lossy uplink. Media packets are left alone.
+    """
+    from aiortc import rtcsctptransport
+
+    rng = random.Random(seed)
+    send_chunk = rtcsctptransport.RTCSctpTransport._send_chunk
+
+    async def lossy_send_chunk(self, chunk):
+        if isinstance(chunk, rtcsctptransport.DataChunk) and rng.random() < loss:
+            return
+        await send_chunk(self, chunk)
+
+    rtcsctptransport.RTCSctpTransport._send_chunk = lossy_send_chunk
+
+
+def time_decoders(metrics):
+    """
+    Observe the time aiortc's decoders of this process take per frame, they run on
+    the receiver's decoder thread.
+    """
+    from aiortc import rtcrtpreceiver
+
+    histogram = metrics.histogram("loopback_decode_seconds", "Time to decode one video frame")
+    get_decoder = rtcrtpreceiver.get_decoder
+
+    def timed_get_decoder(codec):
+        decoder = get_decoder(codec)
+        decode = decoder.decode
+
+        def timed_decode(frame):
+            start = time.perf_counter()
+            frames = decode(frame)
+            histogram.observe(time.perf_counter() - start)
+            return frames
+
+        decoder.decode = timed_decode
+        return decoder
+
+    rtcrtpreceiver.get_decoder = timed_get_decoder
+
+
+# Seconds between the server and the client process starts, the client connects
+# to the server's signaling socket
+CLIENT_DELAY = 1.0
+
+
+async def measure(metrics, pids, warmup, duration):
+    """
+    Reset the metrics after the warm-up and record CPU, RSS and metrics over the window.
+
+    Parameters
+    ----------
+    metrics : obj of class 'Metrics'
+        registry of the script running in this process
+    pids : callable
+        returns the pids whose CPU and memory are counted, read after the warm-up
+    warmup, duration : float
+        seconds before and of the measurement
+
+    Returns
+    -------
+    dict
+        cpu percent of one core, rss in MB, counters per second and latencies in ms
+    """
+    await asyncio.sleep(warmup)
+    metrics.reset()
+    pids = pids()
+    before = metrics.snapshot()
+    cpu, start = sum(process_cpu_seconds(pid) for pid in pids), time.perf_counter()
+    await asyncio.sleep(duration)
+    elapsed = time.perf_counter() - start
+    cpu = sum(process_cpu_seconds(pid) for pid in pids) - cpu
+
+    result = {"cpu_percent": cpu / elapsed * 100, "rss_mb": sum(process_rss_mb(pid) for pid in pids)}
+    for name, value in metrics.snapshot().items():
+        kind = metrics.metrics[name].kind
+        if kind == "counter":
+            result[name.replace("_total", "_per_second")] = (value - before[name]) / elapsed
+        elif kind == "histogram" and name.endswith("_seconds"):
+            result[name.replace("_seconds", "_ms")] = {key: value[key] * 1000 for key in ("mean", "p50", "p99")}
+            result[name.replace("_seconds", "_ms")]["count"] = value["count"]
+        elif kind == "histogram":
+            result[name] = value
+    return result
+
+
+def run_server(config, warmup, duration, report, done):
+    """
+    Server process: offer() with the run's scene, report its measurements and keep
+    streaming until the client has reported too.
+    """
+    from docker_server import server
+
+    sys.stdout = open(os.devnull, "w")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    signaling, pc = create_signaling(config), RTCPeerConnection()
+    profile = server.EncoderProfile(config["codec"], config["bitrate"] or None, config["keyframe_interval"] or None, config["preset"])
+    loop.create_task(server.offer(pc, signaling, loop, image_shape=RESOLUTIONS[config["resolution"]], fps=config["fps"],
+                                  unordered=config["channel"] == "unordered", profile=profile))
+    # Started earlier, so the measurement windows of both sides line up
+    result = loop.run_until_complete(measure(server.METRICS, lambda: [os.getpid()], warmup + CLIENT_DELAY, duration))
+    report.put(("server", result))
+    loop.run_until_complete(loop.run_in_executor(None, done.wait, 30))
+    loop.run_until_complete(pc.close())
+
+
+def run_client(config, warmup, duration, report, done):
+    """
+    Client process: answer() without display, then report its measurements and
+    those of its detector processes.
+    """
+    from docker_client import client
+
+    sys.stdout = open(os.devnull, "w")
+    if config["loss"]:
+        simulate_loss(config["loss"])
+    time_decoders(client.METRICS)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    signaling, pc = create_signaling(config), RTCPeerConnection()
+    loop.create_task(client.answer(
+        pc, signaling, MediaBlackhole(), loop, workers=config["workers"], transport=config["transport"],
+        queue_size=config["queue_size"], overflow=config["overflow"], display=False))
+
+    def pids():
+        workers = client.FrameReceiever.pool.workers if client.FrameReceiever.pool is not None else []
+        return [os.getpid()] + [worker.pid for worker in workers]
+
+    result = loop.run_until_complete(measure(client.METRICS, pids, warmup, duration))
+    report.put(("client", result))
+    loop.run_until_complete(loop.run_in_executor(None, done.wait, 30))
+    client.FrameReceiever.shutdown()
+    loop.run_until_complete(pc.close())
+
+
+def no_nan(value):
+    """
+    Replace NaN, e.g. percentiles of an empty histogram, by None so the report is strict JSON.
+    """
+    if isinstance(value, dict):
+        return {key: no_nan(item) for key, item in value.items()}
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def run(config, warmup, duration):
+    """
+    Run one configuration and collect the reports of both processes.
+
+    Returns
+    -------
+    dict
+        'config', 'server' and 'client' measurements, an 'error' if a side did not report
+    """
+    report, done = mp.Queue(), mp.Event()
+    server = mp.Process(target=run_server, args=(config, warmup, duration, report, done))
+    client = mp.Process(target=run_client, args=(config, warmup, duration, report, done))
+    server.start()
+    time.sleep(CLIENT_DELAY)
+    client.start()
+
+    result = {"config": config}
+    try:
+        for _ in range(2):
+            side, measurements = report.get(timeout=warmup + duration + 30)
+            result[side] = measurements
+    except Exception:
+        result["error"] = "no report from " + " and ".join(side for side in ("server", "client") if side not in result)
+    done.set()
+    for process in (client, server):
+        process.join(10)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    return no_nan(result)
+
+
+def summary(result):
+    """
+    One line of the printed table.
+    """
+    config = result["config"]
+    name = "%s@%d w%d %s q%d %s %s" % (config["resolution"], config["fps"], config["workers"], config["transport"], config["queue_size"],
+                                       config["overflow"], config["channel"])
+    name += " %s %s" % (config["codec"], config["preset"])
+    if config["bitrate"]:
+        name += " %dk" % (config["bitrate"] // 1000)
+    if config["keyframe_interval"]:
+        name += " kf%d" % config["keyframe_interval"]
+    if config["loss"]:
+        name += " loss %g%%" % (config["loss"] * 100)
+    if "error" in result:
+        return "%-72s %s" % (name, result["error"])
+    server, client = result["server"], result["client"]
+
+    def value(stats, key):
+        return "%.1f" % stats[key] if stats[key] is not None else "-"
+
+    round_trip, errors = server["ball_server_round_trip_ms"], server["ball_server_error_pixels"]
+    return "%-72s %8.1f %8.1f %10s %10s %8s %8s %8s %8s %9.1f %9.1f %9.1f %9.1f" % (
+        name, server["ball_server_frames_sent_per_second"], client["ball_client_coordinate_send_ms"]["count"] / result["duration"],
+        value(round_trip, "p50"), value(round_trip, "p99"),
+        value(server["ball_server_encode_ms"], "mean"), value(client["loopback_decode_ms"], "mean"),
+        value(errors, "mean"), value(errors, "p99"),
+        server["cpu_percent"], client["cpu_percent"], server["rss_mb"], client["rss_mb"])
+
+
+def csv(cast):
+    return lambda text: [cast(item) for item in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless server/client loopback benchmark")
+    parser.add_argument("--resolutions", type=csv(str), default=["480p"], help="Comma separated, from %s." % ", ".join(RESOLUTIONS))
+    parser.add_argument("--fps", type=csv(int), default=[30])
+    parser.add_argument("--workers", type=csv(int), default=[2])
+    parser.add_argument("--transport", type=csv(str), default=["shm"])
+    parser.add_argument("--queue-size", type=csv(int), default=[4])
+    parser.add_argument("--overflow", type=csv(str), default=["latest"])
+    parser.add_argument("--codec", type=csv(str), default=["vp8"], help="Video codec, 'vp8' or 'h264'.")
+    parser.add_argument("--preset", type=csv(str), default=["default"], help="Encoder preset, 'default' or 'low-latency'.")
+    parser.add_argument("--bitrate", type=csv(int), default=[0], help="Target video bitrates in bit/s, 0 for the codec's default.")
+    parser.add_argument("--keyframe-interval", type=csv(int), default=[0], help="Most frames between two keyframes, 0 for the codec's default.")
+    parser.add_argument("--channel", type=csv(str), default=["reliable"], help="Coordinate channel, 'reliable' or 'unordered'.")
+    parser.add_argument("--loss", type=csv(float), default=[0.0], help="Share of the client's SCTP data chunks dropped, e.g. 0.05.")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds before the measurement starts.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds measured per run.")
+    parser.add_argument("--signaling", choices=["tcp-socket", "unix-socket"], default="tcp-socket")
+    parser.add_argument("--port", type=int, default=9870, help="First signaling port, every run uses the next one.")
+    parser.add_argument("--output", default="loopback.json", help="JSON report file.")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.resolutions if name not in RESOLUTIONS]
+    if unknown:
+        parser.error("unknown resolution %s" % ", ".join(unknown))
+    if set(args.codec) - {"vp8", "h264"} or set(args.preset) - {"default", "low-latency"}:
+        parser.error("--codec should be 'vp8' or 'h264' and --preset 'default' or 'low-latency'")
+    if set(args.channel) - {"reliable", "unordered"}:
+        parser.error("--channel should be 'reliable' or 'unordered'")
+
+    results = []
+    print("%-72s %8s %8s %10s %10s %8s %8s %8s %8s %9s %9s %9s %9s" % (
+        "run", "sent/s", "det/s", "rtt p50", "rtt p99", "enc ms", "dec ms", "err px", "err p99", "srv cpu", "cli cpu", "srv MB", "cli MB"))
+    with tempfile.TemporaryDirectory() as directory:
+        sweep = itertools.product(args.resolutions, args.fps, args.workers, args.transport, args.queue_size, args.overflow,
+                                  args.codec, args.preset, args.bitrate, args.keyframe_interval, args.channel, args.loss)
+        for i, (resolution, fps, workers, transport, queue_size, overflow, codec, preset, bitrate, keyframe_interval, channel, loss) in enumerate(sweep):
+            config = {
+                "resolution": resolution, "fps": fps, "workers": workers, "transport": transport,
+                "queue_size": queue_size, "overflow": overflow, "codec": codec, "preset": preset, "bitrate": bitrate,
+                "keyframe_interval": keyframe_interval, "channel": channel, "loss": loss, "signaling": args.signaling,
+                "port": args.port + i, "path": os.path.join(directory, "signaling-%d.sock" % i),
+            }
+            result = run(config, args.warmup, args.duration)
+            result["duration"] = args.duration
+            results.append(result)
+            print(summary(result))
+
+    with open(args.output, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "warmup": args.warmup, "duration": args.duration, "runs": results}, f, indent=2)
+    print("Report written to", args.output)
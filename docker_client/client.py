@@ -1,49 +1,1883 @@
 # Paras Savnani
 
+import abc
 import argparse
 import asyncio
+import bisect
+import cProfile
+import copy
+import fractions
+import functools
 import logging
 import math
+import mmap
+import os
+import signal
+import struct
+import threading
 import time
 import cv2
 import multiprocessing as mp
 import numpy as np
+from multiprocessing import shared_memory
+from queue import Empty, Full, Queue
+import av
 from av import VideoFrame
+from collections import OrderedDict, deque
 
 from aiortc import (
     RTCIceCandidate,
     RTCPeerConnection,
+    RTCRtpSender,
     RTCSessionDescription,
     MediaStreamTrack,
 )
+from aiortc.mediastreams import MediaStreamError
 from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder, MediaRelay
 from aiortc.contrib.signaling import BYE, add_signaling_arguments, create_signaling
+
+# Signaling retries are logged here, the session output is printed
+logger = logging.getLogger("ball_client")
+        
+
+# Coordinate message sent over the data channel: message type, frame pts,
+# ball x, ball y and detection wall-clock time - must match server.py
+COORDINATE_MESSAGE = 1
+COORDINATE_FORMAT = "!Bqiid"
+
+
+def pack_coordinates(pts, x, y, timestamp):
+    """
+    Pack a frame-tagged ball coordinate into the binary data channel message.
+
+    Parameters
+    ----------
+    pts : int
+        presentation timestamp of the analysed frame
+    x, y : int
+        centre coordinate of the ball
+    timestamp : float
+        wall-clock time at which the detection finished
+
+    Returns
+    -------
+    bytes
+        message of struct.calcsize(COORDINATE_FORMAT) bytes
+    """
+    return struct.pack(COORDINATE_FORMAT, COORDINATE_MESSAGE, pts, x, y, timestamp)
+
+
+# Multi-ball detection message: message type, frame pts, detection wall-clock time
+# and number of balls, followed by that many big-endian int32 (x, y) pairs - must match server.py
+DETECTIONS_MESSAGE = 2
+DETECTIONS_HEADER = "!BqdI"
+
+
+def pack_detections(pts, xs, ys, timestamp):
+    """
+    Pack the frame-tagged centres of every ball found in a frame into one binary message.
+
+    Parameters
+    ----------
+    pts : int
+        presentation timestamp of the analysed frame
+    xs, ys : numpy ndarray
+        centre coordinates of the balls
+    timestamp : float
+        wall-clock time at which the detection finished
+
+    Returns
+    -------
+    bytes
+        header of struct.calcsize(DETECTIONS_HEADER) bytes followed by 8 bytes per ball
+    """
+    centres = np.stack([xs, ys], axis=1).astype('>i4')
+    return struct.pack(DETECTIONS_HEADER, DETECTIONS_MESSAGE, pts, timestamp, len(centres)) + centres.tobytes()
+
+
+# Batch of single-ball coordinates: message type, detection wall-clock time and
+# number of frames, followed by that many big-endian (int64 pts, int32 x, int32 y) records - must match server.py
+BATCH_MESSAGE = 3
+BATCH_HEADER = "!BdI"
+BATCH_RECORD = np.dtype([("pts", ">i8"), ("x", ">i4"), ("y", ">i4")])
+
+
+def pack_batch(pts, xs, ys, timestamp):
+    """
+    Pack the coordinates found in a batch of frames into one binary message.
+
+    Parameters
+    ----------
+    pts : numpy ndarray
+        presentation timestamps of the analysed frames
+    xs, ys : numpy ndarray
+        centre coordinate of the ball in each frame
+    timestamp : float
+        wall-clock time at which the batch detection finished
+
+    Returns
+    -------
+    bytes
+        header of struct.calcsize(BATCH_HEADER) bytes followed by 16 bytes per frame
+    """
+    records = np.empty(len(pts), dtype=BATCH_RECORD)
+    records["pts"], records["x"], records["y"] = pts, xs, ys
+    return struct.pack(BATCH_HEADER, BATCH_MESSAGE, timestamp, len(records)) + records.tobytes()
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, rendered in the Prometheus text format.
+    ...
+
+    Attributes
+    ----------
+    name : str
+        metric name
+    help : str
+        metric description
+    buckets : tuple of floats
+        upper bounds of the buckets, +Inf is implied
+    counts : list of ints
+        observations per bucket, the last one is +Inf
+    sum : float
+        sum of the observations
+    count : int
+        number of observations
+
+    Methods
+    -------
+    observe : Add one observation.
+    reset : Forget every observation.
+    quantile : Estimate a quantile by interpolating inside its bucket.
+    render : Prometheus text lines of the histogram.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        """
+        Constructs all the necessary attributes for the Histogram object.
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # observe is called from the event loop and from helper threads
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Method responsible to add one observation.
+        """
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def reset(self):
+        """
+        Method responsible to forget every observation.
+        """
+        with self.lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.sum = 0.0
+            self.count = 0
+
+    def quantile(self, q):
+        """
+        Method responsible to estimate a quantile, NaN when there is no observation.
+
+        Parameters
+        ----------
+        q : float
+            quantile between 0 and 1
+
+        Returns
+        -------
+        float
+            estimate, linearly interpolated inside the bucket holding the quantile
+        """
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        cumulative, lower = 0, 0.0
+        for bound, n in zip(self.buckets, self.counts):
+            if n and cumulative + n >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / n
+            cumulative += n
+            lower = bound
+        # Quantile is in the +Inf bucket, the largest finite bound is the best estimate
+        return lower
+
+    def render(self):
+        """
+        Method responsible to return the Prometheus text lines of the histogram.
+        """
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, bound, cumulative))
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, self.count))
+        lines.append("%s_sum %s" % (self.name, self.sum))
+        lines.append("%s_count %d" % (self.name, self.count))
+        return lines
+
+
+class Counter:
+    """
+    Monotonic counter, rendered in the Prometheus text format.
+    ...
+
+    Attributes
+    ----------
+    name : str
+        metric name
+    help : str
+        metric description
+    value : float
+        current value
+    function : callable
+        if set, called at scrape time to read the value instead
+
+    Methods
+    -------
+    inc : Increase the counter.
+    reset : Set the counter back to zero.
+    render : Prometheus text lines of the counter.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, function=None):
+        """
+        Constructs all the necessary attributes for the Counter object.
+        """
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        """
+        Method responsible to increase the counter.
+        """
+        self.value += amount
+
+    def reset(self):
+        """
+        Method responsible to set the counter back to zero, counters read through
+        a function are left alone.
+        """
+        self.value = 0
+
+    def get(self):
+        """
+        Method responsible to return the current value.
+        """
+        return self.function() if self.function is not None else self.value
+
+    def render(self):
+        """
+        Method responsible to return the Prometheus text lines of the metric.
+        """
+        return ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind), "%s %s" % (self.name, self.get())]
+
+
+class Gauge(Counter):
+    """
+    Value which can go up and down, rendered in the Prometheus text format.
+
+    Methods
+    -------
+    set : Set the value.
+    tick : Count one event and update the value to the event rate per second.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, function=None):
+        """
+        Constructs all the necessary attributes for the Gauge object.
+        """
+        super().__init__(name, help, function)
+        self.window_start = None
+        self.window_count = 0
+
+    def set(self, value):
+        """
+        Method responsible to set the value.
+        """
+        self.value = value
+
+    def tick(self, interval=1.0):
+        """
+        Method responsible to count one event and refresh the rate (events per second)
+        once every interval seconds.
+        """
+        now = time.perf_counter()
+        if self.window_start is None:
+            self.window_start = now
+            return
+        self.window_count += 1
+        elapsed = now - self.window_start
+        if elapsed >= interval:
+            self.value = self.window_count / elapsed
+            self.window_start, self.window_count = now, 0
+
+
+class Metrics:
+    """
+    Registry of the process metrics with an optional local HTTP endpoint which
+    serves them in the Prometheus text format.
+    ...
+
+    Attributes
+    ----------
+    metrics : OrderedDict
+        name -> Histogram, Counter or Gauge
+
+    Methods
+    -------
+    histogram, counter, gauge : Register a metric, or return the one with that name.
+    stage : Register the wall-clock and CPU time histograms of a stage, as a StageTimer.
+    render : Prometheus text exposition of every metric.
+    snapshot : Plain dict of every metric, with p50/p99 for histograms.
+    reset : Reset every metric, e.g. at the end of a warm-up.
+    serve : Start the HTTP endpoint.
+    """
+
+    def __init__(self):
+        """
+        Constructs all the necessary attributes for the Metrics object.
+        """
+        self.metrics = OrderedDict()
+
+    def _register(self, cls, name, *args):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, *args)
+        return self.metrics[name]
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, buckets)
+
+    def counter(self, name, help, function=None):
+        return self._register(Counter, name, help, function)
+
+    def gauge(self, name, help, function=None):
+        return self._register(Gauge, name, help, function)
+
+    def stage(self, name, help):
+        return StageTimer(self.histogram(name + "_wall_seconds", "Wall-clock time of " + help),
+                          self.histogram(name + "_cpu_seconds", "CPU time of the calling thread in " + help))
+
+    def render(self):
+        """
+        Method responsible to return the Prometheus text exposition of every metric.
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """
+        Method responsible to reset every metric.
+        """
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def snapshot(self):
+        """
+        Method responsible to return every metric as plain values, histograms as
+        count, mean, p50 and p99.
+        """
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            if metric.kind == "histogram":
+                snapshot[name] = {
+                    "count": metric.count,
+                    "mean": metric.sum / metric.count if metric.count else math.nan,
+                    "p50": metric.quantile(0.5),
+                    "p99": metric.quantile(0.99),
+                }
+            else:
+                snapshot[name] = metric.get()
+        return snapshot
+
+    async def serve(self, port, host="127.0.0.1", profiler=None):
+        """
+        Method responsible to serve the metrics over HTTP on a local port.
+
+        Parameters
+        ----------
+        port : int
+            port of the endpoint, any path returns the metrics except /profile
+        host : str
+            address to bind, local only by default
+        profiler : obj of class 'ProfileCapture'
+            if set, /profile?seconds=N profiles the event loop for N seconds and
+            returns the path of the pstats file once it is written
+
+        Returns
+        -------
+        obj of class 'asyncio.Server'
+        """
+        async def handle(reader, writer):
+            try:
+                target = (await reader.readline()).split()[1:2]
+                # Headers are not needed
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                status, content_type = b"200 OK", b"text/plain; version=0.0.4"
+                path, _, query = (target[0].decode("latin-1") if target else "/").partition("?")
+                if path == "/profile" and profiler is not None:
+                    options = dict(option.partition("=")[::2] for option in query.split("&") if option)
+                    try:
+                        seconds = float(options.get("seconds", profiler.seconds))
+                    except ValueError:
+                        seconds = math.nan
+                    if not 0 < seconds < math.inf:
+                        status, written = b"400 Bad Request", "seconds should be a positive finite number"
+                    else:
+                        written = await profiler.capture(seconds)
+                        if written is None:
+                            status, written = b"409 Conflict", "a capture is already running"
+                    body, content_type = (written + "\n").encode("utf8"), b"text/plain"
+                else:
+                    body = self.render().encode("utf8")
+                writer.write(b"HTTP/1.1 %s\r\n"
+                             b"Content-Type: %s\r\n"
+                             b"Content-Length: %d\r\n"
+                             b"Connection: close\r\n\r\n" % (status, content_type, len(body)) + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host=host, port=port)
+
+
+class StageTimer:
+    """
+    Wall-clock and CPU time of one stage, cheap enough to leave on in every hot
+    path: two clock reads at each end and two histogram observations.
+    ...
+
+    Attributes
+    ----------
+    wall : obj of class 'Histogram'
+        time.perf_counter() duration of the stage
+    cpu : obj of class 'Histogram'
+        time.thread_time() duration, the CPU the calling thread spent in the stage
+
+    Methods
+    -------
+    start : Both clocks, handed back to stop.
+    stop : Observe the time since start.
+    __call__ : Decorate a function so every call is timed.
+    """
+
+    def __init__(self, wall, cpu):
+        """
+        Constructs all the necessary attributes for the StageTimer object.
+
+        Parameters
+        ----------
+        wall, cpu : obj of class 'Histogram'
+            wall-clock and CPU time histograms
+        """
+        self.wall = wall
+        self.cpu = cpu
+
+    def start(self):
+        return time.perf_counter(), time.thread_time()
+
+    def stop(self, started):
+        self.wall.observe(time.perf_counter() - started[0])
+        self.cpu.observe(time.thread_time() - started[1])
+
+    def __call__(self, function):
+        # The start is kept on the stack, so render threads can share one timer
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter(), time.thread_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stop(started)
+        return timed
+
+
+class ProfileCapture:
+    """
+    Time-boxed cProfile capture of a running process, written as a pstats file
+    (python -m pstats FILE, or any pstats viewer). cProfile only follows the
+    thread which starts it: the event loop, or a detector worker's main thread.
+    ...
+
+    Attributes
+    ----------
+    name : str
+        prefix of the file names
+    directory : str
+        where the captures are written
+    seconds : float
+        duration of a capture started by the signal
+    profiler : obj of class 'cProfile.Profile'
+        the running capture, None between captures
+    path : str
+        file the running capture is written to
+    deadline : float
+        time.monotonic() at which the running capture ends
+    report : callable
+        receives the message naming each file written, print or a logger method
+
+    Methods
+    -------
+    install : Start a capture on SIGUSR1.
+    start : Start profiling the calling thread.
+    stop : Stop the capture and write it.
+    poll : Stop the capture once its time is up, for threads without an event loop.
+    capture : Profile the event loop for a number of seconds.
+    """
+
+    def __init__(self, name, directory=".", seconds=10.0, report=print):
+        """
+        Constructs all the necessary attributes for the ProfileCapture object.
+
+        Parameters
+        ----------
+        name : str
+            prefix of the file names
+        directory : str
+            where the captures are written
+        seconds : float
+            duration of a capture started by the signal
+        report : callable
+            receives the message naming each file written
+        """
+        self.name = name
+        self.directory = directory
+        self.seconds = seconds
+        self.report = report
+        self.profiler = None
+        self.path = None
+        self.deadline = math.inf
+
+    def install(self, loop=None, name=None):
+        """
+        Method responsible to start a capture whenever the process gets SIGUSR1.
+
+        Parameters
+        ----------
+        loop : obj of class 'asyncio.get_event_loop'
+            event loop which stops the capture on time, None for a process which calls poll
+        name : str
+            new prefix of the file names, e.g. in a forked worker
+        """
+        if name is not None:
+            self.name = name
+        if loop is not None:
+            loop.add_signal_handler(signal.SIGUSR1, self._on_signal, loop)
+            return
+        if self.profiler is not None:
+            # Forked while the parent was profiling, that capture is not ours
+            self.profiler.disable()
+            self.profiler = None
+        # A forked child shares the parent loop's wakeup fd, which would start a capture there too
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.start())
+
+    def _on_signal(self, loop):
+        if self.start() is not None:
+            loop.call_later(self.seconds, self.stop)
+
+    def start(self, seconds=None):
+        """
+        Method responsible to start profiling the calling thread.
+
+        Parameters
+        ----------
+        seconds : float
+            duration of the capture, self.seconds if None
+
+        Returns
+        -------
+        str
+            file the capture will be written to, None if one is already running
+        """
+        if self.profiler is not None:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, "%s-%d-%s.pstats" % (self.name, os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        self.deadline = time.monotonic() + (self.seconds if seconds is None else seconds)
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return self.path
+
+    def stop(self):
+        """
+        Method responsible to stop the running capture and write its pstats file.
+
+        Returns
+        -------
+        str
+            the file written, None if no capture was running
+        """
+        if self.profiler is None:
+            return None
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path)
+        self.profiler = None
+        self.report("Profile written to %s" % self.path)
+        return self.path
+
+    def poll(self):
+        if time.monotonic() >= self.deadline and self.profiler is not None:
+            self.stop()
+
+    async def capture(self, seconds):
+        """
+        Method responsible to profile the event loop for a number of seconds.
+
+        Returns
+        -------
+        str
+            the file written, None if a capture was already running
+        """
+        path = self.start(seconds)
+        if path is None:
+            return None
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.stop()
+        return path
+
+METRICS = Metrics()
+# Started with SIGUSR1 or the metrics endpoint's /profile, configured by --profile-dir
+PROFILER = ProfileCapture("client")
+
+
+# Client side stages, scraped with --metrics-port
+FRAMES_RECEIVED = METRICS.counter("ball_client_frames_received_total", "Frames received from the video track")
+FRAMES_DROPPED = METRICS.counter("ball_client_frames_dropped_total", "Frames dropped by the detector queue overflow policy",
+                                 function=lambda: FrameReceiever.stats()["dropped"])
+FRAMES_PROCESSED = METRICS.counter("ball_client_frames_processed_total", "Frames parsed by the detector pool",
+                                   function=lambda: FrameReceiever.stats()["processed"])
+RECEIVE_FPS = METRICS.gauge("ball_client_receive_fps", "Frames received per second")
+DETECT_FPS = METRICS.gauge("ball_client_detect_fps", "Detections sent per second")
+TO_NDARRAY_SECONDS = METRICS.histogram("ball_client_to_ndarray_seconds", "Time to convert a decoded frame to a bgr24 array")
+QUEUE_WAIT_SECONDS = METRICS.histogram("ball_client_queue_wait_seconds", "Time a frame waits in the queue for a detector")
+DETECT_SECONDS = METRICS.histogram("ball_client_detect_seconds", "Time to find the ball in one frame")
+SEND_SECONDS = METRICS.histogram("ball_client_coordinate_send_seconds", "Time from the end of a detection to the coordinate send")
+TIME_TO_FIRST_FRAME = METRICS.histogram("ball_client_time_to_first_frame_seconds", "Time from an offer arriving to the first frame of its session")
+TIME_TO_FIRST_COORDINATE = METRICS.histogram("ball_client_time_to_first_coordinate_seconds", "Time from an offer arriving to the first coordinates sent in its session")
+SESSIONS = METRICS.counter("ball_client_sessions_total", "Offers answered, each with a new peer connection after the first")
+FRAMES_RECORDED = METRICS.counter("ball_client_frames_recorded_total", "Frames written to the --record-raw archive")
+COORDINATES_COALESCED = METRICS.counter("ball_client_coordinates_coalesced_total", "Coordinate messages replaced by newer ones before they were sent")
+FRAMES_NOT_RECORDED = METRICS.counter("ball_client_frames_not_recorded_total", "Frames the --record-raw writer fell too far behind to store")
+STAGE_RECV = METRICS.stage("ball_client_stage_recv", "FrameReceiever.recv after the frame arrived")
+# The detectors run in their own processes, which add their stage time to shared totals
+STAGE_FIND_WALL = METRICS.counter("ball_client_stage_find_coordinates_wall_seconds_total", "Wall-clock time of the detector workers finding the ball, queue wait excluded",
+                                  function=lambda: FrameReceiever.pool.stage_seconds()[0] if FrameReceiever.pool is not None else 0.0)
+STAGE_FIND_CPU = METRICS.counter("ball_client_stage_find_coordinates_cpu_seconds_total", "CPU time of the detector workers finding the ball",
+                                 function=lambda: FrameReceiever.pool.stage_seconds()[1] if FrameReceiever.pool is not None else 0.0)
+
+
+class FrameRing:
+    """
+    Fixed-size ring of frame slots in shared memory, so frames are handed to the
+    detector processes as (slot, seq) pairs instead of pickled arrays.
+    ...
+
+    Attributes
+    ----------
+    shape : tuple of ints
+        (height, width, channel) of the frames stored in the ring, or (height, width) for luma planes
+    slots : int
+        number of frame slots
+    shm : obj of class 'multiprocessing.shared_memory.SharedMemory'
+        shared block holding the sequence header followed by the frame slots
+    seqs : numpy ndarray
+        sequence number of the frame currently stored in each slot (-1 while writing)
+    pts : numpy ndarray
+        presentation timestamp of the frame stored in each slot
+    frames : numpy ndarray
+        (slots,) + shape view of the frame slots
+
+    Methods
+    -------
+    write : Copy a frame into the next slot.
+    read : View of the frame stored in a slot, without copying.
+    valid : Check that a slot still holds the given frame.
+    close : Release the shared block, unlinking it if this ring created it.
+    """
+
+    def __init__(self, shape, slots=8, dtype='uint8', name=None):
+        """
+        Constructs all the necessary attributes for the FrameRing object.
+
+        Parameters
+        ----------
+        shape : tuple of ints
+            (height, width, channel) of the frames stored in the ring, or (height, width) for luma planes
+        slots : int
+            number of frame slots
+        dtype : str
+            dtype of the frames
+        name : str
+            name of an existing shared block to attach to, a new one is created if None
+        """
+        if slots < 1:
+            raise ValueError("FrameRing needs at least one slot")
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+
+        header = 2 * slots * np.dtype(np.int64).itemsize
+        size = header + slots * int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.seqs = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf)
+        self.pts = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf, offset=header // 2)
+        self.frames = np.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf, offset=header)
+        if self.owner:
+            self.seqs[:] = -1
+        self.next_seq = 0
+
+    def write(self, frame, pts=-1):
+        """
+        Method responsible to copy a frame into the next slot, overwriting the oldest one.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            frame of the ring's shape
+        pts : int
+            presentation timestamp of the frame
+
+        Returns
+        -------
+        tuple of ints
+            (slot, seq) identifying the frame in the ring
+        """
+        seq = self.next_seq
+        slot = seq % self.slots
+        # Mark the slot as being written so readers holding an older seq back off
+        self.seqs[slot] = -1
+        self.frames[slot] = frame
+        self.pts[slot] = pts
+        self.seqs[slot] = seq
+        self.next_seq += 1
+        return slot, seq
+
+    def read(self, slot, seq):
+        """
+        Method responsible to return the frame stored in a slot without copying it.
+
+        Parameters
+        ----------
+        slot : int
+            slot index returned by write
+        seq : int
+            sequence number returned by write
+
+        Returns
+        -------
+        numpy ndarray or None
+            view of the frame, None if the slot was already overwritten
+        """
+        if self.seqs[slot] != seq:
+            return None
+        return self.frames[slot]
+
+    def valid(self, slot, seq):
+        """
+        Method responsible to check that a frame read earlier was not overwritten meanwhile.
+        """
+        return self.seqs[slot] == seq
+
+    def close(self):
+        """
+        Method responsible to release the shared block, unlinking it if this ring created it.
+        """
+        del self.seqs, self.pts, self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+
+class FrameQueue:
+    """
+    Multiprocessing queue which applies an overflow policy instead of growing
+    without limit when the detectors fall behind the stream. Every frame is
+    tagged with a sequence number, so the policy never takes anything off the
+    queue in the putting process: the event loop neither waits nor unpickles
+    frames, the workers skip the frames the policy dropped as they take them.
+    ...
+
+    Attributes
+    ----------
+    maxsize : int
+        maximum number of queued frames
+    policy : str
+        'drop-oldest' drops the oldest queued frame, 'drop-newest' discards the
+        incoming frame and 'latest' keeps only the incoming frame
+    keep : int
+        number of newest frames which are handed to the workers, older ones are dropped
+    limit : int
+        most frames on the queue not taken yet, the incoming frame is dropped past it,
+        for the other policies this only bounds the memory of a stalled pool
+    queue : obj of class 'multiprocessing.queue'
+        underlying queue of (sequence number, item) pairs
+    latest : obj of class 'multiprocessing.value'
+        sequence number of the newest queued frame
+    taken : obj of class 'multiprocessing.value'
+        sequence number of the newest frame taken off the queue
+    dropped : obj of class 'multiprocessing.value'
+        number of frames discarded by the policy
+
+    Methods
+    -------
+    put : Queue a frame, applying the overflow policy, never blocks.
+    get : Take the next frame the policy kept, blocking until one is available.
+    """
+
+    policies = ("drop-oldest", "drop-newest", "latest")
+
+    def __init__(self, maxsize=4, policy="latest"):
+        """
+        Constructs all the necessary attributes for the FrameQueue object.
+
+        Parameters
+        ----------
+        maxsize : int
+            maximum number of queued frames
+        policy : str
+            one of 'drop-oldest', 'drop-newest' or 'latest'
+        """
+        if maxsize < 1:
+            raise ValueError("FrameQueue size should be at least 1")
+        if policy not in FrameQueue.policies:
+            raise ValueError("FrameQueue policy should be one of %s" % ", ".join(FrameQueue.policies))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.keep = 1 if policy == "latest" else maxsize
+        self.limit = maxsize if policy == "drop-newest" else 4 * maxsize
+        # Bounded by the sequence numbers, so a put never waits for the workers
+        self.queue = mp.Queue()
+        self.latest = mp.Value('q', 0)
+        self.taken = mp.Value('q', 0)
+        self.dropped = mp.Value('i', 0)
+
+    def _drop(self):
+        with self.dropped.get_lock():
+            self.dropped.value += 1
+
+    def put(self, item):
+        """
+        Method responsible to queue a frame, applying the overflow policy.
+
+        Parameters
+        ----------
+        item : numpy ndarray or tuple or None
+            frame, (pts, frame) or (slot, seq) pair, optionally followed by the
+            time.perf_counter() at which it was queued, or the stop sentinel which is never dropped
+
+        Returns
+        -------
+        bool
+            True if the item was queued
+        """
+        if item is None:
+            # One per worker, taken after every frame queued before it
+            self.queue.put(None)
+            return True
+
+        seq = self.latest.value + 1
+        if seq - self.taken.value > self.limit:
+            self._drop()
+            return False
+        self.queue.put((seq, item))
+        self.latest.value = seq
+        return True
+
+    def get(self, block=True, timeout=None):
+        """
+        Method responsible to take the next frame, same arguments as 'multiprocessing.queue.get'.
+        """
+        while True:
+            item = self.queue.get(block, timeout)
+            if item is None:
+                return None
+            seq, item = item
+            with self.taken.get_lock():
+                self.taken.value = max(self.taken.value, seq)
+            if seq > self.latest.value - self.keep:
+                return item
+            # Newer frames were queued since, the policy drops this one
+            self._drop()
+
+
+
+class Detector(abc.ABC):
+    """
+    Interface of the detector backends: a detector thresholds a bgr frame or its
+    luma plane and returns the ball centre. Backends are registered in DETECTORS
+    under the name used on the command line.
+    ...
+
+    Attributes
+    ----------
+    threshold : int
+        gray level above which a pixel belongs to the ball
+    multiple : bool
+        True for backends finding every ball of a frame with detect_all
+
+    Methods
+    -------
+    detect : Centre of the ball in a frame.
+    detect_all : Centres of every ball in a frame.
+    """
+
+    multiple = False
+
+    def __init__(self, threshold=50):
+        """
+        Constructs all the necessary attributes for the Detector object.
+
+        Parameters
+        ----------
+        threshold : int
+            gray level above which a pixel belongs to the ball
+        """
+        self.threshold = threshold
+
+    def _mask(self, frame):
+        # Threshold the image to get the mask for the ball - in realistic scenarios hsv range masking is used to detect a particular colour due to intensity variations.
+        # 2-D frames are already the luma plane
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        _,thresh = cv2.threshold(gray,self.threshold,255,cv2.THRESH_BINARY)
+        return thresh
+
+    @abc.abstractmethod
+    def detect(self, frame, pts=-1):
+        """
+        Method responsible to find the centre of the ball.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            bgr frame, or its luma plane
+        pts : int
+            presentation timestamp of the frame, -1 if unknown
+
+        Returns
+        -------
+        tuple of ints or None
+            (x, y) centre of the ball, None if there is no ball in the frame
+        """
+
+    def detect_all(self, frame, pts=-1):
+        """
+        Method responsible to find the centres of every ball, the one ball of detect for single-ball backends.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            bgr frame, or its luma plane
+        pts : int
+            presentation timestamp of the frame, -1 if unknown
+
+        Returns
+        -------
+        tuple of numpy ndarrays or None
+            (xs, ys) int centres of the balls, None if there is no ball in the frame
+        """
+        centre = self.detect(frame, pts)
+        if centre is None:
+            return None
+        return np.array([centre[0]], np.int32), np.array([centre[1]], np.int32)
+
+    def detect_batch(self, frames, pts):
+        """
+        Method responsible to find the ball in every frame of a batch, one detect call per frame.
+
+        Parameters
+        ----------
+        frames : numpy ndarray
+            (N, height, width) luma planes or (N, height, width, channel) bgr frames
+        pts : numpy ndarray
+            presentation timestamp of each frame
+
+        Returns
+        -------
+        tuple of numpy ndarrays
+            (xs, ys, found) centres and a mask of the frames with a ball
+        """
+        xs, ys, found = np.zeros(len(frames), np.int64), np.zeros(len(frames), np.int64), np.zeros(len(frames), bool)
+        for i, frame in enumerate(frames):
+            centre = self.detect(frame, int(pts[i]))
+            if centre is not None:
+                xs[i], ys[i] = centre
+                found[i] = True
+        return xs, ys, found
+
+
+class MomentsDetector(Detector):
+    """
+    Finds the ball centre from the moments of the whole thresholded frame.
+    ...
+
+    Attributes
+    ----------
+    threshold : int
+        gray level above which a pixel belongs to the ball
+
+    Methods
+    -------
+    detect : Centre of the ball in a frame.
+    """
+
+    def _moments(self, frame):
+        thresh = self._mask(frame)
+
+        # calculate moments of binary image
+        return cv2.moments(thresh, True), thresh
+
+    def detect_batch(self, frames, pts):
+        """
+        Method responsible to find the ball in every frame of a batch with a few
+        NumPy reductions over the whole (N, height, width) batch, same centroids
+        as detect.
+
+        Parameters
+        ----------
+        frames : numpy ndarray
+            (N, height, width) luma planes or (N, height, width, channel) bgr frames
+        pts : numpy ndarray
+            presentation timestamp of each frame
+
+        Returns
+        -------
+        tuple of numpy ndarrays
+            (xs, ys, found) centres and a mask of the frames with a ball
+        """
+        if frames.ndim == 4:
+            frames = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames])
+        count, height, width = frames.shape
+        # The batch is thresholded and its rows summed as one (N * height, width) image
+        _, mask = cv2.threshold(np.ascontiguousarray(frames).reshape(-1, width), self.threshold, 1, cv2.THRESH_BINARY)
+        rows = cv2.reduce(mask, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+        # Only rows crossing the ball contribute to the moments
+        lit = np.flatnonzero(rows)
+        frame = lit // height
+        m00 = np.bincount(frame, weights=rows[lit], minlength=count)
+        m10 = np.bincount(frame, weights=mask[lit] @ np.arange(width), minlength=count)
+        m01 = np.bincount(frame, weights=rows[lit] * (lit % height), minlength=count)
+        found = m00 > 0
+        m00[~found] = 1
+        # Floor division truncates like int() in detect, the centroids are never negative
+        return (m10 // m00).astype(np.int64), (m01 // m00).astype(np.int64), found
+
+    def detect(self, frame, pts=-1):
+        """
+        Method responsible to find the centre of the ball.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            bgr frame, or its luma plane
+        pts : int
+            presentation timestamp of the frame, -1 if unknown
+
+        Returns
+        -------
+        tuple of ints or None
+            (x, y) centre of the ball, None if there is no ball in the frame
+        """
+        M, _ = self._moments(frame)
+        if M["m00"] == 0:
+            return None
+
+        # calculate x,y coordinate of center
+        return int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"])
+
+
+class TrackingDetector(MomentsDetector):
+    """
+    Finds the ball centre inside a small window around the position predicted from
+    the last two detections (constant velocity over pts), so the cost per frame
+    hardly depends on the resolution. The whole frame is searched when there is
+    no prediction yet, the window is empty or the ball touches its border.
+    ...
+
+    Attributes
+    ----------
+    window : int
+        smallest half size of the search window in pixels
+    half : int
+        current half size, grown to fit the ball found by a full-frame search
+    history : obj of class 'collections.deque'
+        (pts, x, y) of the last two detections
+    full_searches : int
+        number of frames searched whole
+    window_searches : int
+        number of frames found inside the search window
+
+    Methods
+    -------
+    predict : Expected ball centre in a frame.
+    detect : Centre of the ball in a frame.
+    """
+
+    def __init__(self, threshold=50, window=48):
+        """
+        Constructs all the necessary attributes for the TrackingDetector object.
+
+        Parameters
+        ----------
+        threshold : int
+            gray level above which a pixel belongs to the ball
+        window : int
+            smallest half size of the search window in pixels
+        """
+        super().__init__(threshold)
+        self.window = window
+        self.half = window
+        self.history = deque(maxlen=2)
+        self.full_searches = self.window_searches = 0
+
+    def predict(self, pts):
+        """
+        Method responsible to predict the ball centre in the frame with the given pts.
+
+        Returns
+        -------
+        tuple of floats or None
+            (x, y) predicted centre, None before the first detection
+        """
+        if not self.history:
+            return None
+        p1, x1, y1 = self.history[-1]
+        if len(self.history) < 2 or pts < 0:
+            return x1, y1
+        p0, x0, y0 = self.history[0]
+        if p0 < 0 or p1 == p0:
+            return x1, y1
+        # Frames may arrive out of order or skipped, so extrapolate over pts
+        t = (pts - p1) / (p1 - p0)
+        return x1 + (x1 - x0) * t, y1 + (y1 - y0) * t
+
+    def _track(self, frame, prediction):
+        """
+        Method responsible to find the ball inside the window around the prediction.
+
+        Returns
+        -------
+        tuple of ints or None
+            (x, y) centre, None if the ball is not wholly inside the window
+        """
+        height, width = frame.shape[:2]
+        x0, y0 = max(int(prediction[0]) - self.half, 0), max(int(prediction[1]) - self.half, 0)
+        x1, y1 = min(int(prediction[0]) + self.half + 1, width), min(int(prediction[1]) + self.half + 1, height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        M, thresh = self._moments(frame[y0:y1, x0:x1])
+        if M["m00"] == 0:
+            return None
+        # Part of the ball outside the window would bias the centroid, window edges
+        # on the frame border are fine
+        if ((x0 > 0 and thresh[:, 0].any()) or (x1 < width and thresh[:, -1].any()) or
+                (y0 > 0 and thresh[0].any()) or (y1 < height and thresh[-1].any())):
+            return None
+        return int(M["m10"] / M["m00"]) + x0, int(M["m01"] / M["m00"]) + y0
+
+    def detect(self, frame, pts=-1):
+        """
+        Method responsible to find the centre of the ball, in the search window when possible.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            bgr frame, or its luma plane
+        pts : int
+            presentation timestamp of the frame, -1 if unknown
+
+        Returns
+        -------
+        tuple of ints or None
+            (x, y) centre of the ball, None if there is no ball in the frame
+        """
+        prediction = self.predict(pts)
+        centre = self._track(frame, prediction) if prediction is not None else None
+        if centre is not None:
+            self.window_searches += 1
+        else:
+            self.full_searches += 1
+            M, _ = self._moments(frame)
+            if M["m00"] == 0:
+                self.history.clear()
+                return None
+            centre = int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"])
+            # Fit the window to the ball, m00 is its area in pixels
+            self.half = max(self.window, int(math.sqrt(M["m00"] / math.pi) * 1.5) + 8)
+        self.history.append((pts, centre[0], centre[1]))
+        return centre
+
+    # Each prediction needs the previous detection, so batches go frame by frame
+    detect_batch = Detector.detect_batch
+
+
+class NumpyMomentsDetector(Detector):
+    """
+    Finds the ball centre from the moments of the thresholded frame without OpenCV:
+    the bgr frame is converted to gray with OpenCV's fixed-point luma weights, and
+    the moments are counts of the lit pixels' rows and columns with np.bincount.
+    ...
+
+    Attributes
+    ----------
+    threshold : int
+        gray level above which a pixel belongs to the ball
+
+    Methods
+    -------
+    detect : Centre of the ball in a frame.
+    detect_batch : Centres of the ball in a batch of frames.
+    """
+
+    # B, G and R weights of cv2.COLOR_BGR2GRAY in 14-bit fixed point
+    weights = np.array([1868, 9617, 4899], np.int32)
+
+    def _lit(self, frames, ndim):
+        """
+        Method responsible to return the flat indices of the pixels above the threshold,
+        frames with more than ndim dimensions are bgr.
+        """
+        if frames.ndim > ndim:
+            # Within a gray level of cv2.cvtColor, the ball is far from the threshold anyway
+            gray = (frames @ self.weights + (1 << 13)) >> 14
+        else:
+            gray = frames
+        return np.flatnonzero(gray > self.threshold)
+
+    def detect(self, frame, pts=-1):
+        """
+        Method responsible to find the centre of the ball.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            bgr frame, or its luma plane
+        pts : int
+            presentation timestamp of the frame, -1 if unknown
+
+        Returns
+        -------
+        tuple of ints or None
+            (x, y) centre of the ball, None if there is no ball in the frame
+        """
+        lit = self._lit(frame, 2)
+        if len(lit) == 0:
+            return None
+        height, width = frame.shape[:2]
+        rows, cols = np.bincount(lit // width, minlength=height), np.bincount(lit % width, minlength=width)
+        return int(cols @ np.arange(width) / len(lit)), int(rows @ np.arange(height) / len(lit))
+
+    def detect_batch(self, frames, pts):
+        """
+        Method responsible to find the ball in every frame of a batch, the lit pixels
+        of the whole (N, height, width) batch binned by frame.
+
+        Parameters
+        ----------
+        frames : numpy ndarray
+            (N, height, width) luma planes or (N, height, width, channel) bgr frames
+        pts : numpy ndarray
+            presentation timestamp of each frame
+
+        Returns
+        -------
+        tuple of numpy ndarrays
+            (xs, ys, found) centres and a mask of the frames with a ball
+        """
+        count, height, width = frames.shape[:3]
+        lit = self._lit(frames, 3)
+        frame = lit // (height * width)
+        m00 = np.bincount(frame, minlength=count)
+        m10 = np.bincount(frame, weights=lit % width, minlength=count)
+        m01 = np.bincount(frame, weights=lit // width % height, minlength=count)
+        found = m00 > 0
+        m00[~found] = 1
+        # Floor division truncates like int() in detect, the centroids are never negative
+        return (m10 // m00).astype(np.int64), (m01 // m00).astype(np.int64), found
+
+
+class HoughDetector(Detector):
+    """
+    Finds the ball as the strongest circle of the Hough transform of the
+    thresholded frame.
+    ...
+
+    Attributes
+    ----------
+    threshold : int
+        gray level above which a pixel belongs to the ball
+    radius : int
+        expected ball radius, circles from half to twice this radius are searched
+
+    Methods
+    -------
+    detect : Centre of the ball in a frame.
+    """
+
+    def __init__(self, threshold=50, radius=20):
+        """
+        Constructs all the necessary attributes for the HoughDetector object.
+
+        Parameters
+        ----------
+        threshold : int
+            gray level above which a pixel belongs to the ball
+        radius : int
+            expected ball radius
+        """
+        super().__init__(threshold)
+        self.radius = radius
+
+    def detect(self, frame, pts=-1):
+        """
+        Method responsible to find the centre of the ball.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            bgr frame, or its luma plane
+        pts : int
+            presentation timestamp of the frame, -1 if unknown
+
+        Returns
+        -------
+        tuple of ints or None
+            (x, y) centre of the ball, None if no circle was found
+        """
+        # Smooth the mask so isolated noise pixels do not vote for circles
+        mask = cv2.medianBlur(self._mask(frame), 5)
+        circles = cv2.HoughCircles(mask, cv2.HOUGH_GRADIENT, 1, self.radius * 2, param1=100, param2=15,
+                                   minRadius=max(self.radius // 2, 1), maxRadius=self.radius * 2)
+        if circles is None:
+            return None
+        x, y, r = circles[0, 0]
+        # The gradient votes are off by a pixel or two, refine with the moments around the circle
+        r = int(r) + 2
+        x0, y0 = max(int(x) - r, 0), max(int(y) - r, 0)
+        M = cv2.moments(mask[y0:int(y) + r + 1, x0:int(x) + r + 1], True)
+        if M["m00"] == 0:
+            return int(x), int(y)
+        return int(M["m10"] / M["m00"]) + x0, int(M["m01"] / M["m00"]) + y0
+
+
+class TemplateDetector(Detector):
+    """
+    Finds the ball where a filled disk template matches the thresholded frame best.
+    ...
+
+    Attributes
+    ----------
+    threshold : int
+        gray level above which a pixel belongs to the ball
+    radius : int
+        ball radius of the template
+    template : numpy ndarray
+        (2*radius+1, 2*radius+1) filled disk
+    min_score : float
+        normalized correlation below which no ball is reported
+
+    Methods
+    -------
+    detect : Centre of the ball in a frame.
+    """
+
+    def __init__(self, threshold=50, radius=20, min_score=0.5):
+        """
+        Constructs all the necessary attributes for the TemplateDetector object.
+
+        Parameters
+        ----------
+        threshold : int
+            gray level above which a pixel belongs to the ball
+        radius : int
+            ball radius of the template
+        min_score : float
+            normalized correlation below which no ball is reported
+        """
+        super().__init__(threshold)
+        self.radius = radius
+        self.min_score = min_score
+        self.template = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+        cv2.circle(self.template, (radius, radius), radius, 255, -1)
+
+    def detect(self, frame, pts=-1):
+        """
+        Method responsible to find the centre of the ball.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            bgr frame, or its luma plane
+        pts : int
+            presentation timestamp of the frame, -1 if unknown
+
+        Returns
+        -------
+        tuple of ints or None
+            (x, y) centre of the ball, None if nothing matches the template well enough
+        """
+        scores = cv2.matchTemplate(self._mask(frame), self.template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (x, y) = cv2.minMaxLoc(scores)
+        if score < self.min_score:
+            return None
+        # Scores are indexed by the top-left corner of the template
+        return x + self.radius, y + self.radius
+
+
+class ComponentsDetector(Detector):
+    """
+    Finds every ball in a frame, one connected component of the thresholded frame
+    per ball. Touching balls merge into one component.
+    ...
+
+    Attributes
+    ----------
+    threshold : int
+        gray level above which a pixel belongs to a ball
+    min_area : int
+        components smaller than this many pixels are treated as noise
+
+    Methods
+    -------
+    detect : Centre of the largest ball in a frame.
+    detect_all : Centres of all the balls in a frame.
+    """
+
+    multiple = True
+
+    def __init__(self, threshold=50, min_area=4):
+        """
+        Constructs all the necessary attributes for the ComponentsDetector object.
+
+        Parameters
+        ----------
+        threshold : int
+            gray level above which a pixel belongs to a ball
+        min_area : int
+            smallest component in pixels reported as a ball
+        """
+        super().__init__(threshold)
+        self.min_area = min_area
+
+    def detect_all(self, frame, pts=-1):
+        """
+        Method responsible to find the centres of all the balls, largest first.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            bgr frame, or its luma plane
+        pts : int
+            presentation timestamp of the frame, -1 if unknown
+
+        Returns
+        -------
+        tuple of numpy ndarrays or None
+            (xs, ys) int centres of the balls, None if there is no ball in the frame
+        """
+        _, _, stats, centroids = cv2.connectedComponentsWithStats(self._mask(frame), connectivity=8)
+        # Label 0 is the background
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        order = np.argsort(-areas, kind="stable")
+        centres = centroids[1:][order][areas[order] >= self.min_area].astype(np.int32)
+        if len(centres) == 0:
+            return None
+        return centres[:, 0], centres[:, 1]
+
+    def detect(self, frame, pts=-1):
+        """
+        Method responsible to find the centre of the largest ball.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            bgr frame, or its luma plane
+        pts : int
+            presentation timestamp of the frame, -1 if unknown
+
+        Returns
+        -------
+        tuple of ints or None
+            (x, y) centre of the largest ball, None if there is no ball in the frame
+        """
+        centres = self.detect_all(frame, pts)
+        if centres is None:
+            return None
+        return int(centres[0][0]), int(centres[1][0])
+
+
+# Detector backends selectable on the command line, every one takes the threshold as first argument
+DETECTORS = {
+    "moments": MomentsDetector,
+    "numpy": NumpyMomentsDetector,
+    "components": ComponentsDetector,
+    "hough": HoughDetector,
+    "template": TemplateDetector,
+}
+
+
+class ImageProcess(mp.Process):
+    """
+    Class to process the image frame to find ball centre coordinates
+    ...
+
+    Attributes
+    ----------
+    queue : obj of class 'multiprocessing.queue'
+        multiprocessing queue to store frames
+    centre_coordinate : tuple of objs of class 'multiprocessing.value'
+        centre coordinate of the ball
+    target : obj of class 'ImageProcess'
+        input target function for multiprocessing queue to find coordinates
+    ring : obj of class 'FrameRing'
+        shared frame slots, if set the queue carries (slot, seq) pairs instead of frames
+    results : obj of class 'multiprocessing.queue'
+        receives a (pts, x, y, timestamp, queue_wait, detect_seconds) tuple for every detection, if set,
+        x and y are arrays for detectors finding several balls
+    display : obj of class 'DisplayProcess'
+        preview window offered the annotated frames, None to skip display
+    detector : obj of class 'Detector'
+        finds the ball in a frame, each process works on its own copy
+    batch : int
+        most queued frames taken and detected at once
+    stopping : bool
+        set once the stop sentinel was taken while collecting a batch
+    parent : int
+        pid of the client process, the worker stops once it is gone
+    taken : tuple of floats
+        time.perf_counter() and time.thread_time() at which the last item was taken, None once accounted
+
+    Methods
+    -------
+    info : Method responsible for Parsing the incoming frame, finding and storing the 
+        centre coordinate of the ball and offering the frame to the preview.
+    """
+
+    def __init__(self, queue, centre_coordinate, target=None, ring=None, results=None, display=None, detector=None, batch=1):    
+        """
+        Constructs all the necessary attributes for the ImageProcess object.
+
+        Parameters
+        ----------
+        queue : obj of class 'multiprocessing.queue'
+            multiprocessing queue to store frames, or (pts, frame) pairs
+        centre_coordinate : tuple of objs of class 'multiprocessing.value'
+            centre coordinate of the ball
+        target : obj of class 'ImageProcess'
+            input target function for multiprocessing queue to find coordinates
+        ring : obj of class 'FrameRing'
+            shared frame slots, if set the queue carries (slot, seq) pairs instead of frames
+        results : obj of class 'multiprocessing.queue'
+            receives a (pts, x, y, timestamp, queue_wait, detect_seconds) tuple for every detection, if set,
+            x and y are arrays for detectors finding several balls
+        display : obj of class 'DisplayProcess'
+            preview window offered the annotated frames, None to skip display
+        detector : obj of class 'Detector'
+            finds the ball in a frame, whole-frame moments if None
+        batch : int
+            most queued frames taken and detected at once, 1 handles the frames one by one
+        """
+        if batch < 1:
+            raise ValueError("batch should be at least 1")
+        self.queue = queue
+        self.centre_coordinate = centre_coordinate
+        self.ring = ring
+        self.results = results
+        self.display = display
+        self.detector = detector if detector is not None else MomentsDetector()
+        self.batch = batch
+        self.stopping = False
+        self.parent = os.getpid()
+        self.taken = None
+        self.target = self._findCoordinates
+        mp.Process.__init__(self, target=self.target)
+
+    def _next(self):
+        """
+        Method responsible to wait for the next queued item, or return the stop sentinel
+        once the client process died without stopping the pool: a forked worker holds
+        copies of its sockets, and the server would never see the signaling close.
+        """
+        while True:
+            try:
+                item = self.queue.get(timeout=1.0)
+            except Empty:
+                PROFILER.poll()
+                if os.getppid() != self.parent:
+                    return None
+                continue
+            if item is not None:
+                self.taken = time.perf_counter(), time.thread_time()
+            return item
+
+    def _findCoordinates(self):
+        """
+        Method responsible for Parsing the incoming frame, finding and storing the 
+        centre coordinate of the ball and offering the frame to the preview.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        bool
+            False if the stop sentinel was received, True otherwise
+        """
+        item = self._next()
+        if item is None:
+            # Stop sentinel pushed by DetectorPool.stop
+            return False
+
+        start = time.perf_counter()
+        # Tuples may end with the time they were queued at, for the queue wait metric
+        queued = item[2] if isinstance(item, tuple) and len(item) > 2 else start
+        frame, pts = self._read(item)
+        if frame is None:
+            # Slot was overwritten before this worker got to it
+            return True
+
+        if self.detector.multiple:
+            centre = self.detector.detect_all(frame, pts)
+        else:
+            centre = self.detector.detect(frame, pts)
+        if centre is None:
+            # No ball in this frame, nothing to report
+            return True
+        cX, cY = centre
+        detected = time.perf_counter()
+
+        # print(cX, cY, "\n")
+        if self.ring is not None and not self.ring.valid(*item[:2]):
+            return True
+        if self.display is not None:
+            # Rate limited and never blocks, the display process draws and shows it. The
+            # slot is checked again after offer copied it, the writer may have come back
+            self.display.offer(frame, cX, cY, functools.partial(self.ring.valid, *item[:2]) if self.ring is not None else None)
+
+        # Store Coordinates as multiprocessing Values, the largest ball when there are several
+        if self.detector.multiple:
+            self.centre_coordinate[0].value, self.centre_coordinate[1].value = int(cX[0]), int(cY[0])
+        else:
+            self.centre_coordinate[0].value, self.centre_coordinate[1].value = cX, cY
+        if self.results is not None:
+            self.results.put((pts, cX, cY, time.time(), start - queued, detected - start))
+        return True
+
+    def _read(self, item):
+        """
+        Method responsible to unwrap a queued item into its frame and pts.
+
+        Returns
+        -------
+        tuple
+            (frame, pts), frame is None if its ring slot was overwritten
+        """
+        if self.ring is not None:
+            # Read the frame in place from shared memory
+            slot, seq = item[:2]
+            frame = self.ring.read(slot, seq)
+            return frame, int(self.ring.pts[slot]) if frame is not None else -1
+        if isinstance(item, tuple):
+            return item[1], item[0]
+        # Untagged frame
+        return item, -1
+
+    def _findBatch(self):
+        """
+        Method responsible for taking every queued frame up to the batch size, finding
+        the ball in all of them at once and reporting their coordinates together.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        int
+            number of frames taken from the queue, the stopping flag is set when the
+            stop sentinel was among them
+        """
+        items = [self._next()]
+        # Never take a second sentinel, it belongs to another worker
+        while items[-1] is not None and len(items) < self.batch:
+            try:
+                items.append(self.queue.get(block=False))
+            except Empty:
+                break
+        if items[-1] is None:
+            self.stopping = True
+            items.pop()
+        if not items:
+            return 0
+
+        start = time.perf_counter()
+        frames, pts, waits, kept = [], [], [], []
+        for item in items:
+            frame, frame_pts = self._read(item)
+            if frame is not None:
+                frames.append(frame)
+                pts.append(frame_pts)
+                waits.append(start - (item[2] if isinstance(item, tuple) and len(item) > 2 else start))
+                kept.append(item)
+        if not frames:
+            return len(items)
+        # One contiguous (N, height, width) copy, so ring slots are free as soon as it is made
+        batch, pts, waits = np.stack(frames), np.array(pts, dtype=np.int64), np.array(waits)
+        # Checked after the copy, a slot overwritten while np.stack read it is torn. The preview gets the copy
+        valid = np.array([self.ring.valid(*item[:2]) for item in kept]) if self.ring is not None else np.ones(len(kept), bool)
+
+        xs, ys, found = self.detector.detect_batch(batch, pts)
+        detected = time.perf_counter()
+        found &= valid
+        if not found.any():
+            return len(items)
+
+        last = np.flatnonzero(found)[-1]
+        if self.display is not None:
+            self.display.offer(batch[last], int(xs[last]), int(ys[last]))
+        self.centre_coordinate[0].value = int(xs[last])
+        self.centre_coordinate[1].value = int(ys[last])
+        if self.results is not None:
+            # Queue wait and detection time per frame, averaged over the batch
+            self.results.put((pts[found], xs[found], ys[found], time.time(), float(waits.mean()), (detected - start) / len(batch)))
+        return len(items)
+
         
 
+class DetectorWorker(ImageProcess):
+    """
+    Long-lived detector process which keeps parsing frames from the queue
+    until it receives the stop sentinel (None).
+    ...
+
+    Attributes
+    ----------
+    frames_processed : obj of class 'multiprocessing.value'
+        number of frames handled by this worker
+    stage_seconds : obj of class 'multiprocessing.Array'
+        wall-clock and CPU seconds spent on the frames, from taking them off the queue
+
+    Methods
+    -------
+    run : Parse frames from the queue until the stop sentinel is received, SIGUSR1 profiles it.
+    """
+
+    def __init__(self, queue, centre_coordinate, frames_processed, ring=None, results=None, display=None, detector=None, batch=1):
+        """
+        Constructs all the necessary attributes for the DetectorWorker object.
+
+        Parameters
+        ----------
+        queue : obj of class 'multiprocessing.queue'
+            multiprocessing queue to store frames
+        centre_coordinate : tuple of objs of class 'multiprocessing.value'
+            centre coordinate of the ball
+        frames_processed : obj of class 'multiprocessing.value'
+            number of frames handled by this worker
+        ring : obj of class 'FrameRing'
+            shared frame slots, if set the queue carries (slot, seq) pairs instead of frames
+        results : obj of class 'multiprocessing.queue'
+            receives a (pts, x, y, timestamp, queue_wait, detect_seconds) tuple for every detection, if set,
+            x and y are arrays for detectors finding several balls
+        display : obj of class 'DisplayProcess'
+            preview window offered the annotated frames, None to skip display
+        detector : obj of class 'Detector'
+            finds the ball in a frame, whole-frame moments if None
+        batch : int
+            most queued frames taken and detected at once
+        """
+        ImageProcess.__init__(self, queue, centre_coordinate, ring=ring, results=results, display=display, detector=detector, batch=batch)
+        self.frames_processed = frames_processed
+        self.stage_seconds = mp.Array('d', 2)
+
+    def run(self):
+        """
+        Method responsible to parse frames until the stop sentinel is received.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        """
+        PROFILER.install(name="worker")
+        if self.batch > 1:
+            while not self.stopping:
+                self.frames_processed.value += self._findBatch()
+                self._account()
+            return
+        while self._findCoordinates():
+            self.frames_processed.value += 1
+            self._account()
+
+    def _account(self):
+        # Time from taking the item off the queue, the wait for it is excluded
+        if self.taken is not None:
+            self.stage_seconds[0] += time.perf_counter() - self.taken[0]
+            self.stage_seconds[1] += time.thread_time() - self.taken[1]
+            self.taken = None
+        PROFILER.poll()
 
-class ImageProcess(mp.Process):
+
+class DetectorPool:
     """
-    Class to process the image frame to find ball centre coordinates
+    Fixed pool of DetectorWorker processes which live for the whole session,
+    so no process is spawned per frame.
     ...
 
     Attributes
     ----------
     queue : obj of class 'multiprocessing.queue'
-        multiprocessing queue to store frames
-    centre_coordinate : tuple of objs of class 'multiprocessing.value'
-        centre coordinate of the ball
-    target : obj of class 'ImageProcess'
-        input target function for multiprocessing queue to find coordinates
+        multiprocessing queue shared by all the workers
+    workers : list of objs of class 'DetectorWorker'
+        detector processes
+    counters : list of objs of class 'multiprocessing.value'
+        number of frames handled by each worker
+    ring : obj of class 'FrameRing'
+        shared frame slots read by the workers, None when frames travel through the queue
 
     Methods
     -------
-    info : Method responsible for Parsing the incoming frame, finding and storing the 
-        centre coordinate of the ball and displaying the corresponding frame.
+    start : Start all the workers.
+    stop : Send one stop sentinel per worker and wait for them to exit.
+    frame_counts : Number of frames handled by each worker.
+    stage_seconds : Wall-clock and CPU seconds the workers spent on their frames.
     """
 
-    def __init__(self, queue, centre_coordinate, target=None):    
+    def __init__(self, queue, centre_coordinate, workers=2, ring=None, results=None, display=None, detector=None, batch=1):
         """
-        Constructs all the necessary attributes for the ImageProcess object.
+        Constructs all the necessary attributes for the DetectorPool object.
 
         Parameters
         ----------
@@ -51,52 +1885,653 @@ class ImageProcess(mp.Process):
             multiprocessing queue to store frames
         centre_coordinate : tuple of objs of class 'multiprocessing.value'
             centre coordinate of the ball
-        target : obj of class 'ImageProcess'
-            input target function for multiprocessing queue to find coordinates
+        workers : int
+            number of detector processes
+        ring : obj of class 'FrameRing'
+            shared frame slots, if set the queue carries (slot, seq) pairs instead of frames
+        results : obj of class 'multiprocessing.queue'
+            receives a (pts, x, y, timestamp, queue_wait, detect_seconds) tuple for every detection, if set,
+            x and y are arrays for detectors finding several balls
+        display : obj of class 'DisplayProcess'
+            preview window offered the annotated frames, None to skip display
+        detector : obj of class 'Detector'
+            finds the ball in a frame, copied for every worker so tracking state is
+            per worker; whole-frame moments if None
+        batch : int
+            most queued frames a worker takes and detects at once
         """
+        if workers < 1:
+            raise ValueError("DetectorPool needs at least one worker")
         self.queue = queue
-        self.centre_coordinate = centre_coordinate
-        self.target = self._findCoordinates
-        mp.Process.__init__(self, target=self.target)
+        self.ring = ring
+        self.counters = [mp.Value('i', 0) for _ in range(workers)]
+        self.workers = [DetectorWorker(queue, centre_coordinate, counter, ring, results, display, copy.deepcopy(detector), batch)
+                        for counter in self.counters]
 
-    def _findCoordinates(self):
+    def start(self):
         """
-        Method responsible for Parsing the incoming frame, finding and storing the 
-        centre coordinate of the ball and displaying the corresponding frame.
+        Method responsible to start all the workers.
+        """
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def stop(self, timeout=2.0):
+        """
+        Method responsible to stop the workers, frames already queued are parsed first.
 
         Parameters
         ----------
-        None
+        timeout : float
+            seconds to wait for each worker before terminating it
 
         Returns
         -------
-        None
+        list of ints
+            number of frames handled by each worker
         """
-        frame = self.queue.get()
-        # Threshold the image to get the mask for the ball - in realistic scenarios hsv range masking is used to detect a particular colour due to intensity variations.
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        _,thresh = cv2.threshold(gray,50,255,cv2.THRESH_BINARY)
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        return self.frame_counts()
 
-        # calculate moments of binary image
-        M = cv2.moments(thresh)
+    def frame_counts(self):
+        """
+        Method responsible to report the number of frames handled by each worker.
+        """
+        return [counter.value for counter in self.counters]
 
-        # calculate x,y coordinate of center
-        cX = int(M["m10"] / M["m00"])
-        cY = int(M["m01"] / M["m00"])
+    def stage_seconds(self):
+        """
+        Method responsible to report the wall-clock and CPU seconds of all the workers together.
+        """
+        return tuple(sum(worker.stage_seconds[i] for worker in self.workers) for i in range(2))
 
-        # print(cX, cY, "\n")
-        # put text and highlight the center
-        cv2.circle(frame, (cX, cY), 5, (255, 255, 0), -1)
-        cv2.putText(frame, f"{cX}, {cY}", (cX - 25, cY - 25),cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 2)
-        
-        cv2.imshow('img', frame)
-        cv2.waitKey(100)
 
-        # Store Coordinates as multiprocessing Values
-        self.centre_coordinate[0].value = cX
-        self.centre_coordinate[1].value = cY
+class DisplayProcess(mp.Process):
+    """
+    Preview window in its own process, showing the latest annotated frame at a
+    fixed refresh rate so the detectors never wait on the GUI.
+    ...
+
+    Attributes
+    ----------
+    frames : obj of class 'FrameQueue'
+        latest (frame, x, y) waiting to be shown, older ones are replaced
+    refresh : float
+        maximum number of frames shown per second
+    window : str
+        name of the OpenCV window
+    next_due : obj of class 'multiprocessing.value'
+        time.perf_counter() from which the next frame is accepted
+    shown : obj of class 'multiprocessing.value'
+        number of frames shown
+    parent : int
+        pid of the client process, the display closes once it is gone
+
+    Methods
+    -------
+    offer : Hand over a frame if the refresh interval has elapsed, never blocks.
+    run : Draw and show the frames until the stop sentinel is received.
+    stop : Stop the process, which closes the window.
+    """
+
+    def __init__(self, refresh=15.0, window="img"):
+        """
+        Constructs all the necessary attributes for the DisplayProcess object.
+
+        Parameters
+        ----------
+        refresh : float
+            maximum number of frames shown per second
+        window : str
+            name of the OpenCV window
+        """
+        if refresh <= 0:
+            raise ValueError("refresh should be positive")
+        mp.Process.__init__(self, daemon=True)
+        self.frames = FrameQueue(1, "latest")
+        self.refresh = refresh
+        self.window = window
+        self.next_due = mp.Value('d', 0.0)
+        self.shown = mp.Value('i', 0)
+        self.parent = os.getpid()
+
+    def offer(self, frame, x, y, valid=None):
+        """
+        Method responsible to hand a frame to the display, called by the detectors.
+
+        Parameters
+        ----------
+        frame : numpy ndarray
+            analysed frame, copied since it may live in a shared ring slot
+        x, y : int or numpy ndarray
+            centre coordinate of the ball found in the frame, or of every ball
+        valid : callable
+            called once the frame is copied, False if its ring slot was overwritten
+            meanwhile and the copy may be torn, None for frames nobody overwrites
+
+        Returns
+        -------
+        bool
+            True if the frame was taken, False if it came before the refresh interval
+            elapsed or was overwritten
+        """
+        now = time.perf_counter()
+        with self.next_due.get_lock():
+            if now < self.next_due.value:
+                return False
+            self.next_due.value = now + 1.0 / self.refresh
+        frame = frame.copy()
+        if valid is not None and not valid():
+            return False
+        return self.frames.put((frame, x, y))
+
+    def run(self):
+        """
+        Method responsible to draw and show the latest frame until the stop sentinel is received.
+        """
+        while True:
+            try:
+                item = self.frames.get(timeout=1.0 / self.refresh)
+            except Empty:
+                if os.getppid() != self.parent:
+                    # Client died without stopping the display, see ImageProcess._next
+                    break
+                # Keep the window responsive between frames
+                cv2.waitKey(1)
+                continue
+            if item is None:
+                break
+
+            # put text and highlight the center
+            frame, cX, cY = item
+            if frame.ndim == 2:
+                # Luma plane, draw the annotation in colour
+                frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+            if np.ndim(cX) == 0:
+                cv2.circle(frame, (cX, cY), 5, (255, 255, 0), -1)
+                cv2.putText(frame, f"{cX}, {cY}", (cX - 25, cY - 25),cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 2)
+            else:
+                # Several balls, only mark the centres
+                for x, y in zip(cX.tolist(), cY.tolist()):
+                    cv2.circle(frame, (x, y), 3, (255, 255, 0), -1)
+            cv2.imshow(self.window, frame)
+            cv2.waitKey(1)
+            self.shown.value += 1
+        cv2.destroyAllWindows()
+
+    def stop(self, timeout=2.0):
+        """
+        Method responsible to stop the display process.
+
+        Parameters
+        ----------
+        timeout : float
+            seconds to wait before terminating it
+
+        Returns
+        -------
+        int
+            number of frames shown
+        """
+        self.frames.put(None)
+        self.join(timeout)
+        if self.is_alive():
+            self.terminate()
+            self.join()
+        return self.shown.value
+
+
+
+def luma_plane(frame):
+    """
+    Y plane of a decoded frame as a (height, width) array, viewed in place for
+    yuv420p frames which is what the video decoder produces.
+
+    Parameters
+    ----------
+    frame : obj of class 'VideoFrame'
+        decoded frame
+
+    Returns
+    -------
+    numpy ndarray
+        uint8 luma plane, a view into the frame unless it had to be converted
+    """
+    if frame.format.name not in ("yuv420p", "yuvj420p"):
+        return frame.to_ndarray(format="gray")
+    plane = frame.planes[0]
+    # Rows may be padded up to line_size
+    return np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)[:, :plane.width]
+
+
+def bgr_image(frame, i420=None, out=None):
+    """
+    bgr24 array of a decoded frame. A yuv420p frame is gathered into the i420
+    buffer and converted by OpenCV into the out buffer, so no array is allocated
+    per frame; anything else goes through VideoFrame.to_ndarray.
+
+    Parameters
+    ----------
+    frame : obj of class 'VideoFrame'
+        decoded frame
+    i420 : numpy ndarray
+        (height * 3 / 2, width) uint8 buffer for the planes, None to use to_ndarray
+    out : numpy ndarray
+        (height, width, 3) uint8 buffer for the converted image
+
+    Returns
+    -------
+    numpy ndarray
+        out holding the image, or a new array from to_ndarray
+    """
+    if i420 is None or frame.format.name != "yuv420p" or i420.shape != (frame.height * 3 // 2, frame.width):
+        return frame.to_ndarray(format="bgr24")
+    flat, start = i420.reshape(-1), 0
+    for plane in frame.planes:
+        size = plane.width * plane.height
+        # Rows may be padded up to line_size
+        rows = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+        np.copyto(flat[start:start + size].reshape(plane.height, plane.width), rows[:, :plane.width])
+        start += size
+    return cv2.cvtColor(i420, cv2.COLOR_YUV2BGR_I420, dst=out)
+
+
+# Raw frame archive written by --record-raw: the data file holds the yuv420p planes of
+# every frame back to back, the index file a header (magic, time base) followed by one
+# fixed-size little-endian record per frame
+ARCHIVE_MAGIC = b"BALLRAW1"
+ARCHIVE_HEADER = "<8sii"
+ARCHIVE_RECORD = np.dtype([("pts", "<i8"), ("offset", "<i8"), ("width", "<u4"), ("height", "<u4")])
+
+
+class RawFrameArchive:
+    """
+    Memory-mapped archive of raw yuv420p frames with a compact offset index, so any
+    frame can be read back directly without decoding the ones before it.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        data file, the index is path + '.idx'
+    mode : str
+        'w' to append frames, 'r' to read them
+    data : obj of class 'mmap.mmap'
+        mapping of the data file, preallocated and grown by doubling while writing
+    size : int
+        bytes of the data file holding frames
+    records : numpy ndarray
+        index of the frames, ARCHIVE_RECORD entries (read mode)
+    time_base : obj of class 'fractions.Fraction'
+        time base of the frame pts
+
+    Methods
+    -------
+    append : Copy a frame into the data file and index it.
+    frame : Read back a frame by its position in the archive.
+    find : Position of the frame with a given pts.
+    close : Flush the archive and trim the data file to the frames written.
+    """
+
+    def __init__(self, path, mode="r", capacity=64 << 20):
+        """
+        Constructs all the necessary attributes for the RawFrameArchive object.
+
+        Parameters
+        ----------
+        path : str
+            data file, the index is path + '.idx'
+        mode : str
+            'w' creates (or overwrites) the archive, 'r' opens it for reading
+        capacity : int
+            bytes preallocated for the data file in write mode
+        """
+        if mode not in ("r", "w"):
+            raise ValueError("mode must be 'r' or 'w', not %r" % mode)
+        self.path = path
+        self.mode = mode
+        self.size = 0
+        self.time_base = None
+        if mode == "w":
+            self.file = open(path, "w+b")
+            self.file.truncate(capacity)
+            self.data = mmap.mmap(self.file.fileno(), capacity)
+            self.index = open(path + ".idx", "wb")
+            self.count = 0
+            return
+
+        with open(path + ".idx", "rb") as f:
+            header = f.read(struct.calcsize(ARCHIVE_HEADER))
+            records = f.read()
+        if len(header) < struct.calcsize(ARCHIVE_HEADER):
+            self.records = np.empty(0, dtype=ARCHIVE_RECORD)
+        else:
+            magic, num, den = struct.unpack(ARCHIVE_HEADER, header)
+            if magic != ARCHIVE_MAGIC:
+                raise ValueError("%s.idx is not a raw frame index" % path)
+            self.time_base = fractions.Fraction(num, den)
+            # A record cut short by a crash while writing is ignored
+            usable = len(records) // ARCHIVE_RECORD.itemsize * ARCHIVE_RECORD.itemsize
+            self.records = np.frombuffer(records[:usable], dtype=ARCHIVE_RECORD)
+        self.count = len(self.records)
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, frame, pts=None, time_base=None):
+        """
+        Method responsible to copy the planes of a frame to the end of the data file
+        and add its index record.
+
+        Parameters
+        ----------
+        frame : obj of class 'VideoFrame'
+            frame to store, converted to yuv420p if it is in another format
+        pts, time_base : int and obj of class 'fractions.Fraction'
+            timing of the frame if not its own, e.g. read when it was queued
+        """
+        pts = frame.pts if pts is None else pts
+        time_base = time_base or frame.time_base
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        nbytes = sum(plane.width * plane.height for plane in frame.planes)
+        if self.size + nbytes > len(self.data):
+            self.data.resize(max(2 * len(self.data), self.size + nbytes))
+        if self.time_base is None:
+            self.time_base = time_base or fractions.Fraction(1, 90000)
+            self.index.write(struct.pack(ARCHIVE_HEADER, ARCHIVE_MAGIC, self.time_base.numerator, self.time_base.denominator))
+
+        offset = position = self.size
+        for plane in frame.planes:
+            # Rows may be padded up to line_size, only the visible part is stored
+            rows = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)[:, :plane.width]
+            target = np.frombuffer(self.data, np.uint8, count=rows.size, offset=position).reshape(rows.shape)
+            np.copyto(target, rows)
+            del target   # the mapping can not be resized while a view exists
+            position += rows.size
+        self.size = position
+        record = np.array([(pts or 0, offset, frame.width, frame.height)], dtype=ARCHIVE_RECORD)
+        self.index.write(record.tobytes())
+        self.count += 1
+
+    def frame(self, i):
+        """
+        Method responsible to read back a frame, only its own bytes are touched.
+
+        Parameters
+        ----------
+        i : int
+            position of the frame in the archive
+
+        Returns
+        -------
+        obj of class 'VideoFrame'
+            yuv420p frame with its original pts and time base
+        """
+        pts, offset, width, height = self.records[i].tolist()
+        chroma = ((height + 1) // 2) * ((width + 1) // 2)
+        planes = np.frombuffer(self.data, np.uint8, count=width * height + 2 * chroma, offset=offset)
+        frame = VideoFrame(width, height, "yuv420p")
+        start = 0
+        for plane, size in zip(frame.planes, (width * height, chroma, chroma)):
+            rows = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+            rows[:, :plane.width] = planes[start:start + size].reshape(plane.height, plane.width)
+            start += size
+        frame.pts, frame.time_base = pts, self.time_base
+        return frame
+
+    def find(self, pts):
+        """
+        Method responsible to look up a frame by pts, the records are in arrival order
+        which is increasing pts for one track.
+
+        Returns
+        -------
+        int or None
+            position of the frame, None if no frame has that pts
+        """
+        i = int(np.searchsorted(self.records["pts"], pts))
+        if i < self.count and self.records["pts"][i] == pts:
+            return i
+        return None
+
+    def close(self):
+        """
+        Method responsible to flush the archive and, when writing, trim the
+        preallocated data file to the bytes used.
+        """
+        if self.data is not None:
+            if self.mode == "w":
+                self.data.flush()
+            self.data.close()
+            self.data = None
+        if self.mode == "w":
+            self.file.truncate(self.size)
+            self.index.close()
+        self.file.close()
+
+
+class RawFrameRecorder:
+    """
+    Drop-in for aiortc's MediaRecorder which stores the raw frames in a
+    RawFrameArchive instead of encoding them. The event loop only hands frame
+    references to a bounded queue, a background thread copies them to the archive
+    and frames are dropped (and counted) rather than delaying the live path when
+    the disk falls behind.
+    ...
+
+    Attributes
+    ----------
+    archive : obj of class 'RawFrameArchive'
+        archive the frames are written to
+    tracks : list
+        video tracks added before start
+    frames : obj of class 'queue.Queue'
+        frames waiting for the writer thread
+    recorded, dropped : int
+        frames written and frames dropped because the queue was full
+
+    Methods
+    -------
+    addTrack : Add a track to record, audio tracks are ignored.
+    start : Start consuming the tracks and the writer thread.
+    stop : Stop consuming, write what is queued and close the archive.
+    """
+
+    def __init__(self, path, capacity=64 << 20, queue_size=64):
+        """
+        Constructs all the necessary attributes for the RawFrameRecorder object.
+
+        Parameters
+        ----------
+        path : str
+            data file of the archive, the index is path + '.idx'
+        capacity : int
+            bytes preallocated for the data file
+        queue_size : int
+            most frames waiting for the writer before new ones are dropped
+        """
+        self.archive = RawFrameArchive(path, "w", capacity)
+        self.tracks = []
+        self.tasks = []
+        self.frames = Queue(queue_size)
+        self.writer = None
+        self.recorded = 0
+        self.dropped = 0
+
+    def addTrack(self, track):
+        if track.kind == "video":
+            self.tracks.append(track)
+            if self.writer is not None:
+                # Track of a later session, recorded into the same archive
+                self.tasks.append(asyncio.ensure_future(self._consume(track)))
+
+    async def start(self):
+        if self.writer is not None:
+            return
+        self.writer = threading.Thread(target=self._write, name="raw-recorder", daemon=True)
+        self.writer.start()
+        self.tasks = [asyncio.ensure_future(self._consume(track)) for track in self.tracks]
+
+    async def _consume(self, track):
+        while True:
+            try:
+                frame = await track.recv()
+            except MediaStreamError:
+                return
+            # The relay shares the frame with the detector track whose sender rewrites
+            # its pts, so the timing is read now and not by the writer thread
+            try:
+                self.frames.put_nowait((frame, frame.pts, frame.time_base))
+            except Full:
+                self.dropped += 1
+                FRAMES_NOT_RECORDED.inc()
+
+    def _write(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            self.archive.append(*item)
+            self.recorded += 1
+            FRAMES_RECORDED.inc()
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.writer is not None:
+            self.frames.put(None)
+            await asyncio.get_running_loop().run_in_executor(None, self.writer.join)
+            self.writer = None
+        if self.archive.data is not None:
+            self.archive.close()
+            print("Recorded %d raw frames to %s, dropped %d" % (self.recorded, self.archive.path, self.dropped))
+
+
+def transcode_archive(path, output, codec="libx264"):
+    """
+    Encode a raw frame archive to a regular video file, after the live session.
+
+    Parameters
+    ----------
+    path : str
+        data file of the archive
+    output : str
+        video file to write, the container is picked from its extension
+    codec : str
+        video codec of the output
+
+    Returns
+    -------
+    int
+        number of frames encoded
+    """
+    archive = RawFrameArchive(path)
+    try:
+        if not len(archive):
+            return 0
+        with av.open(output, "w") as container:
+            first = archive.frame(0)
+            stream = container.add_stream(codec)
+            stream.width, stream.height, stream.pix_fmt = first.width, first.height, "yuv420p"
+            stream.time_base = stream.codec_context.time_base = archive.time_base
+            for i in range(len(archive)):
+                frame = archive.frame(i)
+                # Recorded pts keep the gaps of dropped frames, the encoder keeps them too
+                frame.pts -= int(archive.records["pts"][0])
+                container.mux(stream.encode(frame))
+            container.mux(stream.encode())
+        return len(archive)
+    finally:
+        archive.close()
+
+
+class CoordinateSender:
+    """
+    Class responsible to send the coordinate messages on a data channel. With
+    coalescing at most one message waits in the channel's buffer: while it has not
+    reached the SCTP layer, a newer message replaces the pending one instead of
+    queuing behind it, so a lost packet never builds a backlog of stale coordinates.
+    ...
+
+    Attributes
+    ----------
+    channel : obj of class 'RTCDataChannel'
+        channel the coordinates are sent on
+    coalesce : bool
+        keep only the newest message while one is waiting, False sends every message
+    pending : bytes
+        newest message not handed to the channel yet, None if there is none
+    sent : int
+        messages handed to the channel
+    coalesced : int
+        messages replaced by a newer one before they were sent
+
+    Methods
+    -------
+    send : Send a message, or keep it as the pending one while the channel is busy.
+    """
+
+    def __init__(self, channel, coalesce=False):
+        """
+        Constructs all the necessary attributes for the CoordinateSender object.
+
+        Parameters
+        ----------
+        channel : obj of class 'RTCDataChannel'
+            channel the coordinates are sent on
+        coalesce : bool
+            keep only the newest message while one is waiting
+        """
+        self.channel = channel
+        self.coalesce = coalesce
+        self.pending = None
+        self.sent = self.coalesced = 0
+        # Fired once the buffered message has been handed to SCTP
+        channel.bufferedAmountLowThreshold = 0
+        channel.on("bufferedamountlow", self._flush)
+
+    def send(self, message):
+        """
+        Method responsible to send a message now, or to keep it until the channel's buffer is empty.
+
+        Parameters
+        ----------
+        message : bytes
+            packed coordinate message
+
+        Returns
+        -------
+        bool
+            True if the message was handed to the channel right away
+        """
+        if self.coalesce and self.channel.bufferedAmount > 0:
+            if self.pending is not None:
+                self.coalesced += 1
+                COORDINATES_COALESCED.inc()
+            self.pending = message
+            return False
+        self.channel.send(message)
+        self.sent += 1
+        return True
+
+    def _flush(self):
+        if self.pending is None or self.channel.readyState != "open":
+            return
+        message, self.pending = self.pending, None
+        self.channel.send(message)
+        self.sent += 1
 
-        
 
 class FrameReceiever(MediaStreamTrack):
     """
@@ -108,32 +2543,86 @@ class FrameReceiever(MediaStreamTrack):
     ----------
     kind : str
         type of media track
-    queue : obj of class 'multiprocessing.queue'
-        multiprocessing queue to store frames
+    queue : obj of class 'FrameQueue'
+        bounded multiprocessing queue to store frames, created with the detector pool
     channel : obj of class 'RTCPeerConnection.createDataChannel'
         input target function for multiprocessing queue to find coordinates
+    sender : obj of class 'CoordinateSender'
+        sends the coordinates on the channel, coalescing them on an unordered channel
     centre_coordinate : tuple of objs of class 'multiprocessing.value'
             centre coordinate of the ball
+    pool : obj of class 'DetectorPool'
+        detector processes parsing the queued frames, shared by the session
+    ring : obj of class 'FrameRing'
+        shared memory slots holding the frames when the 'shm' transport is used
+    frames_received : int
+        number of frames received from the track
+    results : obj of class 'multiprocessing.queue'
+        (pts, x, y, timestamp, queue_wait, detect_seconds) detections coming back from the pool
+    pump : obj of class 'threading.Thread'
+        forwards the detections to the event loop as soon as they are ready
+    preview : obj of class 'DisplayProcess'
+        window showing the latest annotated frame, None when running headless
     
     Instance Attributes
     ----------
     track : obj of class 'MediaStreamTrack'
         To recieve frames asynchronously 
+    workers : int
+        number of detector processes in the pool
+    transport : str
+        'shm' to pass frames through the shared memory ring, 'queue' to pickle them
+    queue_size : int
+        maximum number of frames waiting for a detector
+    overflow : str
+        FrameQueue policy applied when the detectors fall behind
+    display : bool
+        show the annotated frames in a preview window
+    display_fps : float
+        maximum refresh rate of the preview window
+    tracking : bool
+        search the ball around its predicted position instead of in the whole frame
+    search_window : int
+        smallest half size of the tracking search window in pixels
+    pixel_format : str
+        'yuv' detects on the luma plane of the decoded frame, 'bgr' converts it to bgr24 first
+    detector : str
+        name of the detector backend in DETECTORS, 'components' finds every ball of a multi-ball scene
+    threshold : int
+        gray level above which a pixel belongs to a ball
+    batch : int
+        most queued frames a detector takes at once
+    buffers : tuple of numpy ndarrays
+        (i420, bgr) conversion buffers reused for every frame of the 'bgr' pixel format, None until needed
     on_datachannel : obj of class 'RTCPeerConnection'
         Establishing the data channel on client side to transfer coordinates
 
     Methods
     -------
     info : Uses Image process class to process images and send coordinates to the server
+    shutdown : Stops the detector pool and reports the frames handled by each worker
+    stats : Received, dropped and processed frame counters
+    start_session : Restarts the time-to-first-frame and time-to-first-coordinate clocks
     """
     
     kind = "video"
-    queue = mp.Queue()                                       # Multiprocessing queue
+    queue = None                                             # Bounded multiprocessing queue, created with the pool
     channel = None                                           # Assigned when Class is initialized
+    sender = None                                            # Created with the channel
     centre_coordinate = (mp.Value('i', 0), mp.Value('i', 0)) # Using multiprocessing values as shared memory 
+    pool = None                                              # Started with the first frame
+    ring = None                                              # Sized from the first frame
+    frames_received = 0
+    results = None                                           # Detections coming back from the pool
+    pump = None                                              # Thread forwarding detections to the loop
+    preview = None                                           # Display process, unless headless
+    session_started = None                                   # time.perf_counter() at the last offer
+    first_frame = None                                       # Seconds from the offer to its first frame, None until then
+    awaiting_coordinate = False                              # No coordinates sent yet in this session
 
 
-    def __init__(self, pc, track):
+    def __init__(self, pc, track, workers=2, transport="shm", queue_size=4, overflow="latest", display=True, display_fps=15.0,
+                 tracking=False, search_window=48, pixel_format="yuv", detector="moments", threshold=50, batch=1):
         """
         Constructs all the necessary attributes for the FrameReceiever object.
 
@@ -143,23 +2632,201 @@ class FrameReceiever(MediaStreamTrack):
             To establish the connection
         track : obj of class 'MediaStreamTrack'
             To recieve frames asynchronously 
+        workers : int
+            number of detector processes in the pool
+        transport : str
+            'shm' to pass frames through the shared memory ring, 'queue' to pickle them
+        queue_size : int
+            maximum number of frames waiting for a detector
+        overflow : str
+            'drop-oldest', 'drop-newest' or 'latest', applied when the queue is full
+        display : bool
+            show the annotated frames in a preview window, False for headless
+        display_fps : float
+            maximum refresh rate of the preview window
+        tracking : bool
+            search the ball around its predicted position instead of in the whole frame
+        search_window : int
+            smallest half size of the tracking search window in pixels
+        pixel_format : str
+            'yuv' detects on the luma plane of the decoded frame, 'bgr' converts it to bgr24 first
+        detector : str
+            name of the detector backend in DETECTORS, 'components' finds every ball of a multi-ball scene
+        threshold : int
+            gray level above which a pixel belongs to a ball
+        batch : int
+            most queued frames a detector takes at once, their coordinates are sent in one message
         on_datachannel : obj of class 'RTCPeerConnection.on'
             Establishing the data channel on client side to transfer coordinates
         """
         super().__init__()
+        if transport not in ("shm", "queue"):
+            raise ValueError("transport should be 'shm' or 'queue'")
+        if overflow not in FrameQueue.policies:
+            raise ValueError("overflow should be one of %s" % ", ".join(FrameQueue.policies))
+        if pixel_format not in ("yuv", "bgr"):
+            raise ValueError("pixel_format should be 'yuv' or 'bgr'")
+        if detector not in DETECTORS:
+            raise ValueError("detector should be one of %s" % ", ".join(DETECTORS))
+        if tracking and detector != "moments":
+            raise ValueError("tracking needs the 'moments' detector")
+        if batch > 1 and DETECTORS[detector].multiple:
+            # Batch messages carry one centre per frame
+            raise ValueError("batching needs a single-ball detector")
         self.track = track
+        self.workers = workers
+        self.transport = transport
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.display = display
+        self.display_fps = display_fps
+        self.tracking = tracking
+        self.search_window = search_window
+        self.pixel_format = pixel_format
+        self.detector = detector
+        self.threshold = threshold
+        self.batch = batch
+        self.buffers = None
 
         @pc.on("datachannel")
         def on_datachannel(channel):
             FrameReceiever.channel = channel
+            # An unordered channel without retransmits asks for the newest coordinates only
+            FrameReceiever.sender = CoordinateSender(channel, coalesce=not channel.ordered)
             print(FrameReceiever.channel.label, "-", "created by remote party")
+
+    def _start_pool(self, shape):
+        """
+        Method responsible to start the detector pool, and the frame ring for the
+        'shm' transport, once the frame shape is known.
+        """
+        FrameReceiever.queue = FrameQueue(self.queue_size, self.overflow)
+        if self.transport == "shm":
+            # One slot per queued frame, one per frame a worker is reading and the one
+            # being written, so a queued frame is never overwritten before a worker reads it
+            FrameReceiever.ring = FrameRing(shape, slots=self.queue_size + self.workers * self.batch + 1)
+        FrameReceiever.results = mp.Queue()
+        if self.display:
+            FrameReceiever.preview = DisplayProcess(self.display_fps)
+            FrameReceiever.preview.start()
+        if self.tracking:
+            detector = TrackingDetector(self.threshold, self.search_window)
+        else:
+            detector = DETECTORS[self.detector](self.threshold)
+        FrameReceiever.pool = DetectorPool(FrameReceiever.queue, FrameReceiever.centre_coordinate, self.workers, FrameReceiever.ring,
+                                           FrameReceiever.results, FrameReceiever.preview, detector, self.batch)
+        FrameReceiever.pool.start()
+        # SIGUSR1 to one of these pids profiles that worker
+        print("Detector workers:", " ".join(str(worker.pid) for worker in FrameReceiever.pool.workers))
+
+        FrameReceiever.pump = threading.Thread(
+            target=FrameReceiever._pump_results,
+            args=(FrameReceiever.results, asyncio.get_event_loop()),
+            daemon=True)
+        FrameReceiever.pump.start()
+
+    @staticmethod
+    def _pump_results(results, loop):
+        """
+        Method responsible to hand every detection to the event loop, which owns the data channel.
+
+        Parameters
+        ----------
+        results : obj of class 'multiprocessing.queue'
+            (pts, x, y, timestamp, queue_wait, detect_seconds) detections, None to stop
+        loop : obj of class 'asyncio.get_event_loop'
+            Event loop object for async coroutines
+        """
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            QUEUE_WAIT_SECONDS.observe(result[4])
+            DETECT_SECONDS.observe(result[5])
+            try:
+                loop.call_soon_threadsafe(FrameReceiever.send_coordinates, *result[:4])
+            except RuntimeError:
+                # Event loop already closed
+                break
+
+    @staticmethod
+    def shutdown():
+        """
+        Method responsible to stop the detector pool once the peer connection is closed.
+        """
+        if FrameReceiever.pool is None:
+            return
+        counts = FrameReceiever.pool.stop()
+        stats = FrameReceiever.stats()
+        FrameReceiever.pool = None
+        FrameReceiever.results.put(None)
+        FrameReceiever.pump.join(timeout=1.0)
+        FrameReceiever.results = FrameReceiever.pump = None
+        if FrameReceiever.ring is not None:
+            FrameReceiever.ring.close()
+            FrameReceiever.ring = None
+        if FrameReceiever.preview is not None:
+            print("Preview showed", FrameReceiever.preview.stop(), "frames")
+            FrameReceiever.preview = None
+        for i, count in enumerate(counts):
+            print("Detector worker", i, "processed", count, "frames")
+        print("Frames received:", stats["received"], "dropped:", stats["dropped"], "processed:", stats["processed"])
+
+    @staticmethod
+    def stats():
+        """
+        Method responsible to report the received, dropped and processed frame counters.
+
+        Returns
+        -------
+        dict
+            'received', 'dropped' and 'processed' frame counts
+        """
+        dropped = FrameReceiever.queue.dropped.value if FrameReceiever.queue is not None else 0
+        processed = sum(FrameReceiever.pool.frame_counts()) if FrameReceiever.pool is not None else 0
+        return {"received": FrameReceiever.frames_received, "dropped": dropped, "processed": processed}
         
-    async def send_coordinates():
+    @staticmethod
+    def start_session():
+        """
+        Method responsible to restart the time-to-first clocks when an offer arrives,
+        the detector pool is kept running across sessions.
+        """
+        FrameReceiever.session_started = time.perf_counter()
+        FrameReceiever.first_frame = None
+        FrameReceiever.awaiting_coordinate = True
+        SESSIONS.inc()
+
+    @staticmethod
+    def send_coordinates(pts, x, y, timestamp):
         """
         Method responsible to generate message and send it to server uisng channel object.
+
+        Parameters
+        ----------
+        pts : int or numpy ndarray
+            presentation timestamp of the analysed frame, or of every frame of a batch
+        x, y : int or numpy ndarray
+            centre coordinate of the ball, of every ball found in the frame or of the ball in every frame of the batch
+        timestamp : float
+            wall-clock time at which the detection finished
         """
-        message = str(FrameReceiever.centre_coordinate[0].value) + " " + str(FrameReceiever.centre_coordinate[1].value)
-        FrameReceiever.channel.send(message)
+        if FrameReceiever.channel is None or FrameReceiever.channel.readyState != "open":
+            return
+        if isinstance(pts, np.ndarray):
+            FrameReceiever.sender.send(pack_batch(pts, x, y, timestamp))
+        elif isinstance(x, np.ndarray):
+            FrameReceiever.sender.send(pack_detections(pts, x, y, timestamp))
+        else:
+            FrameReceiever.sender.send(pack_coordinates(pts, x, y, timestamp))
+        SEND_SECONDS.observe(max(time.time() - timestamp, 0.0))
+        if FrameReceiever.awaiting_coordinate and FrameReceiever.first_frame is not None:
+            FrameReceiever.awaiting_coordinate = False
+            first_coordinate = time.perf_counter() - FrameReceiever.session_started
+            TIME_TO_FIRST_COORDINATE.observe(first_coordinate)
+            print("Session ready: first frame %.0f ms, first coordinates %.0f ms after the offer"
+                  % (FrameReceiever.first_frame * 1000, first_coordinate * 1000))
+        DETECT_FPS.tick()
 
 
     async def recv(self):
@@ -173,28 +2840,59 @@ class FrameReceiever(MediaStreamTrack):
 
         Returns
         -------
-        new_frame : obj of class 'Videoframe'
-            Compatible format for transferring via Media channel
+        frame : obj of class 'Videoframe'
+            the decoded frame, passed through unchanged since it is never annotated here
         """
         frame = await self.track.recv()
-         
-        img = frame.to_ndarray(format="bgr24")
-        FrameReceiever.queue.put(img)
-        process_a = ImageProcess(FrameReceiever.queue, FrameReceiever.centre_coordinate)
-        process_a.start()
+        if self.readyState != "live":
+            # Connection closed while this frame was awaited, do not restart the pool
+            raise MediaStreamError
+        FrameReceiever.frames_received += 1
+        FRAMES_RECEIVED.inc()
+        if FrameReceiever.first_frame is None and FrameReceiever.session_started is not None:
+            FrameReceiever.first_frame = time.perf_counter() - FrameReceiever.session_started
+            TIME_TO_FIRST_FRAME.observe(FrameReceiever.first_frame)
+        RECEIVE_FPS.tick()
+        started = STAGE_RECV.start()
+
+        start = time.perf_counter()
+        if self.pixel_format == "yuv":
+            # The ball is found on brightness alone, no colour conversion needed
+            img = luma_plane(frame)
+        elif FrameReceiever.ring is not None and frame.width % 2 == 0 and frame.height % 2 == 0:
+            # The ring copies the image right away, so one pair of buffers serves every frame
+            if self.buffers is None or self.buffers[1].shape[:2] != (frame.height, frame.width):
+                self.buffers = (np.empty((frame.height * 3 // 2, frame.width), np.uint8),
+                                np.empty((frame.height, frame.width, 3), np.uint8))
+            img = bgr_image(frame, *self.buffers)
+        else:
+            img = frame.to_ndarray(format="bgr24")
+        TO_NDARRAY_SECONDS.observe(time.perf_counter() - start)
 
-        # Send coordinates to server.py
-        asyncio.ensure_future(FrameReceiever.send_coordinates())
+        if FrameReceiever.ring is not None and FrameReceiever.ring.shape != img.shape:
+            # Resolution changed mid-stream, restart the pool with a matching ring
+            FrameReceiever.shutdown()
+        if FrameReceiever.pool is None:
+            self._start_pool(img.shape)
 
-        # rebuild a VideoFrame, preserving timing information
-        new_frame = VideoFrame.from_ndarray(img, format="bgr24")
-        new_frame.pts = frame.pts
-        new_frame.time_base = frame.time_base
-        return new_frame
+        # Frames are tagged with their pts so the server can compare the detection
+        # with the exact frame it rendered, coordinates are sent as detections finish
+        if FrameReceiever.ring is not None:
+            FrameReceiever.queue.put(FrameReceiever.ring.write(img, frame.pts) + (time.perf_counter(),))
+        else:
+            FrameReceiever.queue.put((frame.pts, img, time.perf_counter()))
 
+        STAGE_RECV.stop(started)
+        return frame
 
 
-async def client_consume_signaling(pc, signaling, loop):
+# Seconds between two attempts to reach the server's signaling socket
+RECONNECT_DELAY = 0.2
+# Longest wait between two attempts, the delay doubles after every failed one
+RECONNECT_MAX_DELAY = 5.0
+
+
+async def client_consume_signaling(pc, signaling, recorder, loop, renew=None):
     """
     Asynchronoulsy wait for the signals, record the video frames 
     and send answer to the corresponding offer. 
@@ -204,17 +2902,28 @@ async def client_consume_signaling(pc, signaling, loop):
     pc : obj of class 'RTCPeerConnection
             To establish the connection
     signaling :  obj of class 'aiortc.contrib.signaling.create_signaling'
+    recorder : obj of class 'MediaRecorder' or 'RawFrameRecorder'
+        For recording te incoming image frames to a video
     loop : obj of class 'asyncio.get_event_loop'
         Event loop object for async coroutines 
+    renew : coroutine function
+        called with the current connection when a new offer arrives after the first,
+        returns the new RTCPeerConnection that answers it; None answers on pc
 
     Returns
     ----------
-    None
+    tuple
+        (peer connection of the last session, 'bye' when the server left or 'error')
     """
     try:
         while True:
             obj = await signaling.receive()
             if isinstance(obj, RTCSessionDescription):
+                if obj.type == "offer":
+                    if renew is not None and pc.remoteDescription is not None:
+                        # The server renegotiates after a failure, on a new connection
+                        pc = await renew(pc)
+                    FrameReceiever.start_session()
                 await pc.setRemoteDescription(obj)
                 await recorder.start()
 
@@ -225,17 +2934,20 @@ async def client_consume_signaling(pc, signaling, loop):
                     
             elif isinstance(obj, RTCIceCandidate):
                 await pc.addIceCandidate(obj)
-            elif obj is BYE:
+            elif obj is BYE or obj is None:
+                # None once the socket signaling connection is closed by the other side
                 print("Exiting")
-                break
-    except:
-        # Stop the loop if input object is invalid
-        loop.stop()
+                return pc, "bye"
+    except Exception as e:
+        # Server not listening (yet) or invalid input, the caller decides whether to retry
+        # Failed reconnect attempts are summarized by answer()
+        logger.log(logging.DEBUG if renew is not None else logging.WARNING, "Signaling failed: %r", e)
+        return pc, "error"
 
-        print("Shutdown complete ...") 
 
-
-async def answer(pc, signaling, recorder, loop):
+async def answer(pc, signaling, recorder, loop, workers=2, transport="shm", queue_size=4, overflow="latest", display=True, display_fps=15.0,
+                 tracking=False, search_window=48, pixel_format="yuv", detector="moments", threshold=50, batch=1, reconnect=False,
+                 codec=None):
     """
     Asynchronoulsy wait for the signal and generate and answer for offer, 
     generate media and data channels to recieve corresponding data and consume signaling.
@@ -245,10 +2957,39 @@ async def answer(pc, signaling, recorder, loop):
     pc : obj of class 'RTCPeerConnection
             To establish the connection
     signaling :  obj of class 'aiortc.contrib.signaling.create_signaling'
-    recorder : obj of class 'MediaRecorder'
+    recorder : obj of class 'MediaRecorder' or 'RawFrameRecorder'
         For recording te incoming image frames to a video
     loop : obj of class 'asyncio.get_event_loop'
         Event loop object for async coroutines 
+    workers : int
+        number of detector processes
+    transport : str
+        'shm' to pass frames to the detectors through shared memory, 'queue' to pickle them
+    queue_size : int
+        maximum number of frames waiting for a detector
+    overflow : str
+        'drop-oldest', 'drop-newest' or 'latest', applied when the detectors fall behind
+    display : bool
+        show the annotated frames in a preview window, False for headless
+    display_fps : float
+        maximum refresh rate of the preview window
+    tracking : bool
+        search the ball around its predicted position instead of in the whole frame
+    search_window : int
+        smallest half size of the tracking search window in pixels
+    pixel_format : str
+        'yuv' detects on the luma plane of the decoded frames, 'bgr' converts them to bgr24 first
+    detector : str
+        name of the detector backend in DETECTORS, 'components' finds every ball of a multi-ball scene
+    threshold : int
+        gray level above which a pixel belongs to a ball
+    batch : int
+        most queued frames a detector takes at once
+    reconnect : bool
+        answer every new offer on a new connection and reconnect the signaling when
+        the server goes away, keeping the detector pool running; for socket signaling
+    codec : str
+        'vp8' or 'h264' to only accept that video codec, None accepts the server's choice
 
     Returns
     ----------
@@ -257,34 +2998,102 @@ async def answer(pc, signaling, recorder, loop):
     # connect signaling
     await signaling.connect()
 
-    # Media Channel to receive frames
-    @pc.on("track")
-    def on_track(track):      
-        print("Receiving %s" % track.kind)
+    def setup(pc):
+        # Media Channel to receive frames
+        receivers = []
+        if codec is not None:
+            # setRemoteDescription reuses this transceiver for the offered video, limiting the answer to the codec
+            mime_type = {"vp8": "video/vp8", "h264": "video/h264"}[codec]
+            transceiver = pc.addTransceiver("video", direction="recvonly")
+            transceiver.setCodecPreferences([capability for capability in RTCRtpSender.getCapabilities("video").codecs
+                                             if capability.mimeType.lower() in (mime_type, "video/rtx")])
 
-        framereceiver = FrameReceiever(pc, track) 
-        pc.addTrack(framereceiver)
-        recorder.addTrack(track)
-        
+        @pc.on("track")
+        def on_track(track):      
+            print("Receiving %s" % track.kind)
 
-    @pc.on("connectionstatechange")
-    async def on_connectionstatechange():
-        print("Connection state is ", pc.connectionState)
-        if pc.connectionState == "failed":
-            await pc.close()
-    
-    # consume signaling
-    await client_consume_signaling(pc, signaling, loop)
+            # The detectors and the recorder each get every frame, reading the remote
+            # track from both would split the frames between them
+            relay = MediaRelay()
+            framereceiver = FrameReceiever(pc, relay.subscribe(track), workers, transport, queue_size, overflow, display, display_fps,
+                                           tracking, search_window, pixel_format, detector, threshold, batch)
+            pc.addTrack(framereceiver)
+            receivers.append(framereceiver)
+            recorder.addTrack(relay.subscribe(track))
+
+        @pc.on("connectionstatechange")
+        async def on_connectionstatechange():
+            print("Connection state is ", pc.connectionState)
+            if pc.connectionState == "failed":
+                await pc.close()
+            if pc.connectionState in ("failed", "closed"):
+                for framereceiver in receivers:
+                    framereceiver.stop()
+                if not reconnect:
+                    FrameReceiever.shutdown()
+
+    async def renew(old):
+        await old.close()
+        pc = RTCPeerConnection()
+        setup(pc)
+        return pc
+
+    setup(pc)
+    try:
+        # consume signaling
+        delay, failures = RECONNECT_DELAY, 0
+        while True:
+            pc, reason = await client_consume_signaling(pc, signaling, recorder, loop, renew if reconnect else None)
+            if not reconnect:
+                break
+            if reason == "error" and pc.remoteDescription is None:
+                # Server not listening (yet), back off and only log now and then
+                failures += 1
+                if failures == 1 or delay >= RECONNECT_MAX_DELAY:
+                    logger.warning("Server not reachable after %d attempts, retrying in %.1f s", failures, delay)
+            else:
+                delay, failures = RECONNECT_DELAY, 0
+            # The server left or is not listening yet, wait for the next offer
+            await signaling.close()
+            await asyncio.sleep(delay)
+            if failures:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    finally:
+        await pc.close()
 
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Client Side - Sends coordinates to Server")
     parser.add_argument("--record-to", help="Write received media to a file."),
+    parser.add_argument("--record-raw", help="Write the received frames unencoded to a memory-mapped archive (PATH and PATH.idx), off the event loop.")
+    parser.add_argument("--transcode-to", help="After the session, encode the --record-raw archive to this video file.")
+    parser.add_argument("--workers", type=int, default=2, help="Number of detector processes.")
+    parser.add_argument("--transport", choices=["shm", "queue"], default="shm", help="How frames reach the detector processes.")
+    parser.add_argument("--queue-size", type=int, default=4, help="Maximum number of frames waiting for a detector.")
+    parser.add_argument("--overflow", choices=FrameQueue.policies, default="latest", help="What to drop when the detectors fall behind.")
+    parser.add_argument("--headless", action="store_true", help="Do not open the preview window.")
+    parser.add_argument("--display-fps", type=float, default=15.0, help="Maximum refresh rate of the preview window.")
+    parser.add_argument("--tracking", action="store_true", help="Search the ball around its predicted position instead of in the whole frame.")
+    parser.add_argument("--search-window", type=int, default=48, help="Smallest half size of the tracking search window in pixels.")
+    parser.add_argument("--pixel-format", choices=["yuv", "bgr"], default="yuv", help="Detect on the luma plane of the decoded frames or convert them to bgr24 first.")
+    parser.add_argument("--detector", choices=list(DETECTORS), default="moments", help="Detector backend, 'components' finds every ball of a server.py --balls scene.")
+    parser.add_argument("--threshold", type=int, default=50, help="Gray level above which a pixel belongs to a ball.")
+    parser.add_argument("--batch", type=int, default=1, help="Most queued frames a detector takes and reports at once, pair with a --queue-size at least as large and a drop-* overflow.")
+    parser.add_argument("--codec", choices=["vp8", "h264"], help="Only accept this video codec from the server.")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this local port, /profile?seconds=N takes a capture.")
+    parser.add_argument("--profile-dir", default=".", help="Where SIGUSR1 and /profile write their cProfile captures, detector workers take their own on SIGUSR1.")
+    parser.add_argument("--profile-seconds", type=float, default=10.0, help="Duration of a capture started by SIGUSR1.")
     parser.add_argument("--verbose", "-v", action="count")
     add_signaling_arguments(parser)
+    parser.set_defaults(signaling="tcp-socket")
     args = parser.parse_args()
 
+    if args.record_to and args.record_raw:
+        parser.error("--record-to and --record-raw are exclusive")
+    if args.transcode_to and not args.record_raw:
+        parser.error("--transcode-to needs --record-raw")
+
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
 
@@ -293,25 +3102,49 @@ if __name__ == "__main__":
     pc = RTCPeerConnection()
 
     # create media sink
-    if args.record_to:
+    if args.record_raw:
+        recorder = RawFrameRecorder(args.record_raw)
+    elif args.record_to:
         recorder = MediaRecorder(args.record_to)
     else:
         recorder = MediaBlackhole()
 
     # run event loop
     loop = asyncio.get_event_loop()
+    PROFILER.directory, PROFILER.seconds = args.profile_dir, args.profile_seconds
+    PROFILER.install(loop)
+    if args.metrics_port:
+        loop.run_until_complete(METRICS.serve(args.metrics_port, profiler=PROFILER))
     try:
-        asyncio.ensure_future(answer(
+        session = asyncio.ensure_future(answer(
                 pc=pc,
                 recorder=recorder,
                 signaling=signaling,
-                loop=loop))
+                loop=loop,
+                workers=args.workers,
+                transport=args.transport,
+                queue_size=args.queue_size,
+                overflow=args.overflow,
+                display=not args.headless,
+                display_fps=args.display_fps,
+                tracking=args.tracking,
+                search_window=args.search_window,
+                pixel_format=args.pixel_format,
+                detector=args.detector,
+                threshold=args.threshold,
+                batch=args.batch,
+                reconnect=args.signaling != "copy-and-paste",
+                codec=args.codec))
         loop.run_forever()
     except KeyboardInterrupt:
         pass
     finally:
-        # cleanup
-        cv2.destroyAllWindows()
+        # cleanup - close the connection first, so no frame restarts the detectors
+        session.cancel()
+        loop.run_until_complete(asyncio.gather(session, return_exceptions=True))
+        loop.run_until_complete(pc.close())
+        FrameReceiever.shutdown()
         loop.run_until_complete(recorder.stop())
         loop.run_until_complete(signaling.close())
-        loop.run_until_complete(pc.close())
+        if args.transcode_to:
+            print("Transcoded %d frames to %s" % (transcode_archive(args.record_raw, args.transcode_to), args.transcode_to))
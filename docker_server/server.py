@@ -2,154 +2,2736 @@
 
 import argparse
 import asyncio
+import bisect
+import cProfile
+import fractions
+import functools
+import itertools
+import json
 import logging
+import logging.handlers
 import time
 import math
+import mmap
+import os
+import signal
+import queue
+import struct
+import sys
+import threading
+import weakref
 import cv2
 import numpy as np
+import av
 from av import VideoFrame
 
 from aiortc import (
     RTCIceCandidate,
     RTCPeerConnection,
     RTCSessionDescription,
+    MediaStreamTrack,
     VideoStreamTrack,
 )
 
-from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder
-from aiortc.contrib.signaling import BYE, add_signaling_arguments, create_signaling
+from aiortc.mediastreams import VIDEO_CLOCK_RATE, VIDEO_TIME_BASE, MediaStreamError
+from aiortc.codecs import h264, vpx
+from aiortc.rtcrtpsender import RTCRtpSender
+from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder, MediaRelay
+from aiortc.contrib.signaling import BYE, add_signaling_arguments, create_signaling, object_from_string, object_to_string
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-message details are logged at DEBUG (-v), the periodic error summaries at INFO
+logger = logging.getLogger("ball_server")
+
+
+# Coordinate message received over the data channel: message type, frame pts,
+# ball x, ball y and detection wall-clock time - must match client.py
+COORDINATE_MESSAGE = 1
+COORDINATE_FORMAT = "!Bqiid"
+
+
+def unpack_coordinates(message):
+    """
+    Unpack a binary frame-tagged coordinate message sent by the client.
+
+    Parameters
+    ----------
+    message : bytes
+        message of struct.calcsize(COORDINATE_FORMAT) bytes
+
+    Returns
+    -------
+    tuple
+        (pts, x, y, timestamp) of the detection
+    """
+    kind, pts, x, y, timestamp = struct.unpack(COORDINATE_FORMAT, message)
+    if kind != COORDINATE_MESSAGE:
+        raise ValueError("Unknown coordinate message type %d" % kind)
+    return pts, x, y, timestamp
+
+
+# Multi-ball detection message: message type, frame pts, detection wall-clock time
+# and number of balls, followed by that many big-endian int32 (x, y) pairs - must match client.py
+DETECTIONS_MESSAGE = 2
+DETECTIONS_HEADER = "!BqdI"
+
+
+def unpack_detections(message):
+    """
+    Unpack a binary frame-tagged multi-ball detection message sent by the client.
+
+    Parameters
+    ----------
+    message : bytes
+        header of struct.calcsize(DETECTIONS_HEADER) bytes followed by the (x, y) pairs
+
+    Returns
+    -------
+    tuple
+        (pts, xs, ys, timestamp) of the detection, xs and ys are int arrays
+    """
+    header = struct.calcsize(DETECTIONS_HEADER)
+    kind, pts, timestamp, count = struct.unpack(DETECTIONS_HEADER, message[:header])
+    if kind != DETECTIONS_MESSAGE:
+        raise ValueError("Unknown detections message type %d" % kind)
+    centres = np.frombuffer(message, dtype='>i4', count=2 * count, offset=header).reshape(count, 2).astype(np.int32)
+    return pts, centres[:, 0], centres[:, 1], timestamp
+
+
+# Batch of single-ball coordinates: message type, detection wall-clock time and
+# number of frames, followed by that many big-endian (int64 pts, int32 x, int32 y) records - must match client.py
+BATCH_MESSAGE = 3
+BATCH_HEADER = "!BdI"
+BATCH_RECORD = np.dtype([("pts", ">i8"), ("x", ">i4"), ("y", ">i4")])
+
+
+def unpack_batch(message):
+    """
+    Unpack a binary message holding the coordinates of a batch of frames.
+
+    Parameters
+    ----------
+    message : bytes
+        header of struct.calcsize(BATCH_HEADER) bytes followed by the records
+
+    Returns
+    -------
+    tuple
+        (pts, xs, ys, timestamp) of the batch, pts, xs and ys are int arrays
+    """
+    header = struct.calcsize(BATCH_HEADER)
+    kind, timestamp, count = struct.unpack(BATCH_HEADER, message[:header])
+    if kind != BATCH_MESSAGE:
+        raise ValueError("Unknown batch message type %d" % kind)
+    records = np.frombuffer(message, dtype=BATCH_RECORD, count=count, offset=header)
+    return records["pts"].astype(np.int64), records["x"].astype(np.int64), records["y"].astype(np.int64), timestamp
+
+
+def match_detections(true_x, true_y, rec_x, rec_y, gate):
+    """
+    Greedily pair detections with balls, closest pairs first, each ball and each
+    detection used at most once.
+
+    Parameters
+    ----------
+    true_x, true_y : numpy ndarray
+        ball positions drawn in the frame
+    rec_x, rec_y : numpy ndarray
+        detected centres
+    gate : float
+        largest distance at which a detection can belong to a ball
+
+    Returns
+    -------
+    tuple of numpy ndarrays
+        (ball indices, detection indices, distances) of the matched pairs
+    """
+    true_x, true_y, rec_x, rec_y = (np.asarray(v, dtype=np.int64) for v in (true_x, true_y, rec_x, rec_y))
+    # Candidate pairs are the detections within the gate along x, found on the
+    # x-sorted detections instead of computing every ball to detection distance
+    by_x = np.argsort(rec_x, kind="stable")
+    lo = np.searchsorted(rec_x[by_x], true_x - gate, side="left")
+    hi = np.searchsorted(rec_x[by_x], true_x + gate, side="right")
+    counts = hi - lo
+    balls = np.repeat(np.arange(len(true_x)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    detections = by_x[np.repeat(lo, counts) + offsets]
+    distances = np.hypot(true_x[balls] - rec_x[detections], true_y[balls] - rec_y[detections])
+    inside = distances <= gate
+    balls, detections, distances = balls[inside], detections[inside], distances[inside]
+
+    order = np.argsort(distances, kind="stable")
+    ball_used, detection_used = np.zeros(len(true_x), dtype=bool), np.zeros(len(rec_x), dtype=bool)
+    keep = []
+    for i in order.tolist():
+        ball, detection = balls[i], detections[i]
+        if not ball_used[ball] and not detection_used[detection]:
+            ball_used[ball] = detection_used[detection] = True
+            keep.append(i)
+    keep = np.array(keep, dtype=np.intp)
+    return balls[keep], detections[keep], distances[keep]
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, rendered in the Prometheus text format.
+    ...
+
+    Attributes
+    ----------
+    name : str
+        metric name
+    help : str
+        metric description
+    buckets : tuple of floats
+        upper bounds of the buckets, +Inf is implied
+    counts : list of ints
+        observations per bucket, the last one is +Inf
+    sum : float
+        sum of the observations
+    count : int
+        number of observations
+
+    Methods
+    -------
+    observe : Add one observation.
+    reset : Forget every observation.
+    quantile : Estimate a quantile by interpolating inside its bucket.
+    render : Prometheus text lines of the histogram.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        """
+        Constructs all the necessary attributes for the Histogram object.
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # observe is called from the event loop and from helper threads
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Method responsible to add one observation.
+        """
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def reset(self):
+        """
+        Method responsible to forget every observation.
+        """
+        with self.lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.sum = 0.0
+            self.count = 0
+
+    def quantile(self, q):
+        """
+        Method responsible to estimate a quantile, NaN when there is no observation.
+
+        Parameters
+        ----------
+        q : float
+            quantile between 0 and 1
+
+        Returns
+        -------
+        float
+            estimate, linearly interpolated inside the bucket holding the quantile
+        """
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        cumulative, lower = 0, 0.0
+        for bound, n in zip(self.buckets, self.counts):
+            if n and cumulative + n >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / n
+            cumulative += n
+            lower = bound
+        # Quantile is in the +Inf bucket, the largest finite bound is the best estimate
+        return lower
+
+    def render(self):
+        """
+        Method responsible to return the Prometheus text lines of the histogram.
+        """
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, bound, cumulative))
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, self.count))
+        lines.append("%s_sum %s" % (self.name, self.sum))
+        lines.append("%s_count %d" % (self.name, self.count))
+        return lines
+
+
+class Counter:
+    """
+    Monotonic counter, rendered in the Prometheus text format.
+    ...
+
+    Attributes
+    ----------
+    name : str
+        metric name
+    help : str
+        metric description
+    value : float
+        current value
+    function : callable
+        if set, called at scrape time to read the value instead
+
+    Methods
+    -------
+    inc : Increase the counter.
+    reset : Set the counter back to zero.
+    render : Prometheus text lines of the counter.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, function=None):
+        """
+        Constructs all the necessary attributes for the Counter object.
+        """
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        """
+        Method responsible to increase the counter.
+        """
+        self.value += amount
+
+    def reset(self):
+        """
+        Method responsible to set the counter back to zero, counters read through
+        a function are left alone.
+        """
+        self.value = 0
+
+    def get(self):
+        """
+        Method responsible to return the current value.
+        """
+        return self.function() if self.function is not None else self.value
+
+    def render(self):
+        """
+        Method responsible to return the Prometheus text lines of the metric.
+        """
+        return ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind), "%s %s" % (self.name, self.get())]
+
+
+class Gauge(Counter):
+    """
+    Value which can go up and down, rendered in the Prometheus text format.
+
+    Methods
+    -------
+    set : Set the value.
+    tick : Count one event and update the value to the event rate per second.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, function=None):
+        """
+        Constructs all the necessary attributes for the Gauge object.
+        """
+        super().__init__(name, help, function)
+        self.window_start = None
+        self.window_count = 0
+
+    def set(self, value):
+        """
+        Method responsible to set the value.
+        """
+        self.value = value
+
+    def tick(self, interval=1.0):
+        """
+        Method responsible to count one event and refresh the rate (events per second)
+        once every interval seconds.
+        """
+        now = time.perf_counter()
+        if self.window_start is None:
+            self.window_start = now
+            return
+        self.window_count += 1
+        elapsed = now - self.window_start
+        if elapsed >= interval:
+            self.value = self.window_count / elapsed
+            self.window_start, self.window_count = now, 0
+
+
+class Metrics:
+    """
+    Registry of the process metrics with an optional local HTTP endpoint which
+    serves them in the Prometheus text format.
+    ...
+
+    Attributes
+    ----------
+    metrics : OrderedDict
+        name -> Histogram, Counter or Gauge
+
+    Methods
+    -------
+    histogram, counter, gauge : Register a metric, or return the one with that name.
+    stage : Register the wall-clock and CPU time histograms of a stage, as a StageTimer.
+    render : Prometheus text exposition of every metric.
+    snapshot : Plain dict of every metric, with p50/p99 for histograms.
+    reset : Reset every metric, e.g. at the end of a warm-up.
+    serve : Start the HTTP endpoint.
+    """
+
+    def __init__(self):
+        """
+        Constructs all the necessary attributes for the Metrics object.
+        """
+        self.metrics = OrderedDict()
+
+    def _register(self, cls, name, *args):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, *args)
+        return self.metrics[name]
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, buckets)
+
+    def counter(self, name, help, function=None):
+        return self._register(Counter, name, help, function)
+
+    def gauge(self, name, help, function=None):
+        return self._register(Gauge, name, help, function)
+
+    def stage(self, name, help):
+        return StageTimer(self.histogram(name + "_wall_seconds", "Wall-clock time of " + help),
+                          self.histogram(name + "_cpu_seconds", "CPU time of the calling thread in " + help))
+
+    def render(self):
+        """
+        Method responsible to return the Prometheus text exposition of every metric.
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """
+        Method responsible to reset every metric.
+        """
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def snapshot(self):
+        """
+        Method responsible to return every metric as plain values, histograms as
+        count, mean, p50 and p99.
+        """
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            if metric.kind == "histogram":
+                snapshot[name] = {
+                    "count": metric.count,
+                    "mean": metric.sum / metric.count if metric.count else math.nan,
+                    "p50": metric.quantile(0.5),
+                    "p99": metric.quantile(0.99),
+                }
+            else:
+                snapshot[name] = metric.get()
+        return snapshot
+
+    async def serve(self, port, host="127.0.0.1", profiler=None):
+        """
+        Method responsible to serve the metrics over HTTP on a local port.
+
+        Parameters
+        ----------
+        port : int
+            port of the endpoint, any path returns the metrics except /profile
+        host : str
+            address to bind, local only by default
+        profiler : obj of class 'ProfileCapture'
+            if set, /profile?seconds=N profiles the event loop for N seconds and
+            returns the path of the pstats file once it is written
+
+        Returns
+        -------
+        obj of class 'asyncio.Server'
+        """
+        async def handle(reader, writer):
+            try:
+                target = (await reader.readline()).split()[1:2]
+                # Headers are not needed
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                status, content_type = b"200 OK", b"text/plain; version=0.0.4"
+                path, _, query = (target[0].decode("latin-1") if target else "/").partition("?")
+                if path == "/profile" and profiler is not None:
+                    options = dict(option.partition("=")[::2] for option in query.split("&") if option)
+                    try:
+                        seconds = float(options.get("seconds", profiler.seconds))
+                    except ValueError:
+                        seconds = math.nan
+                    if not 0 < seconds < math.inf:
+                        status, written = b"400 Bad Request", "seconds should be a positive finite number"
+                    else:
+                        written = await profiler.capture(seconds)
+                        if written is None:
+                            status, written = b"409 Conflict", "a capture is already running"
+                    body, content_type = (written + "\n").encode("utf8"), b"text/plain"
+                else:
+                    body = self.render().encode("utf8")
+                writer.write(b"HTTP/1.1 %s\r\n"
+                             b"Content-Type: %s\r\n"
+                             b"Content-Length: %d\r\n"
+                             b"Connection: close\r\n\r\n" % (status, content_type, len(body)) + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host=host, port=port)
+
+
+class StageTimer:
+    """
+    Wall-clock and CPU time of one stage, cheap enough to leave on in every hot
+    path: two clock reads at each end and two histogram observations.
+    ...
+
+    Attributes
+    ----------
+    wall : obj of class 'Histogram'
+        time.perf_counter() duration of the stage
+    cpu : obj of class 'Histogram'
+        time.thread_time() duration, the CPU the calling thread spent in the stage
+
+    Methods
+    -------
+    start : Both clocks, handed back to stop.
+    stop : Observe the time since start.
+    __call__ : Decorate a function so every call is timed.
+    """
+
+    def __init__(self, wall, cpu):
+        """
+        Constructs all the necessary attributes for the StageTimer object.
+
+        Parameters
+        ----------
+        wall, cpu : obj of class 'Histogram'
+            wall-clock and CPU time histograms
+        """
+        self.wall = wall
+        self.cpu = cpu
+
+    def start(self):
+        return time.perf_counter(), time.thread_time()
+
+    def stop(self, started):
+        self.wall.observe(time.perf_counter() - started[0])
+        self.cpu.observe(time.thread_time() - started[1])
+
+    def __call__(self, function):
+        # The start is kept on the stack, so render threads can share one timer
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter(), time.thread_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stop(started)
+        return timed
+
+
+class ProfileCapture:
+    """
+    Time-boxed cProfile capture of a running process, written as a pstats file
+    (python -m pstats FILE, or any pstats viewer). cProfile only follows the
+    thread which starts it: the event loop, or a detector worker's main thread.
+    ...
+
+    Attributes
+    ----------
+    name : str
+        prefix of the file names
+    directory : str
+        where the captures are written
+    seconds : float
+        duration of a capture started by the signal
+    profiler : obj of class 'cProfile.Profile'
+        the running capture, None between captures
+    path : str
+        file the running capture is written to
+    deadline : float
+        time.monotonic() at which the running capture ends
+    report : callable
+        receives the message naming each file written, print or a logger method
+
+    Methods
+    -------
+    install : Start a capture on SIGUSR1.
+    start : Start profiling the calling thread.
+    stop : Stop the capture and write it.
+    poll : Stop the capture once its time is up, for threads without an event loop.
+    capture : Profile the event loop for a number of seconds.
+    """
+
+    def __init__(self, name, directory=".", seconds=10.0, report=print):
+        """
+        Constructs all the necessary attributes for the ProfileCapture object.
+
+        Parameters
+        ----------
+        name : str
+            prefix of the file names
+        directory : str
+            where the captures are written
+        seconds : float
+            duration of a capture started by the signal
+        report : callable
+            receives the message naming each file written
+        """
+        self.name = name
+        self.directory = directory
+        self.seconds = seconds
+        self.report = report
+        self.profiler = None
+        self.path = None
+        self.deadline = math.inf
+
+    def install(self, loop=None, name=None):
+        """
+        Method responsible to start a capture whenever the process gets SIGUSR1.
+
+        Parameters
+        ----------
+        loop : obj of class 'asyncio.get_event_loop'
+            event loop which stops the capture on time, None for a process which calls poll
+        name : str
+            new prefix of the file names, e.g. in a forked worker
+        """
+        if name is not None:
+            self.name = name
+        if loop is not None:
+            loop.add_signal_handler(signal.SIGUSR1, self._on_signal, loop)
+            return
+        if self.profiler is not None:
+            # Forked while the parent was profiling, that capture is not ours
+            self.profiler.disable()
+            self.profiler = None
+        # A forked child shares the parent loop's wakeup fd, which would start a capture there too
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.start())
+
+    def _on_signal(self, loop):
+        if self.start() is not None:
+            loop.call_later(self.seconds, self.stop)
+
+    def start(self, seconds=None):
+        """
+        Method responsible to start profiling the calling thread.
+
+        Parameters
+        ----------
+        seconds : float
+            duration of the capture, self.seconds if None
+
+        Returns
+        -------
+        str
+            file the capture will be written to, None if one is already running
+        """
+        if self.profiler is not None:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, "%s-%d-%s.pstats" % (self.name, os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        self.deadline = time.monotonic() + (self.seconds if seconds is None else seconds)
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return self.path
+
+    def stop(self):
+        """
+        Method responsible to stop the running capture and write its pstats file.
+
+        Returns
+        -------
+        str
+            the file written, None if no capture was running
+        """
+        if self.profiler is None:
+            return None
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path)
+        self.profiler = None
+        self.report("Profile written to %s" % self.path)
+        return self.path
+
+    def poll(self):
+        if time.monotonic() >= self.deadline and self.profiler is not None:
+            self.stop()
+
+    async def capture(self, seconds):
+        """
+        Method responsible to profile the event loop for a number of seconds.
+
+        Returns
+        -------
+        str
+            the file written, None if a capture was already running
+        """
+        path = self.start(seconds)
+        if path is None:
+            return None
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.stop()
+        return path
+
+METRICS = Metrics()
+# Started with SIGUSR1 or the metrics endpoint's /profile, configured by --profile-dir
+PROFILER = ProfileCapture("server", report=logger.info)
+
+
+# Server side stages, scraped with --metrics-port
+PIXEL_BUCKETS = (0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+FRAMES_SENT = METRICS.counter("ball_server_frames_sent_total", "Frames handed to the video sender")
+COORDINATES_RECEIVED = METRICS.counter("ball_server_coordinates_received_total", "Coordinate messages received from the clients")
+COORDINATES_UNMATCHED = METRICS.counter("ball_server_coordinates_unmatched_total", "Coordinates whose frame was no longer in the position history")
+SEND_FPS = METRICS.gauge("ball_server_send_fps", "Frames handed to the video sender per second")
+RENDER_SECONDS = METRICS.histogram("ball_server_render_seconds", "Time to draw one frame")
+CONVERT_SECONDS = METRICS.histogram("ball_server_convert_seconds", "Time to wrap a drawn frame in a VideoFrame")
+ENCODE_SECONDS = METRICS.histogram("ball_server_encode_seconds", "Time from a frame leaving the track to the sender asking for the next one - encode and packetize")
+FRAME_TO_DETECTION_SECONDS = METRICS.histogram("ball_server_frame_to_detection_seconds", "Time from a frame being sent to its detection finishing on the client")
+DETECTION_TO_SERVER_SECONDS = METRICS.histogram("ball_server_detection_to_server_seconds", "Time from a detection finishing to its coordinates reaching the server")
+ROUND_TRIP_SECONDS = METRICS.histogram("ball_server_round_trip_seconds", "Time from a frame being sent to its coordinates reaching the server")
+ERROR_SECONDS = METRICS.histogram("ball_server_error_seconds", "Time to match a coordinate message and compute its error")
+BALLS_MISSED = METRICS.counter("ball_server_balls_missed_total", "Balls of a scene frame without a matching detection")
+DETECTIONS_SPURIOUS = METRICS.counter("ball_server_detections_spurious_total", "Detections of a scene frame not matching any ball")
+TIME_TO_FIRST_FRAME = METRICS.histogram("ball_server_time_to_first_frame_seconds", "Time from a session's offer to its first frame handed to the sender")
+TIME_TO_FIRST_COORDINATE = METRICS.histogram("ball_server_time_to_first_coordinate_seconds", "Time from a session's offer to its first coordinate message")
+SESSIONS = METRICS.counter("ball_server_sessions_total", "Sessions offered, each on a new peer connection")
+DEADLINES_MISSED = METRICS.counter("ball_server_deadlines_missed_total", "Frames handed to the sender after their pacing deadline")
+FRAMES_SKIPPED = METRICS.counter("ball_server_frames_skipped_total", "Frame slots skipped by the pacing clock to catch up")
+PACING_LATENESS_SECONDS = METRICS.histogram("ball_server_pacing_lateness_seconds", "How late a frame that missed its deadline was handed out, after skipping")
+REPLAY_CACHE_HITS = METRICS.counter("ball_server_replay_cache_hits_total", "Replayed frames served from the decoded frame cache")
+REPLAY_CACHE_MISSES = METRICS.counter("ball_server_replay_cache_misses_total", "Replayed frames decoded because they were not cached")
+DECODE_SECONDS = METRICS.histogram("ball_server_replay_decode_seconds", "Time to decode or read one replayed frame, off the event loop")
+FRAME_POOL_ALLOCATIONS = METRICS.counter("ball_server_frame_pool_allocations_total", "VideoFrame buffers allocated because every pooled buffer was still in use")
+ERROR_PIXELS = METRICS.histogram("ball_server_error_pixels", "Distance between the detected and the true ball position", PIXEL_BUCKETS)
+STAGE_GENERATE_FRAME = METRICS.stage("ball_server_stage_generate_frame", "FrameGenerator.generateFrame")
+STAGE_RECV = METRICS.stage("ball_server_stage_recv", "FrameGenerator.recv after the pacing wait, a prefetched frame included")
+STAGE_ON_MESSAGE = METRICS.stage("ball_server_stage_on_message", "the coordinate message handler")
+
+
+class PositionHistory:
+    """
+    Bounded history of the ground-truth ball position of every frame sent, keyed
+    by the frame pts, so a detection is compared with the frame it was made on.
+    ...
+
+    Attributes
+    ----------
+    size : int
+        number of frames remembered
+    positions : OrderedDict
+        pts -> (ball_x, ball_y, send time) of the most recent frames, x and y are
+        arrays holding every ball for a scene
+    tolerance : int
+        pts ticks a lookup may be off by, the decoder can round a pts down by a tick
+
+    Methods
+    -------
+    add : Remember the ball position of a frame, forgetting the oldest one if full.
+    get : Ball position of a frame, None if it is not remembered anymore.
+    """
+
+    def __init__(self, size=300, tolerance=2):
+        """
+        Constructs all the necessary attributes for the PositionHistory object.
+
+        Parameters
+        ----------
+        size : int
+            number of frames remembered, 300 is 10 seconds at 30 fps
+        tolerance : int
+            pts ticks a lookup may be off by
+        """
+        if size < 1:
+            raise ValueError("PositionHistory size should be at least 1")
+        self.size = size
+        self.tolerance = tolerance
+        self.positions = OrderedDict()
+
+    def add(self, pts, x, y, sent):
+        """
+        Method responsible to remember the ball position of a frame.
+
+        Parameters
+        ----------
+        pts : int
+            presentation timestamp of the frame
+        x, y : int or numpy ndarray
+            ball position drawn in the frame, or the positions of all balls of a scene
+        sent : float
+            wall-clock time at which the frame was handed to the encoder
+        """
+        self.positions[pts] = (x, y, sent)
+        if len(self.positions) > self.size:
+            self.positions.popitem(last=False)
+
+    def get(self, pts):
+        """
+        Method responsible to return the (ball_x, ball_y, send time) of a frame, None if forgotten.
+        """
+        truth = self.positions.get(pts)
+        if truth is None:
+            # Timebase conversions in the decoder truncate, look at the neighbouring ticks
+            for delta in range(1, self.tolerance + 1):
+                truth = self.positions.get(pts + delta) or self.positions.get(pts - delta)
+                if truth is not None:
+                    break
+        return truth
+
+
+class BallRenderer:
+    """
+    Renders the ball into one preallocated canvas, erasing only the ball's
+    previous bounding box and blitting a cached pre-rendered sprite at the new
+    position. Output is identical to drawing the ball with cv2.circle on a new
+    black frame.
+    ...
+
+    Attributes
+    ----------
+    canvas : numpy ndarray
+        frame reused by every render call
+    radius : int
+        ball radius
+    sprite : numpy ndarray
+        (2*radius+1, 2*radius+1, channel) ball drawn with cv2.circle
+    mask : numpy ndarray
+        boolean mask of the ball pixels in the sprite
+    previous : tuple of ints
+        (y0, y1, x0, x1) region of the canvas covered by the last blit
+
+    Methods
+    -------
+    render : Move the ball to a new position and return the canvas.
+    """
+
+    format = "bgr24"
+
+    def __init__(self, image_shape, dtype, radius, color):
+        """
+        Constructs all the necessary attributes for the BallRenderer object.
+
+        Parameters
+        ----------
+        image_shape : tuple of ints
+            (height, width, channel) of the image to be generated
+        dtype : str
+            dtype of the image to be generated
+        radius : int
+            ball radius
+        color : tuple of ints
+            ball color in bgr color space
+        """
+        self.canvas = np.zeros(image_shape, dtype=dtype)
+        self.radius = radius
+
+        size = 2 * radius + 1
+        self.sprite = np.zeros((size, size, image_shape[2]), dtype=dtype)
+        cv2.circle(self.sprite, (radius, radius), radius, color, -1)
+        mask = np.zeros((size, size), dtype=np.uint8)
+        cv2.circle(mask, (radius, radius), radius, 255, -1)
+        self.mask = (mask > 0)[:, :, None]
+        self.previous = None
+
+    def render(self, x, y):
+        """
+        Method responsible to erase the ball from its previous position and draw it at (x, y).
+
+        Parameters
+        ----------
+        x, y : int
+            ball centre, the sprite is clipped at the canvas borders
+
+        Returns
+        -------
+        canvas : numpy ndarray
+            the shared canvas, overwritten by the next render call
+        """
+        if self.previous is not None:
+            y0, y1, x0, x1 = self.previous
+            self.canvas[y0:y1, x0:x1] = 0
+
+        height, width = self.canvas.shape[:2]
+        r = self.radius
+        y0, y1 = max(y - r, 0), min(y + r + 1, height)
+        x0, x1 = max(x - r, 0), min(x + r + 1, width)
+        if y0 >= y1 or x0 >= x1:
+            # Ball entirely outside the canvas
+            self.previous = None
+            return self.canvas
+
+        sy0, sx0 = y0 - (y - r), x0 - (x - r)
+        sy1, sx1 = sy0 + (y1 - y0), sx0 + (x1 - x0)
+        np.copyto(self.canvas[y0:y1, x0:x1], self.sprite[sy0:sy1, sx0:sx1], where=self.mask[sy0:sy1, sx0:sx1])
+        self.previous = (y0, y1, x0, x1)
+        return self.canvas
+
+
+class YuvBallRenderer:
+    """
+    Renders the ball straight into the planes of a yuv420p frame, the format the
+    video encoder works in, so no frame is converted from BGR. Like BallRenderer
+    only the ball's previous bounding box is erased on every call.
+    ...
+
+    Attributes
+    ----------
+    canvas : numpy ndarray
+        (height * 3 / 2, width) uint8 frame holding the Y, U and V planes one after the other
+    planes : tuple of numpy ndarrays
+        (height, width) Y, (height / 2, width / 2) U and V views of the canvas
+    radius : int
+        ball radius
+    color : tuple of ints
+        (Y, U, V) of the ball
+    background : tuple of ints
+        (Y, U, V) of black
+    previous : tuple of ints
+        (y0, y1, x0, x1) region of the Y plane covered by the last ball
+
+    Methods
+    -------
+    render : Move the ball to a new position and return the canvas.
+    """
+
+    format = "yuv420p"
+
+    def __init__(self, image_shape, dtype, radius, color):
+        """
+        Constructs all the necessary attributes for the YuvBallRenderer object.
+
+        Parameters
+        ----------
+        image_shape : tuple of ints
+            (height, width, channel) of the image to be generated, even height and width
+        dtype : str
+            unused, yuv420p planes are always uint8
+        radius : int
+            ball radius
+        color : tuple of ints
+            ball color in bgr color space
+        """
+        height, width = image_shape[:2]
+        if height % 2 or width % 2:
+            raise ValueError("yuv420p frames need an even height and width")
+        self.canvas = np.empty((height * 3 // 2, width), dtype=np.uint8)
+        flat, luma, chroma = self.canvas.reshape(-1), height * width, (height // 2) * (width // 2)
+        self.planes = (
+            self.canvas[:height],
+            flat[luma:luma + chroma].reshape(height // 2, width // 2),
+            flat[luma + chroma:].reshape(height // 2, width // 2),
+        )
+        self.radius = radius
+        self.color = self._yuv(color)
+        self.background = self._yuv((0, 0, 0))
+        for plane, value in zip(self.planes, self.background):
+            plane[:] = value
+        self.previous = None
+
+    @staticmethod
+    def _yuv(color):
+        """
+        Method responsible to convert a bgr color to its (Y, U, V) values, same BT.601
+        limited range as the encoder's own conversion.
+        """
+        i420 = cv2.cvtColor(np.full((2, 2, 3), color, dtype=np.uint8), cv2.COLOR_BGR2YUV_I420)
+        return int(i420[0, 0]), int(i420[2, 0]), int(i420[2, 1])
+
+    def render(self, x, y):
+        """
+        Method responsible to erase the ball from its previous position and draw it at (x, y).
+
+        Parameters
+        ----------
+        x, y : int
+            ball centre
+
+        Returns
+        -------
+        canvas : numpy ndarray
+            the shared yuv420p canvas, overwritten by the next render call
+        """
+        luma, u, v = self.planes
+        if self.previous is not None:
+            y0, y1, x0, x1 = self.previous
+            luma[y0:y1, x0:x1] = self.background[0]
+            # Chroma rows and columns cover two luma rows and columns each
+            for plane, value in zip((u, v), self.background[1:]):
+                plane[y0 // 2:(y1 + 1) // 2, x0 // 2:(x1 + 1) // 2] = value
+
+        r = self.radius
+        cv2.circle(luma, (x, y), r, self.color[0], -1)
+        cv2.circle(u, (x // 2, y // 2), r // 2, self.color[1], -1)
+        cv2.circle(v, (x // 2, y // 2), r // 2, self.color[2], -1)
+
+        height, width = luma.shape
+        self.previous = (max(y - r, 0), min(y + r + 1, height), max(x - r, 0), min(x + r + 1, width))
+        return self.canvas
+
+
+class BallTrajectory:
+    """
+    Closed-form ball motion, the position after any number of frames is computed
+    directly instead of stepping through every bounce.
+
+    The ball moves on a lattice of step |velocity| and reverses on the first lattice
+    point at or past a wall, so each axis is a triangle wave between those two
+    turning points: unfold the motion along a line and reflect it modulo twice
+    the distance between them. This matches FrameGenerator.step exactly.
+    ...
+
+    Attributes
+    ----------
+    axes : list of tuples
+        (low turning point, distance between turning points, start offset,
+        initial direction, step) for x and y
+
+    Methods
+    -------
+    state : Ball position and velocity after n frames.
+    """
+
+    def __init__(self, image_shape, ball_pos, velocity, radius):
+        """
+        Constructs all the necessary attributes for the BallTrajectory object.
+
+        Parameters
+        ----------
+        image_shape : tuple of ints
+            (height, width, channel) of the image
+        ball_pos : list of ints
+            (ball_x, ball_y) position of the ball at frame 0
+        velocity : list of ints
+            (dx, dy) rate of change of ball's position at frame 0
+        radius : int
+            ball radius
+        """
+        height, width = image_shape[:2]
+        self.axes = [
+            self._axis(ball_pos[0], velocity[0], radius, width - radius),
+            self._axis(ball_pos[1], velocity[1], radius, height - radius),
+        ]
+
+    @staticmethod
+    def _axis(start, velocity, low, high):
+        """
+        Method responsible to compute the turning points of one axis.
+        """
+        if not low < start < high:
+            raise ValueError("Ball should start strictly inside the walls")
+        step = abs(velocity)
+        if step == 0:
+            return (start, 0, 0, 0, 0)
+        turn_low = low - ((low - start) % step)
+        turn_high = high + ((start - high) % step)
+        return (turn_low, turn_high - turn_low, start - turn_low, 1 if velocity > 0 else -1, step)
+
+    def state(self, n):
+        """
+        Method responsible to return the ball position and velocity after n frames.
+
+        Parameters
+        ----------
+        n : int
+            number of FrameGenerator.step calls since frame 0
+
+        Returns
+        -------
+        tuple of ints
+            (ball_x, ball_y, dx, dy)
+        """
+        positions, velocities = [], []
+        for turn_low, length, offset, direction, step in self.axes:
+            if step == 0:
+                positions.append(turn_low)
+                velocities.append(0)
+                continue
+            m = (offset + direction * n * step) % (2 * length)
+            positions.append(turn_low + (m if m <= length else 2 * length - m))
+            # The velocity is already reversed on the turning point itself
+            if direction > 0:
+                velocities.append(step if m < length else -step)
+            else:
+                velocities.append(-step if 0 < m <= length else step)
+        return positions[0], positions[1], velocities[0], velocities[1]
+
+
+class BallScene:
+    """
+    Any number of bouncing balls stored in NumPy arrays, all moved and bounced
+    off the walls in one vectorized step with the same rule as
+    FrameGenerator.step uses for a single ball.
+    ...
+
+    Attributes
+    ----------
+    image_shape : tuple of ints
+        (height, width, channel) of the image
+    positions : numpy ndarray
+        (n, 2) int (x, y) centres
+    velocities : numpy ndarray
+        (n, 2) int (dx, dy) per frame
+    radii : numpy ndarray
+        (n,) int radii
+    colors : numpy ndarray
+        (n, 3) uint8 bgr colors
+
+    Methods
+    -------
+    random : Scene of n balls placed inside the walls with random speed, size and color.
+    step : Move every ball by one frame.
+    """
+
+    def __init__(self, image_shape, positions, velocities, radii, colors):
+        """
+        Constructs all the necessary attributes for the BallScene object.
+
+        Parameters
+        ----------
+        image_shape : tuple of ints
+            (height, width, channel) of the image
+        positions : array_like
+            (n, 2) (x, y) centres
+        velocities : array_like
+            (n, 2) (dx, dy) per frame
+        radii : array_like
+            (n,) radii
+        colors : array_like
+            (n, 3) bgr colors
+        """
+        self.image_shape = image_shape
+        self.positions = np.array(positions, dtype=np.int64).reshape(-1, 2)
+        self.velocities = np.array(velocities, dtype=np.int64).reshape(-1, 2)
+        self.radii = np.array(radii, dtype=np.int64).reshape(-1)
+        self.colors = np.array(colors, dtype=np.uint8).reshape(-1, 3)
+        if not len(self.positions) == len(self.velocities) == len(self.radii) == len(self.colors):
+            raise ValueError("BallScene needs a position, velocity, radius and color per ball")
+
+    @classmethod
+    def random(cls, image_shape, count, radius=20, speed=4, seed=None):
+        """
+        Method responsible to create a scene of random balls.
+
+        Parameters
+        ----------
+        image_shape : tuple of ints
+            (height, width, channel) of the image
+        count : int
+            number of balls
+        radius : int
+            largest radius, radii are drawn between radius / 2 and radius
+        speed : int
+            largest speed along each axis, in pixels per frame
+        seed : int
+            seed of the random generator, None for a different scene every time
+
+        Returns
+        -------
+        obj of class 'BallScene'
+        """
+        height, width = image_shape[:2]
+        if count < 1 or 2 * radius + 2 >= min(height, width):
+            raise ValueError("BallScene needs at least one ball which fits in the image")
+        rng = np.random.default_rng(seed)
+        radii = rng.integers(max(radius // 2, 2), radius + 1, count)
+        positions = np.stack([rng.integers(radii + 1, width - radii - 1), rng.integers(radii + 1, height - radii - 1)], axis=1)
+        velocities = rng.integers(1, speed + 1, (count, 2)) * rng.choice([-1, 1], (count, 2))
+        # Bright colors so every ball clears the detector threshold, also on the luma plane
+        colors = rng.integers(128, 256, (count, 3))
+        return cls(image_shape, positions, velocities, radii, colors)
+
+    def __len__(self):
+        return len(self.radii)
+
+    def step(self):
+        """
+        Method responsible to move every ball and reverse its velocity on collision with a wall.
+        """
+        height, width = self.image_shape[:2]
+        self.positions += self.velocities
+        x, y = self.positions[:, 0], self.positions[:, 1]
+        self.velocities[(y >= height - self.radii) | (y - self.radii <= 0), 1] *= -1
+        self.velocities[(x >= width - self.radii) | (x - self.radii <= 0), 0] *= -1
+
+
+class SceneRenderer:
+    """
+    Draws a BallScene into one preallocated canvas, in bgr24 or straight into
+    yuv420p planes. The whole canvas is cleared every frame, with many balls
+    there is little to gain from dirty rectangles.
+    ...
+
+    Attributes
+    ----------
+    format : str
+        'bgr24' or 'yuv420p'
+    canvas : numpy ndarray
+        frame reused by every render call
+    planes : tuple of numpy ndarrays
+        Y, U and V views of the canvas for yuv420p, the canvas itself for bgr24
+
+    Methods
+    -------
+    render : Draw every ball of the scene and return the canvas.
+    """
+
+    def __init__(self, image_shape, dtype, format="yuv420p"):
+        """
+        Constructs all the necessary attributes for the SceneRenderer object.
+
+        Parameters
+        ----------
+        image_shape : tuple of ints
+            (height, width, channel) of the image to be generated
+        dtype : str
+            dtype of the bgr24 image, yuv420p planes are always uint8
+        format : str
+            'bgr24' or 'yuv420p'
+        """
+        if format not in ("bgr24", "yuv420p"):
+            raise ValueError("format should be 'bgr24' or 'yuv420p'")
+        self.format = format
+        if format == "bgr24":
+            self.canvas = np.zeros(image_shape, dtype=dtype)
+            self.planes = (self.canvas,)
+            self.background = (0,)
+        else:
+            # Reuse the plane layout and colors of the single ball renderer
+            yuv = YuvBallRenderer(image_shape, dtype, 0, (0, 0, 0))
+            self.canvas, self.planes, self.background = yuv.canvas, yuv.planes, yuv.background
+
+    @staticmethod
+    def _yuv(colors):
+        """
+        Method responsible to convert (n, 3) bgr colors to (n, 3) (Y, U, V) values in one call.
+        """
+        n = len(colors)
+        # Every color fills a 2x2 block, so it gets one U and one V sample of its own
+        blocks = np.repeat(np.repeat(colors[None, :, :], 2, axis=0), 2, axis=1)
+        i420 = cv2.cvtColor(blocks, cv2.COLOR_BGR2YUV_I420).reshape(-1)
+        return np.stack([i420[0:2 * n:2], i420[4 * n:5 * n], i420[5 * n:6 * n]], axis=1)
+
+    def render(self, scene):
+        """
+        Method responsible to draw the scene.
+
+        Parameters
+        ----------
+        scene : obj of class 'BallScene'
+            balls to draw
+
+        Returns
+        -------
+        canvas : numpy ndarray
+            the shared canvas, overwritten by the next render call
+        """
+        for plane, value in zip(self.planes, self.background):
+            plane[:] = value
+        positions, radii = scene.positions.tolist(), scene.radii.tolist()
+        if self.format == "bgr24":
+            for (x, y), r, color in zip(positions, radii, scene.colors.tolist()):
+                cv2.circle(self.canvas, (x, y), r, color, -1)
+            return self.canvas
+
+        luma, u, v = self.planes
+        for (x, y), r, (cy, cu, cv) in zip(positions, radii, self._yuv(scene.colors).tolist()):
+            cv2.circle(luma, (x, y), r, cy, -1)
+            cv2.circle(u, (x // 2, y // 2), r // 2, cu, -1)
+            cv2.circle(v, (x // 2, y // 2), r // 2, cv, -1)
+        return self.canvas
+
+
+class VideoFramePool:
+    """
+    Class responsible to reuse the image buffers of the VideoFrames handed to the
+    sender: a rendered image is copied into a pooled buffer which a new frame
+    wraps with VideoFrame.from_numpy_buffer, instead of VideoFrame.from_ndarray
+    allocating new buffers every time. libav holds the buffer until its last
+    reference to the frame is gone, only then is the buffer back in the pool, so
+    the sender, the relay and the encoder are done with it.
+    ...
+
+    Attributes
+    ----------
+    width, height : int
+        size of the frames
+    format : str
+        'yuv420p' or 'bgr24' pixel format of the frames and of the wrapped images
+    size : int
+        most buffers kept, a buffer allocated while all of them are in use is not pooled
+    free : obj of class 'collections.deque'
+        pooled buffers no frame holds, given back from whichever thread drops the last frame
+    pooled : int
+        buffers owned by the pool, free or held by a frame
+    allocated : int
+        buffers allocated, the pooled ones included
+    lock : obj of class 'threading.Lock'
+        guards the counters, render threads wrap concurrently
+
+    Methods
+    -------
+    wrap : Copy an image into a free buffer of the pool.
+    """
+
+    def __init__(self, width, height, format="yuv420p", size=8):
+        """
+        Constructs all the necessary attributes for the VideoFramePool object.
+
+        Parameters
+        ----------
+        width, height : int
+            size of the frames
+        format : str
+            'yuv420p' or 'bgr24'
+        size : int
+            most buffers kept
+        """
+        if format not in ("yuv420p", "bgr24"):
+            raise ValueError("format should be 'yuv420p' or 'bgr24'")
+        self.width = width
+        self.height = height
+        self.format = format
+        # from_numpy_buffer reads the height of a yuv420p canvas as rows // 6 * 4
+        self.size = size if format == "bgr24" or height % 4 == 0 else 0
+        self.free = deque()
+        self.pooled = 0
+        self.allocated = 0
+        self.lock = threading.Lock()
+
+    def _allocate(self, image):
+        """
+        Method responsible to copy an image into a new frame the pool doesn't track.
+        """
+        frame = VideoFrame(self.width, self.height, self.format)
+        width, height = self.width, self.height
+        if self.format == "bgr24":
+            sources = (image.reshape(height, width * 3),)
+        else:
+            flat, luma, chroma = image.reshape(-1), height * width, (height // 2) * (width // 2)
+            sources = (image[:height],
+                       flat[luma:luma + chroma].reshape(height // 2, width // 2),
+                       flat[luma + chroma:].reshape(height // 2, width // 2))
+        for plane, source in zip(frame.planes, sources):
+            # Rows may be padded up to line_size
+            rows = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+            np.copyto(rows[:, :source.shape[1]], source)
+        return frame
+
+    def wrap(self, image):
+        """
+        Method responsible to copy an image into a free pooled buffer and wrap it in a new frame.
+
+        Parameters
+        ----------
+        image : numpy ndarray
+            (height * 3 / 2, width) yuv420p canvas or (height, width, 3) bgr24 image
+
+        Returns
+        -------
+        obj of class 'VideoFrame'
+            frame holding the image, its pts still have to be set
+        """
+        try:
+            buffer = self.free.popleft()
+        except IndexError:
+            with self.lock:
+                self.allocated += 1
+                pooled = self.pooled < self.size
+                self.pooled += pooled
+            FRAME_POOL_ALLOCATIONS.inc()
+            if not pooled:
+                return self._allocate(image)
+            buffer = np.empty(image.shape, np.uint8)
+        # The canvas already has the layout of the frame's planes
+        np.copyto(buffer, image)
+        # A view per frame: it dies with the last reference libav holds, which gives the buffer back
+        view = buffer.view()
+        weakref.finalize(view, self.free.append, buffer)
+        return VideoFrame.from_numpy_buffer(view, format=self.format)
+
+
+class FramePrefetcher:
+    """
+    Renders upcoming frames on a thread pool into a bounded buffer, so the event
+    loop only picks up a ready VideoFrame.
+    ...
+
+    Attributes
+    ----------
+    trajectory : obj of class 'BallTrajectory'
+        ball position of any frame
+    depth : int
+        number of frames rendered ahead of the one being sent
+    executor : obj of class 'concurrent.futures.ThreadPoolExecutor'
+        render threads
+    renderers : obj of class 'queue.Queue'
+        one renderer per render thread
+    frames : obj of class 'VideoFramePool'
+        frames the renderers' images are copied into
+    pending : dict
+        frame index -> future of (VideoFrame, (ball_x, ball_y))
+
+    Methods
+    -------
+    get : VideoFrame of a frame index, scheduling the following ones.
+    close : Stop the render threads.
+    """
+
+    def __init__(self, trajectory, image_shape, dtype, radius, color, depth=4, threads=2, renderer=BallRenderer):
+        """
+        Constructs all the necessary attributes for the FramePrefetcher object.
+
+        Parameters
+        ----------
+        trajectory : obj of class 'BallTrajectory'
+            ball position of any frame
+        image_shape : tuple of ints
+            (height, width, channel) of the image to be generated
+        dtype : str
+            dtype of the image to be generated
+        radius : int
+            ball radius
+        color : tuple of ints
+            ball color in bgr color space
+        depth : int
+            number of frames rendered ahead
+        threads : int
+            number of render threads
+        renderer : class
+            BallRenderer for bgr24 frames or YuvBallRenderer for yuv420p frames
+        """
+        if depth < 1 or threads < 1:
+            raise ValueError("FramePrefetcher needs a depth and threads of at least 1")
+        self.trajectory = trajectory
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="render")
+        self.renderers = queue.Queue()
+        for _ in range(threads):
+            self.renderers.put(renderer(image_shape, dtype, radius, color))
+        # Buffered frames, one per render thread and a few held by the sender and encoder
+        self.frames = VideoFramePool(image_shape[1], image_shape[0], renderer.format, size=depth + threads + 4)
+        self.pending = {}
+
+    def _render(self, index):
+        """
+        Method responsible to render one frame on a render thread.
+        """
+        x, y, _, _ = self.trajectory.state(index)
+        renderer = self.renderers.get()
+        try:
+            start = time.perf_counter()
+            image = renderer.render(x, y)
+            rendered = time.perf_counter()
+            # The canvas is copied into a pooled buffer, so the renderer is free again afterwards
+            frame = self.frames.wrap(image)
+            RENDER_SECONDS.observe(rendered - start)
+            CONVERT_SECONDS.observe(time.perf_counter() - rendered)
+        finally:
+            self.renderers.put(renderer)
+        return frame, (x, y)
+
+    async def get(self, index):
+        """
+        Method responsible to return a rendered frame and keep the buffer topped up.
+
+        Parameters
+        ----------
+        index : int
+            frame index, frames before it which are still buffered are discarded
+
+        Returns
+        -------
+        tuple
+            (VideoFrame, (ball_x, ball_y))
+        """
+        for stale in [i for i in self.pending if i < index]:
+            self.pending.pop(stale).cancel()
+        for ahead in range(index, index + self.depth + 1):
+            if ahead not in self.pending:
+                self.pending[ahead] = self.executor.submit(self._render, ahead)
+        return await asyncio.wrap_future(self.pending.pop(index))
+
+    def close(self):
+        """
+        Method responsible to stop the render threads.
+        """
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+
+
+def start_log_listener(level=logging.INFO, stream=None):
+    """
+    Route the server's log records through a queue to a background thread which
+    writes them out, so logging never blocks the event loop on terminal I/O.
+
+    Parameters
+    ----------
+    level : int
+        level of the server logger
+    stream : file object
+        where the records are written, sys.stdout if None
+
+    Returns
+    -------
+    obj of class 'logging.handlers.QueueListener'
+        started listener, stop it to flush the remaining records
+    """
+    records = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(level)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(records, logging.StreamHandler(stream or sys.stdout))
+    listener.start()
+    return listener
+
+
+class RunningStats:
+    """
+    Count, mean, variance and max of a stream of values with Welford's update,
+    O(1) per value and mergeable.
+    ...
+
+    Attributes
+    ----------
+    count : int
+        number of values
+    mean : float
+        running mean
+    m2 : float
+        sum of the squared differences from the mean
+    max : float
+        largest value
+
+    Methods
+    -------
+    add : Add one value.
+    merge : Add all the values summarized by another RunningStats.
+    """
+
+    def __init__(self):
+        """
+        Constructs all the necessary attributes for the RunningStats object.
+        """
+        self.count = 0
+        self.mean = self.m2 = self.max = 0.0
+
+    def add(self, value):
+        """
+        Method responsible to add one value.
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.max = value if self.count == 1 else max(self.max, value)
+
+    def merge(self, other):
+        """
+        Method responsible to combine the values of another RunningStats into this one.
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.max = other.count, other.mean, other.m2, other.max
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.max = max(self.max, other.max)
+
+    @property
+    def std(self):
+        """
+        Sample standard deviation, 0 for fewer than two values.
+        """
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class QuantileSketch:
+    """
+    Fixed-size quantile sketch: counts in log-spaced buckets, so a quantile is
+    known to within the bucket growth factor whatever the number of values.
+    ...
+
+    Attributes
+    ----------
+    lowest : float
+        upper bound of the first bucket, smaller values land in it
+    growth : float
+        ratio between the bounds of consecutive buckets
+    counts : list of ints
+        values per bucket, the last one also takes everything above its bound
+
+    Methods
+    -------
+    add : Count one value.
+    merge : Add the counts of another sketch with the same buckets.
+    quantile : Approximate quantile of the values counted.
+    """
+
+    def __init__(self, lowest=0.01, growth=1.1, size=160):
+        """
+        Constructs all the necessary attributes for the QuantileSketch object.
+
+        Parameters
+        ----------
+        lowest : float
+            upper bound of the first bucket
+        growth : float
+            ratio between the bounds of consecutive buckets, 1.1 keeps quantiles within 10%
+        size : int
+            number of buckets, 160 with the defaults reaches past 4K frame diagonals
+        """
+        self.lowest = lowest
+        self.growth = growth
+        self.log_growth = math.log(growth)
+        self.counts = [0] * size
+
+    def add(self, value):
+        """
+        Method responsible to count one value, O(1).
+        """
+        if value <= self.lowest:
+            index = 0
+        else:
+            index = min(int(math.log(value / self.lowest) / self.log_growth) + 1, len(self.counts) - 1)
+        self.counts[index] += 1
+
+    def merge(self, other):
+        """
+        Method responsible to add the counts of another sketch.
+        """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+
+    def quantile(self, q):
+        """
+        Method responsible to estimate a quantile, as the geometric middle of its bucket,
+        0 in the first bucket.
+
+        Parameters
+        ----------
+        q : float
+            quantile between 0 and 1
+
+        Returns
+        -------
+        float
+            estimated value, NaN if nothing was counted
+        """
+        total = sum(self.counts)
+        if total == 0:
+            return float("nan")
+        rank, seen = q * total, 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                break
+        if index == 0:
+            # Below the sketch resolution, e.g. exact detections
+            return 0.0
+        return self.lowest * self.growth ** (index - 0.5)
+
+
+class SlidingErrorStats:
+    """
+    Distance error statistics over a sliding time window, kept as a ring of
+    short slices each holding a RunningStats and a QuantileSketch. Adding an error
+    is O(1); the slices are only merged when a summary is asked for.
+    ...
+
+    Attributes
+    ----------
+    window : float
+        seconds covered by the summaries
+    slice_length : float
+        seconds covered by one slice
+    slices : obj of class 'collections.deque'
+        (start time, RunningStats, QuantileSketch) of the live slices, newest last
+    total : obj of class 'RunningStats'
+        errors of the whole session
+
+    Methods
+    -------
+    add : Count one error.
+    summary : Count, mean, std, max and percentiles over the window.
+    """
+
+    def __init__(self, window=10.0, slices=10):
+        """
+        Constructs all the necessary attributes for the SlidingErrorStats object.
+
+        Parameters
+        ----------
+        window : float
+            seconds covered by the summaries
+        slices : int
+            number of slices the window is split into, the window slides by one slice
+        """
+        if window <= 0 or slices < 1:
+            raise ValueError("SlidingErrorStats needs a positive window and at least one slice")
+        self.window = window
+        self.slice_length = window / slices
+        self.slices = deque()
+        self.total = RunningStats()
+
+    def _expire(self, now):
+        """
+        Method responsible to drop the slices which left the window.
+        """
+        while self.slices and self.slices[0][0] <= now - self.window:
+            self.slices.popleft()
+
+    def add(self, error, now=None):
+        """
+        Method responsible to count one error.
+
+        Parameters
+        ----------
+        error : float
+            distance error in pixels
+        now : float
+            time.monotonic() of the error, read if None
+        """
+        now = time.monotonic() if now is None else now
+        if not self.slices or now >= self.slices[-1][0] + self.slice_length:
+            self._expire(now)
+            self.slices.append((now, RunningStats(), QuantileSketch()))
+        _, stats, sketch = self.slices[-1]
+        stats.add(error)
+        sketch.add(error)
+        self.total.add(error)
+
+    def summary(self, now=None):
+        """
+        Method responsible to summarize the errors of the window.
+
+        Parameters
+        ----------
+        now : float
+            time.monotonic() the window ends at, read if None
+
+        Returns
+        -------
+        dict
+            'count', 'mean', 'std', 'max', 'p50', 'p90' and 'p99' of the window
+        """
+        self._expire(time.monotonic() if now is None else now)
+        stats, sketch = RunningStats(), QuantileSketch()
+        for _, slice_stats, slice_sketch in self.slices:
+            stats.merge(slice_stats)
+            sketch.merge(slice_sketch)
+        return {
+            "count": stats.count, "mean": stats.mean, "std": stats.std, "max": stats.max,
+            "p50": sketch.quantile(0.5), "p90": sketch.quantile(0.9), "p99": sketch.quantile(0.99),
+        }
+
+
+class PeerChannel:
+    """
+    Data channel of one peer, with its own error accounting against the position
+    history of the frame source it watches.
+    ...
+
+    Attributes
+    ----------
+    channel : obj of class 'RTCPeerConnection.createDataChannel'
+        channel on which the peer sends its coordinates
+    source : obj of class 'FrameGenerator' or 'ReplayTrack'
+        frame source holding the ground-truth ball positions
+    name : str
+        peer name used in the printed messages
+    pts_offset : int
+        source pts of the first frame this peer received, None until it is known;
+        aiortc rebases the peer's pts on that frame
+    messages : int
+        number of coordinate messages received
+    matched : int
+        number of messages whose frame was found in the position history
+    error_total : float
+        sum of the distance errors of the matched messages
+    error_max : float
+        largest distance error
+    latency_total : float
+        sum of the round trip latencies of the matched messages, in seconds
+    missed : int
+        balls of scene frames without a matching detection
+    spurious : int
+        detections of scene frames not matching any ball
+    untracked : int
+        detections in frames without a drawn ball position, e.g. replayed frames
+    errors : obj of class 'SlidingErrorStats'
+        distance errors over the last stats_window seconds
+    report_interval : float
+        seconds between two logged error summaries
+    started : float
+        time.perf_counter() at which the session was offered
+    first_frame, first_coordinate : float
+        seconds from the offer to the first frame sent and to the first coordinate
+        message received, None until then
+    next_report : float
+        time.monotonic() from which the next summary is logged
+    on_message : obj of class 'RTCPeerConnection.createDataChannel.on'
+        Function responsible for recieving the ball coordinates from client via datachannel
+        and calculate and print the error between actual coordinates and recieved coordinates.
+
+    Methods
+    -------
+    frame_sent : Record the time to the first frame of the session.
+    summary : Print the error accounting of this peer.
+    """
+
+    def __init__(self, pc, source, name="chat", pts_offset=0, stats_window=10.0, report_interval=1.0, unordered=False):
+        """
+        Constructs all the necessary attributes for the PeerChannel object.
+
+        Parameters
+        ----------
+        pc : obj of class 'RTCPeerConnection
+            connection of this peer
+        source : obj of class 'FrameGenerator' or 'ReplayTrack'
+            frame source holding the ground-truth ball positions
+        name : str
+            peer name used in the printed messages
+        pts_offset : int
+            source pts of the first frame sent to this peer, None if set later by a PeerTrack
+        stats_window : float
+            seconds of errors covered by the logged summaries
+        report_interval : float
+            seconds between two logged summaries
+        unordered : bool
+            create the unordered "coords" channel without retransmits instead of the
+            reliable "chat" one, a lost packet then only loses its own coordinates
+        """
+        self.source = source
+        self.name = name
+        self.pts_offset = pts_offset
+        self.messages = self.matched = 0
+        self.error_total = self.error_max = self.latency_total = 0.0
+        self.missed = self.spurious = self.untracked = 0
+        self.errors = SlidingErrorStats(stats_window)
+        self.report_interval = report_interval
+        self.next_report = time.monotonic() + report_interval
+        self.started = time.perf_counter()
+        self.first_frame = self.first_coordinate = None
+        SESSIONS.inc()
+
+        if unordered:
+            self.channel = channel = pc.createDataChannel("coords", ordered=False, maxRetransmits=0)
+        else:
+            self.channel = channel = pc.createDataChannel("chat")
+        print(channel.label, "-", "created by local party")
+
+        @channel.on("message")
+        @STAGE_ON_MESSAGE
+        def on_message(message):
+            self.messages += 1
+            COORDINATES_RECEIVED.inc()
+            if self.first_coordinate is None:
+                self.first_coordinate = time.perf_counter() - self.started
+                TIME_TO_FIRST_COORDINATE.observe(self.first_coordinate)
+                logger.info("%s : first frame %.0f ms, first coordinates %.0f ms after the offer", self.name,
+                            (self.first_frame or 0.0) * 1000, self.first_coordinate * 1000)
+            if isinstance(message, str):
+                if getattr(self.source, "ball_pos", None) is None:
+                    return
+                # Untagged "x y" text message, compare with the current position
+                coods  = message.split(" ")
+                rec_x, rec_y = int(coods[0]), int(coods[1])
+                error = math.hypot(self.source.ball_pos[0]-rec_x, self.source.ball_pos[1]-rec_y)
+                self.errors.add(error)
+                logger.debug("%s : ball position %d %d, current %d %d, error %.3f",
+                             self.name, rec_x, rec_y, self.source.ball_pos[0], self.source.ball_pos[1], error)
+                self._maybe_report()
+                return
+
+            arrived, start = time.time(), time.perf_counter()
+            if message[0] == DETECTIONS_MESSAGE:
+                self._on_detections(message, arrived, start)
+            elif message[0] == BATCH_MESSAGE:
+                pts, rec_x, rec_y, detected = unpack_batch(message)
+                for frame_pts, x, y in zip(pts.tolist(), rec_x.tolist(), rec_y.tolist()):
+                    self._on_coordinates(frame_pts, x, y, detected, arrived, time.perf_counter())
+            else:
+                self._on_coordinates(*unpack_coordinates(message), arrived, start)
+            self._maybe_report()
+
+    def frame_sent(self):
+        """
+        Method responsible to record the time from the offer to the first frame handed to the sender.
+        """
+        if self.first_frame is None:
+            self.first_frame = time.perf_counter() - self.started
+            TIME_TO_FIRST_FRAME.observe(self.first_frame)
+
+    def _on_coordinates(self, pts, rec_x, rec_y, detected, arrived, start):
+        """
+        Method responsible to compare the ball detected in a frame with the ball drawn in it.
+
+        Parameters
+        ----------
+        pts : int
+            presentation timestamp of the frame, as received by the peer
+        rec_x, rec_y : int
+            detected ball centre
+        detected : float
+            wall-clock time at which the detection finished
+        arrived : float
+            wall-clock time at which the message arrived
+        start : float
+            time.perf_counter() at which the handling of this coordinate started
+        """
+        truth = self.source.history.get(pts + (self.pts_offset or 0))
+        if truth is None:
+            COORDINATES_UNMATCHED.inc()
+            logger.debug("%s : frame %d is no longer in the position history", self.name, pts)
+            return
+        true_x, true_y, sent = truth
+        if true_x is None:
+            self._on_untracked(pts, detected, arrived, sent)
+            return
+        error = math.hypot(true_x-rec_x, true_y-rec_y)
+        latency = arrived - sent
+        ERROR_SECONDS.observe(time.perf_counter() - start)
+        ERROR_PIXELS.observe(error)
+        ROUND_TRIP_SECONDS.observe(latency)
+        # Both ends share the host clock in the loopback and docker setups
+        FRAME_TO_DETECTION_SECONDS.observe(max(detected - sent, 0.0))
+        DETECTION_TO_SERVER_SECONDS.observe(max(arrived - detected, 0.0))
+        self.matched += 1
+        self.error_total += error
+        self.error_max = max(self.error_max, error)
+        self.latency_total += latency
+        self.errors.add(error)
+        logger.debug("%s : frame %d ball position %d %d, drawn at %d %d, error %.3f, round trip %.1f ms",
+                     self.name, pts, rec_x, rec_y, true_x, true_y, error, latency * 1000)
+
+    def _on_detections(self, message, arrived, start):
+        """
+        Method responsible to match the balls detected in a scene frame with the balls drawn in it.
+
+        Parameters
+        ----------
+        message : bytes
+            multi-ball detection message
+        arrived : float
+            wall-clock time at which the message arrived
+        start : float
+            time.perf_counter() at which its handling started
+        """
+        pts, rec_x, rec_y, detected = unpack_detections(message)
+        truth = self.source.history.get(pts + (self.pts_offset or 0))
+        if truth is None:
+            COORDINATES_UNMATCHED.inc()
+            logger.debug("%s : frame %d is no longer in the position history", self.name, pts)
+            return
+        true_x, true_y, sent = truth
+        if true_x is None:
+            self._on_untracked(pts, detected, arrived, sent)
+            return
+        # Touching balls merge into one detection, which lands between them
+        gate = 2 * int(self.source.scene.radii.max()) if self.source.scene is not None else 2 * self.source.radius
+        _, _, errors = match_detections(np.atleast_1d(true_x), np.atleast_1d(true_y), rec_x, rec_y, gate)
+        missed, spurious = np.size(true_x) - len(errors), len(rec_x) - len(errors)
+        latency = arrived - sent
+        ERROR_SECONDS.observe(time.perf_counter() - start)
+        for error in errors.tolist():
+            ERROR_PIXELS.observe(error)
+            self.errors.add(error)
+        BALLS_MISSED.inc(missed)
+        DETECTIONS_SPURIOUS.inc(spurious)
+        ROUND_TRIP_SECONDS.observe(latency)
+        FRAME_TO_DETECTION_SECONDS.observe(max(detected - sent, 0.0))
+        DETECTION_TO_SERVER_SECONDS.observe(max(arrived - detected, 0.0))
+        self.missed += missed
+        self.spurious += spurious
+        self.latency_total += latency
+        logger.debug("%s : frame %d matched %d of %d balls, missed %d, spurious %d, round trip %.1f ms",
+                     self.name, pts, len(errors), np.size(true_x), missed, spurious, latency * 1000)
+        if len(errors) == 0:
+            return
+        self.matched += 1
+        self.error_total += float(errors.mean())
+        self.error_max = max(self.error_max, float(errors.max()))
+
+    def _on_untracked(self, pts, detected, arrived, sent):
+        """
+        Method responsible to account a detection in a frame without a drawn ball
+        position, e.g. a replayed frame, only its timing is known.
+        """
+        latency = arrived - sent
+        ROUND_TRIP_SECONDS.observe(latency)
+        FRAME_TO_DETECTION_SECONDS.observe(max(detected - sent, 0.0))
+        DETECTION_TO_SERVER_SECONDS.observe(max(arrived - detected, 0.0))
+        self.untracked += 1
+        self.latency_total += latency
+        logger.debug("%s : frame %d detection without ground truth, round trip %.1f ms", self.name, pts, latency * 1000)
+
+    def _maybe_report(self):
+        """
+        Method responsible to log the error summary of the window once per report interval.
+        """
+        now = time.monotonic()
+        if now < self.next_report:
+            return
+        self.next_report = now + self.report_interval
+        summary = self.errors.summary(now)
+        if summary["count"] == 0:
+            return
+        logger.info("%s : %d errors in the last %.0f s, mean %.2f std %.2f p50 %.2f p90 %.2f p99 %.2f max %.2f px",
+                    self.name, summary["count"], self.errors.window, summary["mean"], summary["std"],
+                    summary["p50"], summary["p90"], summary["p99"], summary["max"])
+
+    def summary(self):
+        """
+        Method responsible to print the error accounting of this peer.
+        """
+        if self.untracked:
+            print(self.name, ":", self.messages, "messages,", self.untracked, "on replayed frames,",
+                  "mean round trip", round(self.latency_total / self.untracked * 1000, 1), "ms")
+            return
+        if self.matched == 0:
+            print(self.name, ":", self.messages, "messages, none matched a sent frame")
+            return
+        print(self.name, ":", self.messages, "messages,",
+              "mean error", round(self.error_total / self.matched, 3),
+              "max error", round(self.error_max, 3),
+              "mean round trip", round(self.latency_total / self.matched * 1000, 1), "ms")
+        if self.missed or self.spurious:
+            print(self.name, ":", self.missed, "balls missed,", self.spurious, "spurious detections")
+
+
+class PeerTrack(MediaStreamTrack):
+    """
+    Per-peer view of a relayed frame source which records the pts of the first
+    frame the peer receives, so the peer's coordinates can be matched to the
+    shared position history.
+    ...
+
+    Attributes
+    ----------
+    kind : str
+        type of media track
+    source : obj of class 'MediaStreamTrack'
+        relay subscription of the shared frame source
+    peer : obj of class 'PeerChannel'
+        data channel and error accounting of the peer
+    returned : float
+        time.perf_counter() at which the last frame was handed to the sender
+    """
+
+    kind = "video"
+
+    def __init__(self, source, peer):
+        """
+        Constructs all the necessary attributes for the PeerTrack object.
+
+        Parameters
+        ----------
+        source : obj of class 'MediaStreamTrack'
+            relay subscription of the shared frame source
+        peer : obj of class 'PeerChannel'
+            data channel and error accounting of the peer
+        """
+        super().__init__()
+        self.source = source
+        self.peer = peer
+        self.returned = None
+
+    async def recv(self):
+        """
+        Method responsible to forward the next shared frame to this peer.
+        """
+        if self.returned is not None:
+            # The sender encodes the previous frame before asking for this one
+            ENCODE_SECONDS.observe(time.perf_counter() - self.returned)
+        frame = await self.source.recv()
+        if self.peer.pts_offset is None:
+            self.peer.pts_offset = frame.pts
+        self.peer.frame_sent()
+        self.returned = time.perf_counter()
+        return frame
+
+    def stop(self):
+        """
+        Method responsible to stop the track and its relay subscription.
+        """
+        super().stop()
+        self.source.stop()
+
+
+class PacingClock:
+    """
+    Frame clock with absolute deadlines: frame n is due start + n / rate on the
+    monotonic clock and its pts is computed from n, so neither sleep overshoot
+    nor pts rounding accumulates into drift. When the frame source falls a whole
+    frame period or more behind, the clock skips to the current slot instead of
+    bursting through the backlog, and the pts jump with it.
+    ...
+
+    Attributes
+    ----------
+    fps : float
+        frame rate of the pts timeline
+    rate : float
+        frames handed out per second of wall-clock time, fps times the speed
+    start : float
+        time.perf_counter() of frame 0, None until the first tick
+    index : int
+        slot of the last frame handed out
+    missed : int
+        frames handed out after their deadline
+    skipped : int
+        slots skipped to catch up
+
+    Methods
+    -------
+    tick : Wait for the next frame slot and return its pts.
+    """
+
+    def __init__(self, fps, speed=1.0):
+        """
+        Constructs all the necessary attributes for the PacingClock object.
+
+        Parameters
+        ----------
+        fps : float
+            frame rate of the pts timeline
+        speed : float
+            wall-clock rate relative to the timeline, above 1 runs faster than real time
+        """
+        if fps <= 0 or speed <= 0:
+            raise ValueError("fps and speed should be positive")
+        self.fps = fps
+        self.rate = fps * speed
+        self.start = None
+        self.index = 0
+        self.missed = self.skipped = 0
+
+    def pts(self, index):
+        return round(index * VIDEO_CLOCK_RATE / self.fps)
+
+    async def tick(self):
+        """
+        Method responsible to wait until the next frame is due.
+
+        Returns
+        -------
+        int
+            pts of the frame, in VIDEO_TIME_BASE units
+        """
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+            return 0
+
+        self.index += 1
+        late = now - (self.start + self.index / self.rate)
+        if late <= 0:
+            await asyncio.sleep(-late)
+            return self.pts(self.index)
+
+        self.missed += 1
+        DEADLINES_MISSED.inc()
+        behind = int(late * self.rate)
+        if behind > 0:
+            # Rendering or encoding overran by whole frames, drop their slots
+            self.index += behind
+            self.skipped += behind
+            FRAMES_SKIPPED.inc(behind)
+        PACING_LATENESS_SECONDS.observe(late - behind / self.rate)
+        return self.pts(self.index)
 
 
 class FrameGenerator(VideoStreamTrack):
     """
-    Class responsible for generating bouncing ball frames, send them to client,
-    recieve the client coordniates and calculate the error in location of the ball.
+    Class responsible for generating bouncing ball frames, send them to client,
+    recieve the client coordniates and calculate the error in location of the ball.
+    ...
+
+    Attributes
+    ----------
+    image_shape : tuple of ints
+        (height, width, channel) of the image to be generated
+    dtype : str
+        dtype of the image to be generated
+    velocity : list of ints
+        (dx, dy) rate of change of ball's position
+    ball_pos : list of ints
+        (ball_x, ball_y) position of the ball
+    radius : int 
+        ball radius
+    color : tuple of ints
+        ball color in bgr color space
+    history : obj of class 'PositionHistory'
+        ball position of the recently sent frames, keyed by pts
+    renderer : obj of class 'BallRenderer' or 'YuvBallRenderer'
+        dirty-rectangle renderer, None when every frame is drawn from scratch
+    frame_index : int
+        number of ball steps so far, one per pacing clock slot whether its frame was sent or skipped
+    prefetcher : obj of class 'FramePrefetcher'
+        renders the next frames off the event loop, None when frames are rendered in recv
+    frames : obj of class 'VideoFramePool'
+        frames the rendered images are copied into when rendering in recv
+    peer : obj of class 'PeerChannel'
+        data channel and error accounting of the connection passed in, None when the
+        generator is shared by several peers
+    returned : float
+        time.perf_counter() at which the last frame was handed to the sender
+    fps : float
+        frames sent per second
+    clock : obj of class 'PacingClock'
+        paces the frames and skips slots when rendering or encoding overruns
+    scene : obj of class 'BallScene'
+        balls of the multi-ball scene, None for the single ball
+    Methods
+    -------
+    info : Calculates the ball position in real time and updates the frame generation.
+    step : Move the ball by one frame without drawing it.
+    """
+       
+
+    def __init__(self, pc, image_shape, dtype, velocity, ball_pos, radius, color, history=300, render="full", lookahead=0, render_threads=2, fps=30,
+                 balls=1, seed=None):
+        """
+        Constructs all the necessary attributes for the FrameGenerator object.
+
+        Parameters
+        ----------
+        pc : obj of class 'RTCPeerConnection
+            To establish the connection, None when the generator is shared through a relay
+        image_shape : tuple of ints
+            (height, width, channel) of the image to be generated
+        dtype : str
+            dtype of the image to be generated
+        velocity : list of ints
+            (dx, dy) rate of change of ball's position
+        ball_pos : list of ints
+            (ball_x, ball_y) position of the ball
+        radius : int 
+            ball radius
+        color : tuple of ints
+            ball color in bgr color space
+        history : int
+            number of sent frames whose ball position is remembered
+        render : str
+            'full' draws every frame on a new array, 'dirty' reuses one canvas and
+            only redraws the ball's bounding box, 'yuv' does the same straight into
+            yuv420p planes so the encoder does not convert the frame
+        lookahead : int
+            frames rendered ahead on a thread pool, 0 renders each frame inside recv
+        render_threads : int
+            number of render threads used when lookahead is enabled
+        fps : int
+            frames sent per second
+        balls : int
+            number of balls, more than one creates a random BallScene with radii up to radius
+        seed : int
+            seed of the random scene
+        """
+        super().__init__()
+        self.image_shape = image_shape
+        self.dtype = dtype
+        self.velocity = velocity
+        self.ball_pos = ball_pos
+        self.radius = radius
+        self.color = color
+        self.history = PositionHistory(history)
+        if render not in ("full", "dirty", "yuv"):
+            raise ValueError("render should be 'full', 'dirty' or 'yuv'")
+        renderer = YuvBallRenderer if render == "yuv" else BallRenderer
+        self.renderer = renderer(image_shape, dtype, radius, color) if render != "full" else None
+        self.frame_index = 0
+        self.prefetcher = None
+        self.scene = None
+        if balls > 1:
+            if lookahead > 0:
+                raise ValueError("lookahead needs a single ball")
+            self.scene = BallScene.random(image_shape, balls, radius, seed=seed)
+            # Dirty rectangles only apply to one ball, the scene is drawn whole
+            self.renderer = SceneRenderer(image_shape, dtype, "yuv420p" if render == "yuv" else "bgr24")
+        if lookahead > 0:
+            trajectory = BallTrajectory(image_shape, ball_pos, velocity, radius)
+            self.prefetcher = FramePrefetcher(trajectory, image_shape, dtype, radius, color, lookahead, render_threads, renderer)
+        self.frames = VideoFramePool(image_shape[1], image_shape[0], self.renderer.format if self.renderer is not None else "bgr24")
+
+        self.peer = PeerChannel(pc, self) if pc is not None else None
+        self.returned = None
+        if fps <= 0:
+            raise ValueError("fps should be positive")
+        self.fps = fps
+        self.clock = PacingClock(fps)
+
+    @STAGE_GENERATE_FRAME
+    def generateFrame(self):
+        """
+        Method responsible to generating the frames and updating the ball's location each time it is called
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        frame : numpy ndarray
+            Image continaing the updated postion of the ball, in 'dirty' and 'yuv' render
+            modes the same array is returned and overwritten on every call, in 'yuv'
+            mode it holds the yuv420p planes
+        """
+
+        # print(self.ball_x, self.ball_y, "/n")
+        # Ball Position Update
+        self.step()
+        if self.scene is not None:
+            return self.renderer.render(self.scene)
+
+        # generate frame
+        if self.renderer is not None:
+            return self.renderer.render(self.ball_pos[0], self.ball_pos[1])
+
+        height, width, channel = self.image_shape
+        frame = np.zeros((height, width, channel),dtype=self.dtype)
+        cv2.circle(frame,(self.ball_pos[0], self.ball_pos[1]),self.radius, self.color,-1)
+
+        return frame
+
+    def step(self):
+        """
+        Method responsible to move the ball, or every ball of the scene, by one frame.
+        """
+        self.frame_index += 1
+        if self.scene is not None:
+            self.scene.step()
+            return
+
+        self.ball_pos[0] += self.velocity[0]
+        self.ball_pos[1] += self.velocity[1]
+
+        # Change the sign of increment on collision with the boundary
+        if self.ball_pos[1] >= (self.image_shape[0] - self.radius) or (self.ball_pos[1] - self.radius) <= 0:
+            self.velocity[1] *= -1
+
+        if self.ball_pos[0] >= (self.image_shape[1]-self.radius) or (self.ball_pos[0] - self.radius) <= 0:
+            self.velocity[0] *= -1
+
+    async def next_timestamp(self):
+        """
+        Method responsible to pace the frames at self.fps with the PacingClock.
+
+        Returns
+        -------
+        tuple
+            (pts, time_base) of the next frame
+        """
+        if self.readyState != "live":
+            raise MediaStreamError
+        return await self.clock.tick(), VIDEO_TIME_BASE
+
+    async def recv(self):
+        """
+        Method responsible to call function to generate frame and 
+        convert them to appropriate object for Mediatrack channel.
+
+        The ball moves with the pacing clock's slots rather than the frames sent:
+        when the clock skips slots to catch up, the ball is advanced through them
+        too, so the frame sent at a pts shows the ball where it is at that time.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        frame : obj of class 'Videoframe'
+            Compatible format for transferring via Media channel
+        """
+        if self.peer is not None and self.returned is not None:
+            # The sender encodes the previous frame before asking for this one,
+            # behind a relay the PeerTracks measure it instead
+            ENCODE_SECONDS.observe(time.perf_counter() - self.returned)
+        pts, time_base = await self.next_timestamp()
+        started = STAGE_RECV.start()
+
+        if self.prefetcher is not None:
+            # Frame was rendered and converted ahead of time on a render thread,
+            # frames of skipped slots are discarded by the prefetcher
+            self.frame_index = self.clock.index + 1
+            frame, (x, y) = await self.prefetcher.get(self.frame_index)
+            self.ball_pos[0], self.ball_pos[1] = x, y
+        else:
+            # Frame n of the clock is the ball after n + 1 steps, catch up on skipped slots
+            while self.frame_index < self.clock.index:
+                self.step()
+            start = time.perf_counter()
+            frame = self.generateFrame()
+            rendered = time.perf_counter()
+
+            # Copy into a pooled buffer the sender is done with
+            frame = self.frames.wrap(frame)
+            RENDER_SECONDS.observe(rendered - start)
+            CONVERT_SECONDS.observe(time.perf_counter() - rendered)
+
+        # aiortc rebases the receiver's pts on the first frame, which is pts 0 here,
+        # so the client tags its detections with this same pts
+        if self.scene is not None:
+            self.history.add(pts, self.scene.positions[:, 0].copy(), self.scene.positions[:, 1].copy(), time.time())
+        else:
+            self.history.add(pts, self.ball_pos[0], self.ball_pos[1], time.time())
+
+        frame.pts = pts
+        frame.time_base = time_base
+        FRAMES_SENT.inc()
+        SEND_FPS.tick()
+        if self.peer is not None:
+            self.peer.frame_sent()
+        STAGE_RECV.stop(started)
+        self.returned = time.perf_counter()
+        return frame
+
+    def stop(self):
+        """
+        Method responsible to stop the track and its render threads.
+        """
+        super().stop()
+        if self.clock.missed:
+            logger.info("%d of %d frames missed their deadline at %g fps, %d frame slots skipped",
+                        self.clock.missed, self.clock.index + 1, self.fps, self.clock.skipped)
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+
+# Raw frame archive written by client.py --record-raw: yuv420p planes back to back in
+# the data file, a header and fixed-size records in PATH.idx - must match client.py
+ARCHIVE_MAGIC = b"BALLRAW1"
+ARCHIVE_HEADER = "<8sii"
+ARCHIVE_RECORD = np.dtype([("pts", "<i8"), ("offset", "<i8"), ("width", "<u4"), ("height", "<u4")])
+
+
+class ArchiveReader:
+    """
+    Read side of the client's raw frame archive, any frame is copied straight out
+    of the memory-mapped data file.
     ...
 
     Attributes
     ----------
-    image_shape : tuple of ints
-        (height, width, channel) of the image to be generated
-    dtype : str
-        dtype of the image to be generated
-    velocity : list of ints
-        (dx, dy) rate of change of ball's position
-    ball_pos : list of ints
-        (ball_x, ball_y) position of the ball
-    radius : int 
-        ball radius
-    color : tuple of ints
-        ball color in bgr color space
-    on_message : obj of class 'RTCPeerConnection.createDataChannel.on'
-            Function responsible for recieving the ball coordinates from client via datachannel
-            and calculate and print the error between actual coordinates and recieved coordinates.
+    records : numpy ndarray
+        index of the frames, ARCHIVE_RECORD entries
+    data : obj of class 'mmap.mmap'
+        read-only mapping of the data file
+
     Methods
     -------
-    info : Calculates the ball position in real time and updates the frame generation.
+    frame : Frame at a position of the archive, None past the end.
+    close : Unmap the data file.
     """
-       
 
-    def __init__(self, pc, image_shape, dtype, velocity, ball_pos, radius, color):
+    def __init__(self, path):
         """
-        Constructs all the necessary attributes for the FrameGenerator object.
+        Constructs all the necessary attributes for the ArchiveReader object.
 
         Parameters
         ----------
-        pc : obj of class 'RTCPeerConnection
-            To establish the connection
-        image_shape : tuple of ints
-            (height, width, channel) of the image to be generated
-        dtype : str
-            dtype of the image to be generated
-        velocity : list of ints
-            (dx, dy) rate of change of ball's position
-        ball_pos : list of ints
-            (ball_x, ball_y) position of the ball
-        radius : int 
-            ball radius
-        color : tuple of ints
-            ball color in bgr color space
-        on_message : obj of class 'RTCPeerConnection.createDataChannel.on'
-                Function responsible for recieving the ball coordinates from client via datachannel
-                and calculate and print the error between actual coordinates and recieved coordinates.
+        path : str
+            data file of the archive, the index is path + '.idx'
         """
-        super().__init__()
-        self.image_shape = image_shape
-        self.dtype = dtype
-        self.velocity = velocity
-        self.ball_pos = ball_pos
-        self.radius = radius
-        self.color = color
+        with open(path + ".idx", "rb") as f:
+            header = f.read(struct.calcsize(ARCHIVE_HEADER))
+            records = f.read()
+        if len(header) < struct.calcsize(ARCHIVE_HEADER) or struct.unpack(ARCHIVE_HEADER, header)[0] != ARCHIVE_MAGIC:
+            raise ValueError("%s.idx is not a raw frame index" % path)
+        usable = len(records) // ARCHIVE_RECORD.itemsize * ARCHIVE_RECORD.itemsize
+        self.records = np.frombuffer(records[:usable], dtype=ARCHIVE_RECORD)
+        if not len(self.records):
+            raise ValueError("%s holds no frames" % path)
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-        channel = pc.createDataChannel("chat")
-        print(channel.label, "-", "created by local party")
+    def __len__(self):
+        return len(self.records)
 
-        @channel.on("message")
-        def on_message(message):
-            print(channel.label, ": Ball Position Recieved from client: ", message)
-            coods  = message.split(" ")
-            rec_x, rec_y = int(coods[0]), int(coods[1])
-            print("Current Ball Position:", self.ball_pos[0], self.ball_pos[1], "\n")
-            print("Distance Error: ", round(math.sqrt((self.ball_pos[0]-rec_x)**2 + (self.ball_pos[1]-rec_y)**2), 3), "\n")
+    def frame(self, i):
+        if i >= len(self.records):
+            return None
+        _, offset, width, height = self.records[i].tolist()
+        chroma = ((height + 1) // 2) * ((width + 1) // 2)
+        planes = np.frombuffer(self.data, np.uint8, count=width * height + 2 * chroma, offset=offset)
+        frame = VideoFrame(width, height, "yuv420p")
+        start = 0
+        for plane, size in zip(frame.planes, (width * height, chroma, chroma)):
+            rows = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+            rows[:, :plane.width] = planes[start:start + size].reshape(plane.height, plane.width)
+            start += size
+        return frame
 
-    def generateFrame(self):
+    def close(self):
+        self.data.close()
+
+
+class VideoFileReader:
+    """
+    Sequential decoder of a video file, any container and codec PyAV (and so
+    MediaPlayer) can open. Reading an earlier frame than the last one restarts
+    the decoder from the beginning of the file.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        video file
+    container : obj of class 'av.container.InputContainer'
+        open file
+    position : int
+        index of the next frame the decoder yields
+
+    Methods
+    -------
+    frame : Decoded frame at a position of the file, None past the end.
+    close : Close the file.
+    """
+
+    def __init__(self, path):
         """
-        Method responsible to generating the frames and updating the ball's location each time it is called
+        Constructs all the necessary attributes for the VideoFileReader object.
 
         Parameters
         ----------
-        None
-
-        Returns
-        -------
-        frame : numpy ndarray
-            Image continaing the updated postion of the ball 
+        path : str
+            video file
         """
+        self.path = path
+        self.container = None
+        self._rewind()
 
-        # print(self.ball_x, self.ball_y, "/n")
-        # Ball Position Update
-        self.ball_pos[0] += self.velocity[0]
-        self.ball_pos[1] += self.velocity[1]
+    def _rewind(self):
+        if self.container is not None:
+            self.container.close()
+        self.container = av.open(self.path)
+        self.frames = self.container.decode(video=0)
+        self.position = 0
 
-        # Change the sign of increment on collision with the boundary
-        if self.ball_pos[1] >= (self.image_shape[0] - self.radius) or (self.ball_pos[1] - self.radius) <= 0:
-            self.velocity[1] *= -1
+    def __len__(self):
+        # Container headers may not know the frame count, the end is found by decoding
+        return 0
 
-        if self.ball_pos[0] >= (self.image_shape[1]-self.radius) or (self.ball_pos[0] - self.radius) <= 0:
-            self.velocity[0] *= -1
+    def frame(self, i):
+        if i < self.position:
+            self._rewind()
+        frame = None
+        while self.position <= i:
+            frame = next(self.frames, None)
+            if frame is None:
+                return None
+            self.position += 1
+        return frame
 
-        # generate frame
-        height, width, channel = self.image_shape
-        frame = np.zeros((height, width, channel),dtype=self.dtype)
-        cv2.circle(frame,(self.ball_pos[0], self.ball_pos[1]),self.radius, self.color,-1)
+    def close(self):
+        self.container.close()
 
-        return frame
 
-    async def recv(self):
+class ReplayTrack(MediaStreamTrack):
+    """
+    Video track replaying a recorded video file or a client raw frame archive in a
+    loop, in place of the FrameGenerator. Decoded frames are kept in a bounded LRU
+    cache so the loops after the first do not decode a clip that fits, misses are
+    decoded on a thread off the event loop. The replayed frames have no drawn ball
+    position, so the peers' coordinates only give round trip times.
+    ...
+
+    Attributes
+    ----------
+    kind : str
+        type of media track
+    reader : obj of class 'ArchiveReader' or 'VideoFileReader'
+        source of the frames
+    cache : OrderedDict
+        frame index -> decoded frame, least recently used first
+    cache_frames : int
+        most frames kept in the cache
+    length : int
+        frames in one loop, None until the end of a video file has been reached
+    index : int
+        frame index of the next frame
+    fps : int
+        frame rate of the replayed timeline
+    speed : float
+        replay rate relative to real time, above 1 to stress the client
+    clock : obj of class 'PacingClock'
+        paces the frames at fps times speed
+    history : obj of class 'PositionHistory'
+        send time of the recently sent frames, keyed by pts, without ball positions
+    peer : obj of class 'PeerChannel'
+        data channel of the connection passed in, None when the track is shared
+    scene : None
+        no ball scene, for the PeerChannel
+    hits, misses : int
+        cache lookups served from the cache and decoded
+
+    Methods
+    -------
+    recv : Next frame of the replay, paced at fps times speed.
+    """
+
+    kind = "video"
+
+    def __init__(self, pc, path, fps=30, speed=1.0, cache_frames=450, history=300):
         """
-        Method responsible to call function to generate frame and 
-        convert them to appropriate object for Mediatrack channel.
+        Constructs all the necessary attributes for the ReplayTrack object.
 
         Parameters
         ----------
-        None
+        pc : obj of class 'RTCPeerConnection
+            connection whose data channel receives the coordinates, None for a shared track
+        path : str
+            video file, or data file of a raw frame archive (with its PATH.idx next to it)
+        fps : int
+            frame rate of the replayed timeline
+        speed : float
+            replay rate relative to real time
+        cache_frames : int
+            most decoded frames kept, 450 holds the bundled 28 s clip at 640x480 (about 200 MB)
+        history : int
+            number of sent frames whose send time is remembered
+        """
+        super().__init__()
+        if fps <= 0 or speed <= 0:
+            raise ValueError("fps and speed should be positive")
+        self.reader = ArchiveReader(path) if os.path.exists(path + ".idx") else VideoFileReader(path)
+        self.cache = OrderedDict()
+        self.cache_frames = cache_frames
+        self.length = len(self.reader) or None
+        self.index = 0
+        self.fps = fps
+        self.speed = speed
+        self.clock = PacingClock(fps, speed)
+        self.history = PositionHistory(history)
+        self.scene = None
+        self.hits = self.misses = 0
+        # One thread, the decoder state is not shared between threads
+        self.executor = ThreadPoolExecutor(1)
+        self.peer = PeerChannel(pc, self) if pc is not None else None
+        self.returned = None
+
+    async def next_timestamp(self):
+        """
+        Method responsible to pace the frames at fps times speed, the pts follow the replayed timeline.
+        """
+        if self.readyState != "live":
+            raise MediaStreamError
+        return await self.clock.tick(), VIDEO_TIME_BASE
+
+    async def _frame(self, i):
+        """
+        Method responsible to look a frame up in the cache, decoding it on a miss.
+
+        Returns
+        -------
+        tuple
+            (frame index, frame), the index wraps to 0 at the end of a video file
+        """
+        frame = self.cache.get(i)
+        if frame is not None:
+            self.cache.move_to_end(i)
+            self.hits += 1
+            REPLAY_CACHE_HITS.inc()
+            return i, frame
+
+        start = time.perf_counter()
+        frame = await asyncio.get_running_loop().run_in_executor(self.executor, self.reader.frame, i)
+        if frame is None:
+            if i == 0:
+                raise MediaStreamError
+            # End of the file, one loop is i frames long
+            self.length = i
+            return await self._frame(0)
+        DECODE_SECONDS.observe(time.perf_counter() - start)
+        self.misses += 1
+        REPLAY_CACHE_MISSES.inc()
+        self.cache[i] = frame
+        if len(self.cache) > self.cache_frames:
+            self.cache.popitem(last=False)
+        return i, frame
+
+    async def recv(self):
+        """
+        Method responsible to return the next frame of the replay.
 
         Returns
         -------
         frame : obj of class 'Videoframe'
-            Compatible format for transferring via Media channel
+            replayed frame restamped on the replay timeline
         """
+        if self.peer is not None and self.returned is not None:
+            ENCODE_SECONDS.observe(time.perf_counter() - self.returned)
         pts, time_base = await self.next_timestamp()
+        i, frame = await self._frame(self.index)
+        self.index = i + 1
+        if self.length is not None:
+            self.index %= self.length
 
-        frame = self.generateFrame()
-        
-        # Convert to VideoFrame object
-        frame = VideoFrame.from_ndarray(frame, format='bgr24')
-
+        self.history.add(pts, None, None, time.time())
         frame.pts = pts
         frame.time_base = time_base
+        # Cached frames go to the encoder again on every loop, a keyframe forced on one
+        # (or the clip's own picture type) must not stick to it
+        frame.pict_type = av.video.frame.PictureType.NONE
+        FRAMES_SENT.inc()
+        SEND_FPS.tick()
+        if self.peer is not None:
+            self.peer.frame_sent()
+        self.returned = time.perf_counter()
         return frame
 
+    def stop(self):
+        """
+        Method responsible to stop the track, its decode thread and close the source.
+        """
+        super().stop()
+        self.executor.shutdown(wait=True)
+        self.reader.close()
+
+
 
 async def server_consume_signaling(pc, signaling, loop):
     """
@@ -165,7 +2747,8 @@ async def server_consume_signaling(pc, signaling, loop):
 
     Returns
     ----------
-    None
+    str
+        'bye' when the client left or closed the signaling, 'error' if it failed
     """
     try:
         while True:
@@ -177,17 +2760,255 @@ async def server_consume_signaling(pc, signaling, loop):
 
             elif isinstance(obj, RTCIceCandidate):
                 await pc.addIceCandidate(obj)
-            elif obj is BYE:
+            elif obj is BYE or obj is None:
+                # None once the socket signaling connection is closed by the other side
                 print("Exiting")
-                break
-    except:
-        # Stop the loop if input object is invalid
-        loop.stop()
-    
-        print("Shutdown complete ...") 
+                return "bye"
+    except Exception:
+        # Invalid input or a broken socket ends this session only, the caller decides what follows
+        logger.exception("Signaling failed")
+        return "error"
+
+
+# Codec options of the encoder presets, on top of aiortc's own settings
+ENCODER_PRESETS = {
+    "vp8": {
+        "default": {},
+        # Fastest realtime speed step and no noise reduction pass
+        "low-latency": {"cpu-used": "-16", "noise-sensitivity": "0"},
+    },
+    "h264": {
+        "default": {},
+        "low-latency": {"preset": "ultrafast"},
+    },
+}
+
+
+class TunedEncoder:
+    """
+    Mixin tuning one of aiortc's encoders without copying its encode method.
+    aiortc reaches the codec context through self.codec for every setting and
+    for the first encode, which opens it, so the tuned options are merged into
+    the context on every access until it is open.
+    ...
+
+    Attributes
+    ----------
+    max_bitrate : int
+        bitrate the encoder starts at, the receiver's estimate can only lower it
+    keyframe_interval : int
+        most frames between two keyframes, None keeps the codec's default
+    options : dict
+        codec options added to aiortc's
+
+    Methods
+    -------
+    encode : Encode a frame, a forced keyframe from a private copy of it.
+    """
+
+    def __init__(self, bitrate, keyframe_interval, options, default_bitrate, min_bitrate):
+        """
+        Constructs all the necessary attributes for the TunedEncoder object.
+
+        Parameters
+        ----------
+        bitrate : int
+            target bitrate in bits per second, None for aiortc's default
+        keyframe_interval : int
+            most frames between two keyframes
+        options : dict
+            codec options added to aiortc's
+        default_bitrate, min_bitrate : int
+            aiortc's bounds of the codec
+        """
+        super().__init__()
+        self.max_bitrate = bitrate or default_bitrate
+        self.min_bitrate = min(min_bitrate, self.max_bitrate)
+        self._target_bitrate = self.max_bitrate
+        self.keyframe_interval = keyframe_interval
+        self.options = options
+
+    @property
+    def codec(self):
+        codec = self._codec
+        if codec is not None and not codec.is_open:
+            codec.options = dict(codec.options, **self.codec_options())
+            if self.keyframe_interval:
+                codec.gop_size = self.keyframe_interval
+        return codec
+
+    @codec.setter
+    def codec(self, codec):
+        self._codec = codec
+
+    def codec_options(self):
+        return self.options
+
+    @property
+    def target_bitrate(self):
+        return self._target_bitrate
+
+    @target_bitrate.setter
+    def target_bitrate(self, bitrate):
+        self._target_bitrate = max(self.min_bitrate, min(bitrate, self.max_bitrate))
+
+    def encode(self, frame, force_keyframe=False):
+        if force_keyframe:
+            # A forced keyframe is marked on the frame, which fan-out peers and the
+            # frame pool share, so it is encoded from a copy
+            copy = VideoFrame.from_ndarray(frame.to_ndarray(format="yuv420p"), format="yuv420p")
+            copy.pts, copy.time_base = frame.pts, frame.time_base
+            frame = copy
+        return super().encode(frame, force_keyframe)
+
+
+class TunedVp8Encoder(TunedEncoder, vpx.Vp8Encoder):
+    """
+    aiortc's VP8 encoder with a configurable bitrate, keyframe interval and preset.
+    """
+
+    def __init__(self, bitrate=None, keyframe_interval=None, preset="default"):
+        super().__init__(bitrate, keyframe_interval, ENCODER_PRESETS["vp8"][preset], vpx.DEFAULT_BITRATE, vpx.MIN_BITRATE)
+
+    def codec_options(self):
+        # aiortc sizes the rate control buffer from its own default bitrate
+        return dict({"bufsize": str(self.target_bitrate)}, **self.options)
+
+
+class TunedH264Encoder(TunedEncoder, h264.H264Encoder):
+    """
+    aiortc's H.264 encoder with a configurable bitrate, keyframe interval and preset.
+    """
+
+    def __init__(self, bitrate=None, keyframe_interval=None, preset="default"):
+        super().__init__(bitrate, keyframe_interval, ENCODER_PRESETS["h264"][preset], h264.DEFAULT_BITRATE, h264.MIN_BITRATE)
+
+
+# Private encoder of aiortc's RTCRtpSender, see EncoderProfile.apply
+SENDER_ENCODER = "_RTCRtpSender__encoder"
+
+
+class EncoderProfile:
+    """
+    Codec and encoder settings of the video sent to a peer: the codec is forced
+    through the transceiver's codec preferences, the sender gets an encoder with
+    the bitrate, keyframe interval and preset.
+    ...
+
+    Attributes
+    ----------
+    codec : str
+        'vp8' or 'h264'
+    bitrate : int
+        target bitrate in bits per second, None keeps aiortc's default
+    keyframe_interval : int
+        most frames between two keyframes, None keeps the codec's default
+    preset : str
+        'default' or 'low-latency' speed preset of the encoder
+
+    Methods
+    -------
+    encoder : New encoder with these settings.
+    apply : Set the codec preferences and encoder of a connection's video senders.
+    """
+
+    mime_types = {"vp8": "video/VP8", "h264": "video/H264"}
+
+    def __init__(self, codec="vp8", bitrate=None, keyframe_interval=None, preset="default"):
+        """
+        Constructs all the necessary attributes for the EncoderProfile object.
+
+        Parameters
+        ----------
+        codec : str
+            'vp8' or 'h264'
+        bitrate : int
+            target bitrate in bits per second
+        keyframe_interval : int
+            most frames between two keyframes
+        preset : str
+            'default' or 'low-latency'
+        """
+        if codec not in self.mime_types:
+            raise ValueError("codec should be one of %s" % ", ".join(self.mime_types))
+        if preset not in ENCODER_PRESETS[codec]:
+            raise ValueError("preset should be one of %s" % ", ".join(ENCODER_PRESETS[codec]))
+        self.codec = codec
+        self.bitrate = bitrate
+        self.keyframe_interval = keyframe_interval
+        self.preset = preset
+
+    def encoder(self):
+        encoder = TunedVp8Encoder if self.codec == "vp8" else TunedH264Encoder
+        return encoder(self.bitrate, self.keyframe_interval, self.preset)
+
+    def apply(self, pc):
+        """
+        Method responsible to force the codec of the video transceivers and hand their senders a tuned encoder.
+
+        Parameters
+        ----------
+        pc : obj of class 'RTCPeerConnection
+            connection whose tracks are added, before the offer is created
+        """
+        mime_type = self.mime_types[self.codec].lower()
+        codecs = [codec for codec in RTCRtpSender.getCapabilities("video").codecs
+                  if codec.mimeType.lower() in (mime_type, "video/rtx")]
+        for transceiver in pc.getTransceivers():
+            if transceiver.kind != "video":
+                continue
+            transceiver.setCodecPreferences(codecs)
+            # aiortc has no public way to hand a sender its encoder, it creates the default
+            # one with the first frame unless this private attribute is set already
+            if not hasattr(transceiver.sender, SENDER_ENCODER):
+                raise RuntimeError("RTCRtpSender has no %s attribute in this aiortc version, "
+                                   "EncoderProfile cannot set the encoder" % SENDER_ENCODER)
+            setattr(transceiver.sender, SENDER_ENCODER, self.encoder())
+
+
+def create_frame_generator(pc, render="yuv", lookahead=0, render_threads=2, image_shape=(480, 640, 3), fps=30, balls=1, seed=None,
+                           radius=20, velocity=(2, 2)):
+    """
+    Create the bouncing ball FrameGenerator with the default scene.
+
+    Parameters
+    ----------
+    pc : obj of class 'RTCPeerConnection
+        connection whose data channel receives the coordinates, None for a shared generator
+    render : str
+        'full', 'dirty' or 'yuv' frame rendering
+    lookahead : int
+        frames rendered ahead on a thread pool, 0 renders on the event loop
+    render_threads : int
+        number of render threads used when lookahead is enabled
+    image_shape : tuple of ints
+        (height, width, channel) of the frames
+    fps : int
+        frames sent per second
+    balls : int
+        number of balls, more than one creates a random scene
+    seed : int
+        seed of the random scene
+    radius : int
+        ball radius, the largest radius of a scene
+    velocity : tuple of ints
+        (dx, dy) pixels the single ball moves per frame
+
+    Returns
+    ----------
+    obj of class 'FrameGenerator'
+    """
+    dtype = 'uint8' 
+    velocity = list(velocity)
+    ball_pos = [100, 100]
+    color = (0,0,255)
+    return FrameGenerator(pc, image_shape, dtype, velocity, ball_pos, radius, color,
+                          render=render, lookahead=lookahead, render_threads=render_threads, fps=fps,
+                          balls=balls, seed=seed)
 
 
-async def offer(pc, signaling, loop):
+async def offer(pc, signaling, loop, render="yuv", lookahead=0, render_threads=2, image_shape=(480, 640, 3), fps=30, balls=1, seed=None,
+                replay=None, speed=1.0, cache_frames=450, radius=20, velocity=(2, 2), unordered=False, profile=None):
     """
     Generate offer with media and datachannel transimission and connection 
     with the client.
@@ -201,31 +3022,61 @@ async def offer(pc, signaling, loop):
         For recording te incoming image frames to a video
     loop : obj of class 'asyncio.get_event_loop'
         Event loop object for async coroutines 
+    render : str
+        'full', 'dirty' or 'yuv' frame rendering
+    lookahead : int
+        frames rendered ahead on a thread pool, 0 renders on the event loop
+    render_threads : int
+        number of render threads used when lookahead is enabled
+    image_shape : tuple of ints
+        (height, width, channel) of the frames
+    fps : int
+        frames sent per second
+    balls : int
+        number of balls, more than one creates a random scene
+    seed : int
+        seed of the random scene
+    replay : str
+        video file or raw frame archive streamed in a loop instead of the rendered ball
+    speed : float
+        replay rate relative to real time
+    cache_frames : int
+        most decoded frames the replay keeps
+    radius : int
+        ball radius
+    velocity : tuple of ints
+        (dx, dy) pixels the single ball moves per frame
+    unordered : bool
+        send the coordinates back on an unordered data channel without retransmits
+    profile : obj of class 'EncoderProfile'
+        codec and encoder settings of the video, None keeps aiortc's negotiation and defaults
 
     Returns
     ----------
-    None
+    str
+        why the session ended: 'failed' connection (closed here), 'bye' or 'error' from the signaling
     """
     # connect signaling
     await signaling.connect()
 
-    # Create Instance of FrameGenerator
-    image_shape = (480, 640, 3)
-    dtype = 'uint8' 
-    velocity = [2, 2]
-    ball_pos = [100, 100]
-    radius = 20
-    color = (0,0,255)
-
-
     def add_tracks():
-        framegenerator = FrameGenerator(pc, image_shape, dtype, velocity, ball_pos, radius, color)
+        # Create Instance of FrameGenerator, or replay a recording in its place
+        if replay is not None:
+            framegenerator = ReplayTrack(None, replay, fps, speed, cache_frames)
+        else:
+            framegenerator = create_frame_generator(None, render, lookahead, render_threads, image_shape, fps, balls, seed, radius, velocity)
+        framegenerator.peer = PeerChannel(pc, framegenerator, unordered=unordered)
         pc.addTrack(framegenerator)
+        if profile is not None:
+            profile.apply(pc)
+
+    failed = asyncio.Event()
 
     @pc.on("connectionstatechange")
     async def on_connectionstatechange():
         print("Connection state is ", pc.connectionState)
         if pc.connectionState == "failed":
+            failed.set()
             await pc.close()    
 
     # send offer
@@ -235,19 +3086,213 @@ async def offer(pc, signaling, loop):
 
     print("Server Side to send Video frames to the client....\n")
 
-    # consume signaling
-    await server_consume_signaling(pc, signaling, loop)
+    # consume signaling, until it ends or the connection fails
+    consume = asyncio.ensure_future(server_consume_signaling(pc, signaling, loop))
+    wait_failed = asyncio.ensure_future(failed.wait())
+    await asyncio.wait([consume, wait_failed], return_when=asyncio.FIRST_COMPLETED)
+    wait_failed.cancel()
+    if consume.done():
+        return consume.result()
+    consume.cancel()
+    return "failed"
+
+
+async def offer_sessions(signaling, loop, **options):
+    """
+    Run offer() sessions one after the other, each on a new RTCPeerConnection. A
+    failed connection is renegotiated right away over the same signaling; when the
+    client leaves, the socket signaling is closed and waits for the next client.
+
+    Parameters
+    ----------
+    signaling :  obj of class 'aiortc.contrib.signaling.TcpSocketSignaling' or 'UnixSocketSignaling'
+    loop : obj of class 'asyncio.get_event_loop'
+        Event loop object for async coroutines
+    options : dict
+        keyword arguments of offer()
+
+    Returns
+    ----------
+    None
+    """
+    while True:
+        pc = RTCPeerConnection()
+        try:
+            reason = await offer(pc, signaling, loop, **options)
+        finally:
+            await pc.close()
+        print("Session ended (%s), offering a new connection" % reason)
+        if reason != "failed":
+            await signaling.close()
+
+
+async def serve_peers(framegenerator, host="127.0.0.1", port=1234, path=None, unordered=False, profile=None):
+    """
+    Accept any number of clients on the signaling socket. The frames of one
+    FrameGenerator are rendered once and fanned out to every peer through a
+    MediaRelay, while each peer gets its own data channel and error accounting.
+    Clients connect with the stock tcp-socket or unix-socket signaling.
+
+    Parameters
+    ----------
+    framegenerator : obj of class 'FrameGenerator'
+        shared frame source, created without a peer connection
+    host : str
+        signaling host for tcp sockets
+    port : int
+        signaling port for tcp sockets
+    path : str
+        unix socket path, used instead of host and port when set
+    unordered : bool
+        every peer sends its coordinates on an unordered data channel without retransmits
+    profile : obj of class 'EncoderProfile'
+        codec and encoder settings of every peer's video, each peer has its own encoder
+
+    Returns
+    ----------
+    None
+    """
+    relay = MediaRelay()
+    peers = set()
+    names = itertools.count(1)
+
+    async def session(reader, writer):
+        pc = RTCPeerConnection()
+        peer = PeerChannel(pc, framegenerator, name="peer %d" % next(names), pts_offset=None, unordered=unordered)
+        peers.add(peer)
+        pc.addTrack(PeerTrack(relay.subscribe(framegenerator, buffered=False), peer))
+        if profile is not None:
+            profile.apply(pc)
+        closed = asyncio.Event()
+
+        @pc.on("connectionstatechange")
+        async def on_connectionstatechange():
+            print(peer.name, "connection state is ", pc.connectionState)
+            if pc.connectionState in ("failed", "closed"):
+                closed.set()
+
+        async def consume_signaling():
+            while True:
+                try:
+                    data = await reader.readuntil()
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                obj = object_from_string(data.decode("utf8"))
+                if isinstance(obj, RTCSessionDescription):
+                    await pc.setRemoteDescription(obj)
+                elif isinstance(obj, RTCIceCandidate):
+                    await pc.addIceCandidate(obj)
+                elif obj is BYE:
+                    break
+
+        try:
+            await pc.setLocalDescription(await pc.createOffer())
+            writer.write((object_to_string(pc.localDescription) + "\n").encode("utf8"))
+            print(peer.name, "offered, peers connected:", len(peers))
+
+            tasks = [asyncio.ensure_future(consume_signaling()), asyncio.ensure_future(closed.wait())]
+            _, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+        finally:
+            await pc.close()
+            writer.close()
+            peers.discard(peer)
+            peer.summary()
+
+    if path is not None:
+        server = await asyncio.start_unix_server(session, path=path)
+    else:
+        server = await asyncio.start_server(session, host=host, port=port)
+    print("Server Side fanning out Video frames to every client that connects....\n")
+    async with server:
+        await server.serve_forever()
 
  
 
+def parse_resolution(text):
+    """
+    argparse type for a WIDTHxHEIGHT resolution.
+
+    Returns
+    ----------
+    tuple of ints
+        (height, width, 3) image shape
+    """
+    try:
+        width, height = (int(value) for value in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("resolution should be WIDTHxHEIGHT, e.g. 1280x720")
+    if width < 2 or height < 2 or width % 2 or height % 2:
+        raise argparse.ArgumentTypeError("resolution should be even and at least 2x2, yuv420p halves it")
+    return (height, width, 3)
+
+
+def load_config(parser, args):
+    """
+    Use the options of a JSON config file as defaults, the command line still overrides them.
+
+    Parameters
+    ----------
+    parser : obj of class 'argparse.ArgumentParser'
+    args : list of str
+        command line
+
+    Returns
+    ----------
+    obj of class 'argparse.Namespace'
+    """
+    known, _ = parser.parse_known_args(args)
+    if known.config:
+        with open(known.config) as f:
+            config = {key.replace("-", "_"): value for key, value in json.load(f).items()}
+        unknown = set(config) - set(vars(known))
+        if unknown:
+            parser.error("unknown option %s in %s" % (", ".join(sorted(unknown)), known.config))
+        # Strings go through the option's type like on the command line
+        for action in parser._actions:
+            if action.dest in config and isinstance(config[action.dest], str) and action.type is not None:
+                config[action.dest] = action.type(config[action.dest])
+        parser.set_defaults(**config)
+    return parser.parse_args(args)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Server Side- Generate frames of images and sends to client")
+    parser.add_argument("--config", help="JSON file of option defaults, e.g. {\"fps\": 120, \"resolution\": \"1280x720\"}.")
+    parser.add_argument("--resolution", type=parse_resolution, default=(480, 640, 3), help="Frame size WIDTHxHEIGHT, default 640x480.")
+    parser.add_argument("--fps", type=float, default=30, help="Frames sent per second, 120 and more if the host keeps up; late frames are skipped and counted.")
+    parser.add_argument("--radius", type=int, default=20, help="Ball radius, the largest radius of a --balls scene.")
+    parser.add_argument("--velocity", type=lambda text: tuple(int(value) for value in text.split(",")), default=(2, 2), help="Pixels the ball moves per frame, DX,DY.")
+    parser.add_argument("--render", choices=["full", "dirty", "yuv"], default="yuv", help="Draw every frame from scratch, only redraw the ball's bounding box, or do that in yuv420p planes.")
+    parser.add_argument("--lookahead", type=int, default=0, help="Frames rendered ahead on a thread pool, 0 renders on the event loop.")
+    parser.add_argument("--render-threads", type=int, default=2, help="Render threads used with --lookahead.")
+    parser.add_argument("--balls", type=int, default=1, help="Number of bouncing balls, more than one draws a random scene.")
+    parser.add_argument("--seed", type=int, help="Seed of the random scene.")
+    parser.add_argument("--replay", help="Stream this video file or client.py --record-raw archive in a loop instead of the rendered ball.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay rate relative to real time, e.g. 4 to stress the client.")
+    parser.add_argument("--cache-frames", type=int, default=450, help="Most decoded replay frames kept in memory.")
+    parser.add_argument("--unordered", action="store_true", help="Coordinates come back on an unordered data channel without retransmits, the client sends only the newest.")
+    parser.add_argument("--codec", choices=list(EncoderProfile.mime_types), help="Force the video codec, default is aiortc's negotiation (VP8 first).")
+    parser.add_argument("--bitrate", type=int, help="Target video bitrate in bit/s, the client's estimate can only lower it.")
+    parser.add_argument("--keyframe-interval", type=int, help="Most frames between two keyframes.")
+    parser.add_argument("--preset", choices=["default", "low-latency"], default="default", help="Encoder speed preset, low-latency trades quality for encode time.")
+    parser.add_argument("--fanout", action="store_true", help="Serve any number of clients from one frame source, needs tcp-socket or unix-socket signaling.")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this local port, /profile?seconds=N takes a capture.")
+    parser.add_argument("--profile-dir", default=".", help="Where SIGUSR1 and /profile write their cProfile captures.")
+    parser.add_argument("--profile-seconds", type=float, default=10.0, help="Duration of a capture started by SIGUSR1.")
     parser.add_argument("--verbose", "-v", action="count")
     add_signaling_arguments(parser)
-    args = parser.parse_args()
+    parser.set_defaults(signaling="tcp-socket")
+    args = load_config(parser, sys.argv[1:])
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
+    listener = start_log_listener(logging.DEBUG if args.verbose else logging.INFO)
+    profile = None
+    if args.codec or args.bitrate or args.keyframe_interval or args.preset != "default":
+        # Encoder settings need a known codec, VP8 is what aiortc negotiates first
+        profile = EncoderProfile(args.codec or "vp8", args.bitrate, args.keyframe_interval, args.preset)
 
     # create signaling and peer connection
     signaling = create_signaling(args)
@@ -255,17 +3300,60 @@ if __name__ == "__main__":
 
     # run event loop
     loop = asyncio.get_event_loop()
+    PROFILER.directory, PROFILER.seconds = args.profile_dir, args.profile_seconds
+    PROFILER.install(loop)
+    if args.metrics_port:
+        loop.run_until_complete(METRICS.serve(args.metrics_port, profiler=PROFILER))
 
+    session = None
     try:
-        asyncio.ensure_future(offer(
-                pc=pc,
-                signaling=signaling,
-                loop=loop))
+        if args.fanout:
+            if args.signaling not in ("tcp-socket", "unix-socket"):
+                parser.error("--fanout needs --signaling tcp-socket or unix-socket")
+            if args.replay:
+                framegenerator = ReplayTrack(None, args.replay, args.fps, args.speed, args.cache_frames)
+            else:
+                framegenerator = create_frame_generator(None, args.render, args.lookahead, args.render_threads, args.resolution,
+                                                        args.fps, args.balls, args.seed, args.radius, args.velocity)
+            asyncio.ensure_future(serve_peers(
+                    framegenerator,
+                    host=args.signaling_host,
+                    port=args.signaling_port,
+                    path=args.signaling_path if args.signaling == "unix-socket" else None,
+                    unordered=args.unordered,
+                    profile=profile))
+        else:
+            options = dict(
+                    image_shape=args.resolution,
+                    fps=args.fps,
+                    radius=args.radius,
+                    velocity=args.velocity,
+                    render=args.render,
+                    lookahead=args.lookahead,
+                    render_threads=args.render_threads,
+                    balls=args.balls,
+                    seed=args.seed,
+                    replay=args.replay,
+                    speed=args.speed,
+                    cache_frames=args.cache_frames,
+                    unordered=args.unordered,
+                    profile=profile)
+            if args.signaling == "copy-and-paste":
+                session = asyncio.ensure_future(offer(pc=pc, signaling=signaling, loop=loop, **options))
+                # One session only, exit once it ended or its signaling failed
+                session.add_done_callback(lambda _: loop.stop())
+            else:
+                # Renegotiate on a new connection after a failure and wait for the next client
+                session = asyncio.ensure_future(offer_sessions(signaling, loop, **options))
         loop.run_forever()
     except KeyboardInterrupt:
         pass
     finally:
         # cleanup
+        if session is not None:
+            session.cancel()
+            loop.run_until_complete(asyncio.gather(session, return_exceptions=True))
         loop.run_until_complete(signaling.close())
         loop.run_until_complete(pc.close())
+        listener.stop()
 
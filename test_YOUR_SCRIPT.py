@@ -1,12 +1,20 @@
 # Paras Savnani
 
 import cv2
+import time
+import inspect
 import asyncio
+import fractions
+import functools
 import argparse
+import pstats
 import pytest
 import numpy as np
+import av
+from av import VideoFrame
 import multiprocessing as mp
 from queue import Queue
+from types import SimpleNamespace
 from unittest.mock import patch, ANY
 from asyncmock import AsyncMock
 from asynctest import CoroutineMock
@@ -16,11 +24,54 @@ from aiortc import (
     RTCSessionDescription,
     VideoStreamTrack,
 )
+from aiortc.codecs.vpx import Vp8Encoder, VpxPayloadDescriptor
 from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder
 from aiortc.contrib.signaling import BYE, add_signaling_arguments, create_signaling
 
-from docker_server.server import FrameGenerator
-from docker_client.client import ImageProcess, FrameReceiever
+import docker_server.server
+import docker_client.client
+from docker_server.server import FrameGenerator, BallRenderer, YuvBallRenderer, BallScene, SceneRenderer, BallTrajectory, PeerChannel, PositionHistory, SlidingErrorStats, ReplayTrack, PacingClock, VideoFramePool, create_frame_generator, EncoderProfile, Metrics, ProfileCapture, server_consume_signaling, parse_resolution, unpack_coordinates, unpack_detections, unpack_batch, match_detections
+from docker_client.client import ImageProcess, FrameReceiever, DetectorPool, DisplayProcess, FrameRing, FrameQueue, TrackingDetector, ComponentsDetector, NumpyMomentsDetector, Detector, DETECTORS, luma_plane, pack_coordinates, pack_detections, pack_batch, MomentsDetector, RawFrameArchive, CoordinateSender, bgr_image, client_consume_signaling
+
+
+class BufferedChannel:
+    """
+    Data channel stand-in whose sent messages stay buffered until drain() hands them to SCTP.
+    """
+    def __init__(self):
+        self.sent = []
+        self.bufferedAmount = self.bufferedAmountLowThreshold = 0
+        self.readyState = "open"
+        self.listeners = {}
+
+    def on(self, event, listener):
+        self.listeners[event] = listener
+
+    def send(self, message):
+        self.sent.append(message)
+        self.bufferedAmount += len(message)
+
+    def drain(self):
+        self.bufferedAmount = 0
+        self.listeners["bufferedamountlow"]()
+
+
+class ScriptedSignaling:
+    """
+    Signaling stand-in which hands out a fixed list of objects, raising the exceptions among them.
+    """
+    def __init__(self, items):
+        self.items = list(items)
+        self.sent = []
+
+    async def receive(self):
+        item = self.items.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    async def send(self, obj):
+        self.sent.append(obj)
 
 
 @pytest.mark.asyncio
@@ -58,6 +109,229 @@ class TestClient:
         assert ip.centre_coordinate[0].value == TestClient.centre[0]  # custom defined
         assert ip.centre_coordinate[1].value == TestClient.centre[1]  # custom defined
 
+    def test_detector_pool(self):
+        # Workers keep running across frames and exit cleanly on stop
+        q = mp.Queue()
+        for _ in range(5):
+            q.put(np.zeros((100,100,3), dtype='uint8'))
+
+        centre_coordinate = (mp.Value('i', 0), mp.Value('i', 0))
+        pool = DetectorPool(q, centre_coordinate, workers=2)
+        pool.start()
+        counts = pool.stop()
+        assert sum(counts) == 5
+        assert len(counts) == 2
+        assert not any(worker.is_alive() for worker in pool.workers)
+
+    def test_tagged_results(self):
+        # Detections carry the pts of the frame they were made on
+        q, results = mp.Queue(), mp.Queue()
+        image = np.zeros((100,100,3), dtype='uint8')
+        cv2.circle(image, TestClient.centre, 10, (0,0,255),-1)
+        q.put((3000, image))
+
+        centre_coordinate = (mp.Value('i', 0), mp.Value('i', 0))
+        pool = DetectorPool(q, centre_coordinate, workers=1, results=results)
+        pool.start()
+        pts, x, y, timestamp, queue_wait, detect_seconds = results.get(timeout=5)
+        pool.stop()
+        assert (pts, x, y) == (3000, TestClient.centre[0], TestClient.centre[1])
+        assert queue_wait >= 0 and detect_seconds > 0
+
+        message = pack_coordinates(pts, x, y, timestamp)
+        assert unpack_coordinates(message) == (pts, x, y, timestamp)
+
+    def test_frame_queue_overflow(self):
+        # Bounded queue keeps the configured frames and counts the rest as dropped
+        kept = {}
+        for policy in FrameQueue.policies:
+            q = FrameQueue(maxsize=2, policy=policy)
+            for i in range(5):
+                q.put(i)
+            q.put(None)
+            kept[policy] = list(iter(lambda: q.get(timeout=1), None))
+            assert q.dropped.value + len(kept[policy]) == 5
+
+        assert kept["drop-oldest"] == [3, 4]
+        assert kept["drop-newest"] == [0, 1]
+        assert kept["latest"] == [4]
+        # The putting side never takes frames off the queue, a stalled pool only bounds it
+        q = FrameQueue(maxsize=2, policy="latest")
+        start = time.perf_counter()
+        queued = [q.put(np.zeros((480, 640, 3), dtype='uint8')) for _ in range(20)]
+        assert time.perf_counter() - start < 0.05 and queued.count(True) == q.limit == 8
+        q.put(None)
+        frames = 0
+        while q.get(timeout=1) is not None:
+            frames += 1
+        assert frames == 1 and q.dropped.value == 19
+
+    def test_tracking_detector(self):
+        # Ball is found in the predicted window, and by a full search after it jumps
+        detector = TrackingDetector(window=30)
+        positions = [(100, 100), (110, 104), (120, 108), (130, 112), (400, 50)]
+        for i, centre in enumerate(positions):
+            image = np.zeros((480,640,3), dtype='uint8')
+            cv2.circle(image, centre, 10, (0,0,255),-1)
+            assert detector.detect(image, i * 3000) == centre
+        assert detector.predict(5 * 3000) is not None
+        assert (detector.full_searches, detector.window_searches) == (2, 3)
+
+    def test_luma_plane(self):
+        # Ball is found on the Y plane of a decoded yuv420p frame without converting it to bgr
+        image = np.zeros((480,640,3), dtype='uint8')
+        cv2.circle(image, TestClient.centre, 10, (0,0,255),-1)
+        frame = VideoFrame.from_ndarray(image, format="bgr24").reformat(format="yuv420p")
+        luma = luma_plane(frame)
+        assert luma.shape == (480, 640)
+        assert TrackingDetector().detect(luma) == TestClient.centre
+
+    def test_components_detector(self):
+        # Every ball is found and the centres survive the detections message
+        image = np.zeros((480,640,3), dtype='uint8')
+        centres = [(40, 40), (200, 100), (600, 400)]
+        for centre in centres:
+            cv2.circle(image, centre, 10, (0,0,255),-1)
+        cv2.circle(image, (600, 400), 15, (0,0,255),-1)
+        xs, ys = ComponentsDetector().detect_all(image)
+        pts, rec_x, rec_y, timestamp = unpack_detections(pack_detections(3000, xs, ys, 1.5))
+        assert (pts, timestamp) == (3000, 1.5)
+        assert sorted(zip(rec_x.tolist(), rec_y.tolist())) == centres
+        # A single centre is the largest ball, single-ball backends find one ball with detect_all
+        assert ComponentsDetector().detect(image) == (600, 400)
+        xs, ys = MomentsDetector().detect_all(cv2.circle(np.zeros_like(image), (600, 400), 15, (0,0,255),-1))
+        assert (xs.tolist(), ys.tolist()) == ([600], [400])
+        with pytest.raises(TypeError):
+            Detector()
+
+    def test_detector_backends(self):
+        # Every backend finds the ball in a bgr frame and in its luma plane
+        image = np.zeros((480,640,3), dtype='uint8')
+        cv2.circle(image, (300, 200), 20, (0,0,255),-1)
+        luma = cv2.cvtColor(image, cv2.COLOR_BGR2YUV_I420)[:480]
+        for name, backend in DETECTORS.items():
+            for frame in (image, luma):
+                x, y = backend().detect(frame)
+                assert abs(x - 300) <= 1 and abs(y - 200) <= 1, name
+
+    def test_batch_detection(self):
+        # A worker takes every queued frame at once and reports them in one batch message
+        frames = np.zeros((3,480,640), dtype='uint8')
+        for i, frame in enumerate(frames):
+            cv2.circle(frame, (100 + 50 * i, 200), 10, 255, -1)
+        xs, ys, found = MomentsDetector().detect_batch(frames, np.arange(3))
+        assert list(zip(xs, ys)) == [MomentsDetector().detect(frame) for frame in frames] and found.all()
+        xs, ys, found = NumpyMomentsDetector().detect_batch(frames, np.arange(3))
+        assert list(zip(xs, ys)) == [MomentsDetector().detect(frame) for frame in frames] and found.all()
+
+        queue, results = FrameQueue(8, "drop-oldest"), mp.Queue()
+        for i, frame in enumerate(frames):
+            queue.put((i * 3000, frame, time.perf_counter()))
+        time.sleep(0.1)
+        worker = ImageProcess(queue, (mp.Value('i', 0), mp.Value('i', 0)), results=results, batch=4)
+        assert worker._findBatch() == 3
+        pts, x, y, timestamp = results.get(timeout=1)[:4]
+        rec_pts, rec_x, rec_y, rec_timestamp = unpack_batch(pack_batch(pts, x, y, timestamp))
+        assert rec_pts.tolist() == [0, 3000, 6000] and rec_x.tolist() == [100, 150, 200] and rec_y.tolist() == [200] * 3
+        assert rec_timestamp == timestamp
+
+    def test_raw_archive(self, tmp_path):
+        # Frames are stored unencoded and read back by pts without touching the others
+        path = str(tmp_path / "frames.raw")
+        archive = RawFrameArchive(path, "w", capacity=1024)
+        for i in range(5):
+            image = np.full((48,64,3), 40 * i, dtype='uint8')
+            frame = VideoFrame.from_ndarray(image, format="bgr24").reformat(format="yuv420p")
+            frame.pts = i * 3000
+            archive.append(frame)
+        archive.close()
+
+        archive = RawFrameArchive(path)
+        assert len(archive) == 5 and archive.find(6000) == 2 and archive.find(6001) is None
+        frame = archive.frame(archive.find(9000))
+        assert frame.pts == 9000 and (frame.width, frame.height) == (64, 48)
+        assert np.array_equal(luma_plane(frame), luma_plane(VideoFrame.from_ndarray(np.full((48,64,3), 120, dtype='uint8'), format="bgr24").reformat(format="yuv420p")))
+        archive.close()
+
+    def test_bgr_image(self):
+        # Conversion into reused buffers matches to_ndarray up to rounding
+        image = np.zeros((48, 64, 3), dtype='uint8')
+        cv2.circle(image, (30, 20), 10, (0, 0, 255), -1)
+        frame = VideoFrame.from_ndarray(image, format="bgr24").reformat(format="yuv420p")
+        out = np.empty((48, 64, 3), dtype='uint8')
+        assert bgr_image(frame, np.empty((72, 64), dtype='uint8'), out) is out
+        assert np.abs(out.astype(int) - frame.to_ndarray(format="bgr24")).max() <= 2
+
+    def test_coordinate_sender(self):
+        # While a message waits in the channel's buffer newer ones replace each other, the newest goes out once it drains
+        channel = BufferedChannel()
+        sender = CoordinateSender(channel, coalesce=True)
+        assert sender.send(b"1") and not sender.send(b"2") and not sender.send(b"3")
+        assert channel.sent == [b"1"] and sender.coalesced == 1
+        channel.drain()
+        assert channel.sent == [b"1", b"3"] and sender.pending is None and sender.sent == 2
+        reliable = CoordinateSender(BufferedChannel())
+        assert reliable.send(b"1") and reliable.send(b"2") and reliable.channel.sent == [b"1", b"2"]
+
+    def test_signaling_renew(self):
+        # A second offer is answered on a new connection, the session ends on BYE instead of stopping the loop
+        async def session():
+            servers = [RTCPeerConnection() for _ in range(2)]
+            offers = []
+            for server in servers:
+                server.createDataChannel("chat")
+                await server.setLocalDescription(await server.createOffer())
+                offers.append(server.localDescription)
+            renewed = []
+
+            async def renew(old):
+                await old.close()
+                renewed.append(RTCPeerConnection())
+                return renewed[-1]
+            signaling = ScriptedSignaling(offers + [BYE])
+            pc, reason = await client_consume_signaling(RTCPeerConnection(), signaling, MediaBlackhole(), None, renew)
+            for connection in servers + [pc]:
+                await connection.close()
+            return pc, reason, renewed, offers, signaling.sent
+
+        pc, reason, renewed, offers, sent = asyncio.get_event_loop().run_until_complete(session())
+        assert reason == "bye" and renewed == [pc] and pc.remoteDescription.sdp == offers[1].sdp
+        assert [answer.type for answer in sent] == ["answer", "answer"]
+        assert FrameReceiever.session_started is not None and FrameReceiever.awaiting_coordinate
+
+    def test_display_rate_limit(self):
+        # Preview takes at most one frame per refresh interval and keeps only the latest
+        display = DisplayProcess(refresh=10.0)
+        first, second = np.zeros((10,10,3), dtype='uint8'), np.ones((10,10,3), dtype='uint8')
+        assert display.offer(first, 1, 2)
+        assert not display.offer(second, 3, 4)
+        time.sleep(0.15)
+        assert display.offer(second, 3, 4)
+        frame, x, y = display.frames.get(timeout=1)
+        assert (x, y) == (3, 4) and frame.max() == 1
+
+    def test_frame_ring(self):
+        # Frames are read in place and stale slots are detected
+        ring = FrameRing((100,100,3), slots=2)
+        try:
+            image = np.zeros((100,100,3), dtype='uint8')
+            cv2.circle(image, TestClient.centre, 10, (0,0,255),-1)
+            slot, seq = ring.write(image)
+            view = ring.read(slot, seq)
+            assert np.array_equal(view, image)
+            assert np.shares_memory(view, ring.frames)
+
+            ring.write(image)
+            ring.write(image)   # laps the first slot
+            assert ring.read(slot, seq) is None
+            assert not ring.valid(slot, seq)
+            # The preview drops a copy taken from a slot which was overwritten meanwhile
+            display = DisplayProcess(refresh=10.0)
+            assert not display.offer(view, 1, 2, functools.partial(ring.valid, slot, seq))
+            assert display.frames.latest.value == 0
+        finally:
+            ring.close()
+
     
 
 @pytest.mark.asyncio
@@ -139,6 +413,344 @@ class TestServer:
         except ValueError:
             pass 
 
+    def test_dirty_render(self):
+        # Dirty-rectangle frames are identical to frames drawn from scratch
+        full = FrameGenerator(RTCPeerConnection(), (120, 160, 3), 'uint8', [3, 2], [30, 30], 20, (0,0,255))
+        dirty = FrameGenerator(RTCPeerConnection(), (120, 160, 3), 'uint8', [3, 2], [30, 30], 20, (0,0,255), render="dirty")
+        for _ in range(300):
+            assert np.array_equal(full.generateFrame(), dirty.generateFrame())
+
+        # Ball partially outside the frame is clipped the same way as cv2.circle
+        renderer = BallRenderer((120, 160, 3), 'uint8', 20, (0,255,0))
+        for x, y in [(5, 5), (155, 115), (-10, 60), (80, 130)]:
+            expected = np.zeros((120, 160, 3), dtype='uint8')
+            cv2.circle(expected, (x, y), 20, (0,255,0), -1)
+            assert np.array_equal(renderer.render(x, y), expected)
+
+    def test_trajectory(self):
+        # Closed-form position matches stepping through every bounce
+        for velocity, ball_pos in [([2, 2], [100, 100]), ([3, -5], [101, 57]), ([-7, 4], [33, 200]), ([0, 3], [50, 50])]:
+            pc = RTCPeerConnection()
+            framegenerator = FrameGenerator(pc, (240, 320, 3), 'uint8', list(velocity), list(ball_pos), 20, (0,0,255))
+            trajectory = BallTrajectory((240, 320, 3), ball_pos, velocity, 20)
+            for n in range(1, 1000):
+                framegenerator.generateFrame()
+                assert trajectory.state(n) == tuple(framegenerator.ball_pos + framegenerator.velocity)
+
+    def test_lookahead(self):
+        # Prefetched frames are the frames recv would have rendered itself
+        async def frames(lookahead):
+            pc = RTCPeerConnection()
+            framegenerator = FrameGenerator(pc, (120, 160, 3), 'uint8', [3, 2], [30, 30], 20, (0,0,255), lookahead=lookahead)
+            result = []
+            for _ in range(20):
+                frame = await framegenerator.recv()
+                result.append((frame.to_ndarray(format='bgr24'), list(framegenerator.ball_pos)))
+            framegenerator.stop()
+            await pc.close()
+            return result
+
+        loop = asyncio.get_event_loop()
+        for (inline, inline_pos), (ahead, ahead_pos) in zip(loop.run_until_complete(frames(0)), loop.run_until_complete(frames(4))):
+            assert np.array_equal(inline, ahead)
+            assert inline_pos == ahead_pos
+
+    def test_peer_channel(self):
+        # Each peer matches its coordinates with its own pts offset and keeps its own errors
+        framegenerator = FrameGenerator(None, (120, 160, 3), 'uint8', [3, 2], [30, 30], 20, (0,0,255))
+        assert framegenerator.peer is None
+        framegenerator.history.add(93000, 50, 60, time.time())
+
+        late, early = PeerChannel(RTCPeerConnection(), framegenerator, "late", pts_offset=90000), PeerChannel(RTCPeerConnection(), framegenerator, "early")
+        late.channel.emit("message", pack_coordinates(3000, 53, 64, time.time()))
+        early.channel.emit("message", pack_coordinates(3000, 53, 64, time.time()))
+        assert (late.messages, late.matched, late.error_max) == (1, 1, 5.0)
+        assert (early.messages, early.matched) == (1, 0)
+
+    def test_session_restart(self):
+        # Signaling errors end the session with a reason, and each session times its first frame and coordinates
+        loop = asyncio.get_event_loop()
+        pc = RTCPeerConnection()
+        assert loop.run_until_complete(server_consume_signaling(pc, ScriptedSignaling([ValueError("garbled")]), loop)) == "error"
+        assert loop.run_until_complete(server_consume_signaling(pc, ScriptedSignaling([None]), loop)) == "bye"
+
+        framegenerator = FrameGenerator(None, (120, 160, 3), 'uint8', [3, 2], [30, 30], 20, (0,0,255))
+        peer = PeerChannel(pc, framegenerator)
+        assert peer.first_frame is None and peer.first_coordinate is None
+        peer.frame_sent()
+        first_frame = peer.first_frame
+        peer.frame_sent()
+        peer.channel.emit("message", pack_coordinates(0, 30, 30, time.time()))
+        assert peer.first_frame == first_frame and peer.first_coordinate >= first_frame
+        loop.run_until_complete(pc.close())
+
+    def test_position_history(self):
+        # Ground truth is kept per pts for a bounded number of frames
+        history = PositionHistory(size=2)
+        history.add(0, 100, 100, 1.0)
+        history.add(3000, 102, 102, 2.0)
+        history.add(6000, 104, 104, 3.0)
+        assert history.get(0) is None
+        assert history.get(3000) == (102, 102, 2.0)
+        assert history.get(5999) == (104, 104, 3.0)   # truncated by the decoder
+
+    def test_frame_rate(self):
+        # pts advance by one frame period of the configured rate
+        framegenerator = FrameGenerator(None, TestServer.image_shape, TestServer.dtype, [2, 2], [100, 100], 20, (0, 0, 255), fps=60)
+
+        async def timestamps():
+            return [(await framegenerator.next_timestamp())[0] for _ in range(3)]
+
+        assert asyncio.get_event_loop().run_until_complete(timestamps()) == [0, 1500, 3000]
+
+    def test_yuv_renderer(self):
+        # Ball is drawn straight into the planes of a yuv420p frame and erased when it moves
+        renderer = YuvBallRenderer((480,640,3), 'uint8', 20, (0,0,255))
+        renderer.render(100, 100)
+        canvas = renderer.render(300, 200)
+        assert canvas.shape == (720, 640)
+        _, thresh = cv2.threshold(canvas[:480], 50, 255, cv2.THRESH_BINARY)
+        M = cv2.moments(thresh, True)
+        assert (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"])) == (300, 200)
+        frame = VideoFrame.from_ndarray(canvas, format="yuv420p").to_ndarray(format="bgr24")
+        assert frame[200, 300, 2] > 200 and frame[100, 100].max() < 10
+
+    def test_ball_scene(self):
+        # Balls move in one vectorized step, bounce off the walls and are matched to detections
+        scene = BallScene((480,640,3), [[100, 100], [618, 300]], [[2, 2], [3, -1]], [20, 20], [(0,0,255), (255,255,255)])
+        scene.step()
+        assert scene.positions.tolist() == [[102, 102], [621, 299]]
+        assert scene.velocities.tolist() == [[2, 2], [-3, -1]]
+        canvas = SceneRenderer((480,640,3), 'uint8', "bgr24").render(scene)
+        assert canvas[102, 102].tolist() == [0, 0, 255] and canvas[299, 621].tolist() == [255, 255, 255]
+
+        balls, detections, errors = match_detections(scene.positions[:, 0], scene.positions[:, 1], np.array([620, 400]), np.array([299, 400]), 40)
+        assert balls.tolist() == [1] and detections.tolist() == [0] and errors.tolist() == [1.0]
+
+    def test_error_stats(self):
+        # Running mean, std and percentiles over a sliding window, old slices expire
+        stats = SlidingErrorStats(window=10.0, slices=10)
+        errors = np.random.default_rng(0).exponential(2.0, 1000)
+        for i, error in enumerate(errors):
+            stats.add(error, now=i * 0.005)
+        summary = stats.summary(now=5.0)
+        assert summary["count"] == 1000 and summary["max"] == errors.max()
+        assert summary["mean"] == pytest.approx(errors.mean()) and summary["std"] == pytest.approx(errors.std(ddof=1))
+        assert summary["p90"] == pytest.approx(np.percentile(errors, 90), rel=0.1)
+
+        stats.add(7.0, now=14.0)
+        assert stats.summary(now=14.0)["count"] < 1000
+        assert stats.summary(now=30.0)["count"] == 0 and stats.total.count == 1001
+
+    def test_replay_track(self, tmp_path):
+        # A clip is decoded once, later loops come from the cache and the pts keep increasing
+        path = str(tmp_path / "clip.mp4")
+        with av.open(path, "w") as container:
+            stream = container.add_stream("mpeg4", rate=30)
+            stream.width, stream.height, stream.pix_fmt = 64, 48, "yuv420p"
+            for i in range(5):
+                container.mux(stream.encode(VideoFrame.from_ndarray(np.full((48,64,3), 40 * i, dtype='uint8'), format="bgr24")))
+            container.mux(stream.encode())
+
+        async def replay(track, count):
+            frames, pts = [], []
+            for _ in range(count):
+                frames.append(await track.recv())
+                pts.append(frames[-1].pts)
+            return frames, pts
+        track = ReplayTrack(None, path, speed=10, cache_frames=10)
+        frames, pts = asyncio.get_event_loop().run_until_complete(replay(track, 6))
+        # The encoder marks a forced keyframe on the cached frame, the next loop clears it
+        frames[0].pict_type = av.video.frame.PictureType.I
+        more, more_pts = asyncio.get_event_loop().run_until_complete(replay(track, 6))
+        frames, pts = frames + more, pts + more_pts
+        track.stop()
+        assert track.length == 5 and track.misses == 5 and track.hits == 7
+        assert frames[5] is frames[0] and pts == [3000 * i for i in range(12)]
+        assert frames[10] is frames[0] and frames[10].pict_type == av.video.frame.PictureType.NONE
+
+    def test_video_frame_pool(self):
+        # A buffer is written again only once no frame holds it, odd chroma widths included
+        pool = VideoFramePool(66, 52, "yuv420p", size=2)
+        images = [np.full((78, 66), i, dtype='uint8') for i in range(4)]
+        first = pool.wrap(images[0])
+        second = pool.wrap(images[1])
+        assert (first.to_ndarray() == images[0]).all() and (second.to_ndarray() == images[1]).all()
+        # A plane keeps the buffer of its frame
+        plane = first.planes[0]
+        del first
+        third = pool.wrap(images[2])
+        assert pool.allocated == 3 and (np.frombuffer(plane, np.uint8) == 0).all()
+        del plane
+        fourth = pool.wrap(images[3])
+        assert pool.allocated == 3 and (fourth.to_ndarray() == images[3]).all() and (third.to_ndarray() == images[2]).all()
+        bgr = VideoFramePool(66, 50, "bgr24").wrap(np.full((50, 66, 3), (1, 2, 3), dtype='uint8'))
+        assert (bgr.to_ndarray(format="bgr24") == (1, 2, 3)).all()
+        # A yuv420p height from_numpy_buffer can't read gets a new frame, padded rows included
+        unpooled = VideoFramePool(66, 50, "yuv420p")
+        frame = unpooled.wrap(np.full((75, 66), 7, dtype='uint8'))
+        del frame
+        frame = unpooled.wrap(np.full((75, 66), 9, dtype='uint8'))
+        assert unpooled.allocated == 2 and (frame.to_ndarray() == 9).all()
+
+    def test_video_frame_pool_keyframes(self):
+        # A keyframe forced on a pooled frame is not repeated when the frame is reused
+        pool, encoder, keyframes = VideoFramePool(64, 48, "yuv420p", size=2), Vp8Encoder(), []
+        for i in range(12):
+            frame = pool.wrap(np.full((72, 64), i * 10, dtype='uint8'))
+            frame.pts, frame.time_base = i * 3000, fractions.Fraction(1, 90000)
+            payloads, _ = encoder.encode(frame, force_keyframe=(i == 5))
+            # P bit of the VP8 payload header is clear on keyframes
+            if not VpxPayloadDescriptor.parse(payloads[0])[1][0] & 1:
+                keyframes.append(i)
+            del frame
+        assert keyframes == [0, 5] and pool.allocated == 1
+
+    def test_encoder_profile(self):
+        # The offer only lists the forced codec and the sender encodes with the profile's settings
+        async def offer_codecs(profile):
+            pc = RTCPeerConnection()
+            pc.addTrack(VideoStreamTrack())
+            profile.apply(pc)
+            await pc.setLocalDescription(await pc.createOffer())
+            encoder = pc.getTransceivers()[0].sender._RTCRtpSender__encoder
+            await pc.close()
+            return {line.split()[1].split("/")[0] for line in pc.localDescription.sdp.splitlines() if line.startswith("a=rtpmap")}, encoder
+        codecs, encoder = asyncio.get_event_loop().run_until_complete(offer_codecs(EncoderProfile("h264", 4000000, 60, "low-latency")))
+        assert codecs == {"H264", "rtx"}
+        frame = VideoFrame.from_ndarray(np.zeros((48, 64, 3), dtype='uint8'), format="bgr24")
+        frame.pts, frame.time_base = 0, fractions.Fraction(1, 90000)
+        payloads, _ = encoder.encode(frame)
+        assert payloads and encoder.codec.gop_size == 60 and encoder.options == {"preset": "ultrafast"}
+        encoder.target_bitrate = 10000000
+        assert encoder.target_bitrate == 4000000
+        with pytest.raises(ValueError):
+            EncoderProfile("av1")
+        # A forced keyframe leaves the shared frame alone, the tuned settings reach libvpx
+        vp8 = EncoderProfile("vp8", 800000, 30, "low-latency").encoder()
+        shared = VideoFramePool(64, 48, "yuv420p").wrap(np.zeros((72, 64), dtype='uint8'))
+        shared.pts, shared.time_base = 0, fractions.Fraction(1, 90000)
+        payloads, _ = vp8.encode(shared, force_keyframe=True)
+        assert not VpxPayloadDescriptor.parse(payloads[0])[1][0] & 1
+        assert shared.pict_type == av.video.frame.PictureType.NONE
+        assert vp8.codec.gop_size == 30 and vp8.codec.bit_rate == 800000
+        # Without aiortc's private encoder attribute the profile fails instead of being ignored
+        sender = SimpleNamespace()
+        transceiver = SimpleNamespace(kind="video", sender=sender, setCodecPreferences=lambda codecs: None)
+        with pytest.raises(RuntimeError):
+            EncoderProfile("vp8").apply(SimpleNamespace(getTransceivers=lambda: [transceiver]))
+
+    def test_pacing_clock(self):
+        # pts come from the frame index, no rounding drift at 120 or 70 fps, and an overrun skips slots
+        async def ticks(clock, count, overrun=0):
+            pts = []
+            for i in range(count):
+                pts.append(await clock.tick())
+                if i == 2:
+                    time.sleep(overrun)
+            return pts
+        loop = asyncio.get_event_loop()
+        assert PacingClock(120).pts(7200) == 60 * 90000 and PacingClock(70).pts(70 * 3600) == 3600 * 90000
+        assert loop.run_until_complete(ticks(PacingClock(30), 6)) == [3000 * i for i in range(6)]
+
+        clock = PacingClock(100)
+        pts = loop.run_until_complete(ticks(clock, 6, overrun=0.055))
+        assert clock.missed >= 1 and clock.skipped >= 4 and pts[3] - pts[2] >= 5 * 900
+        assert parse_resolution("1280x720") == (720, 1280, 3)
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_resolution("1280")
+
+    def test_pacing_skips_move_ball(self):
+        # When the clock skips slots the ball moves through them, with and without the prefetcher
+        slots = [0, 1, 4, 5, 9, 10]
+        for lookahead in (0, 2):
+            generator = create_frame_generator(None, "yuv", lookahead, image_shape=(200, 240, 3), velocity=(13, 11))
+            trajectory = BallTrajectory((200, 240, 3), [100, 100], [13, 11], 20)
+            ticks = iter(slots)
+
+            async def tick():
+                generator.clock.index = next(ticks)
+                return generator.clock.pts(generator.clock.index)
+            generator.clock.tick = tick
+
+            async def run():
+                for slot in slots:
+                    frame = await generator.recv()
+                    assert frame.pts == 3000 * slot
+                    assert tuple(generator.ball_pos) == trajectory.state(slot + 1)[:2]
+            asyncio.get_event_loop().run_until_complete(run())
+            generator.stop()
+
+    def test_metrics(self):
+        # Histogram quantiles and the Prometheus text served on the scrape endpoint
+        metrics = Metrics()
+        histogram = metrics.histogram("stage_seconds", "Stage time", buckets=(0.001, 0.01, 0.1))
+        for value in [0.0005] * 50 + [0.05] * 50:
+            histogram.observe(value)
+        metrics.counter("frames_total", "Frames").inc(3)
+        assert histogram.quantile(0.5) == pytest.approx(0.001)
+        assert 0.01 < histogram.quantile(0.99) <= 0.1
+
+        async def scrape():
+            server = await metrics.serve(0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            server.close()
+            return response.decode()
+
+        response = asyncio.get_event_loop().run_until_complete(scrape())
+        assert response.startswith("HTTP/1.1 200 OK")
+        assert 'stage_seconds_bucket{le="0.01"} 50' in response
+        assert 'stage_seconds_bucket{le="+Inf"} 100' in response
+        assert "frames_total 3" in response
+
+    def test_profile_capture(self, tmp_path):
+        # Stage hooks time wall-clock and CPU, /profile writes a pstats capture of the event loop
+        metrics = Metrics()
+        stage = metrics.stage("busy", "a busy loop")
+        busy = stage(lambda n: sum(i * i for i in range(n)))
+        for _ in range(3):
+            busy(20000)
+        snapshot = metrics.snapshot()
+        assert snapshot["busy_wall_seconds"]["count"] == snapshot["busy_cpu_seconds"]["count"] == 3
+        assert metrics.metrics["busy_cpu_seconds"].sum > 0
+
+        profiler = ProfileCapture("test", str(tmp_path))
+
+        async def capture(query):
+            server = await metrics.serve(0, profiler=profiler)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /profile?%s HTTP/1.1\r\nHost: localhost\r\n\r\n" % query)
+            await asyncio.sleep(0.05)
+            # A second capture is refused while the first one runs
+            running = profiler.start() is None
+            if not running:
+                profiler.stop()
+            response = await reader.read()
+            writer.close()
+            server.close()
+            return running, response.decode()
+
+        running, response = asyncio.get_event_loop().run_until_complete(capture(b"seconds=0.2"))
+        assert running and response.startswith("HTTP/1.1 200 OK")
+        path = response.split("\r\n\r\n", 1)[1].strip()
+        assert path.startswith(str(tmp_path)) and path.endswith(".pstats")
+        assert pstats.Stats(path).total_calls > 0
+        assert profiler.profiler is None
+        # Invalid durations are refused without starting a capture
+        for query in (b"seconds=abc", b"seconds=-1", b"seconds=0", b"seconds=nan", b"seconds=inf"):
+            running, response = asyncio.get_event_loop().run_until_complete(capture(query))
+            assert not running and response.startswith("HTTP/1.1 400 Bad Request")
+
+    def test_shared_metrics_copies(self):
+        # Each docker image only gets its own directory, so server.py and client.py carry the same metrics code
+        for name in ("Histogram", "Counter", "Gauge", "Metrics", "StageTimer", "ProfileCapture"):
+            assert inspect.getsource(getattr(docker_server.server, name)) == inspect.getsource(getattr(docker_client.client, name)), name
+
     def test_ball_radius(self):
         # Constraining radius of the ball 
         TestServer.radius = 5 